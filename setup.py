@@ -62,12 +62,15 @@ setup(
             'manyalign = txm2nexuslib.scripts.manyalign:main',
             'manyaverage = txm2nexuslib.scripts.manyaverage:main',
             'img2stack = txm2nexuslib.scripts.img2stack:main',
+            'materializestack = txm2nexuslib.scripts.materializestack:main',
+            'index2sqlite = txm2nexuslib.scripts.index2sqlite:main',
             'manyxrm2norm = txm2nexuslib.workflows.manyxrm2norm:main',
             'xtendof = txm2nexuslib.workflows.xtendof:main',
             'magnetism = txm2nexuslib.workflows.magnetism:main',
             'ctbio = txm2nexuslib.workflows.ctbio:main',
             'ctbiopartial = txm2nexuslib.workflows.ctbiopartial:main',
-            'energyscan = txm2nexuslib.workflows.energyscan:main'
+            'energyscan = txm2nexuslib.workflows.energyscan:main',
+            'txmwatch = txm2nexuslib.workflows.watch:main'
         ]
     },
     author='Marc Rosanes, Carlos Falcon, Zbigniew Reszela, Carlos Pascual',
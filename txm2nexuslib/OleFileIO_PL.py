@@ -20,7 +20,8 @@
 
 #------------------------------------------------------------------------------
 
-import string, StringIO, struct, array, os.path, sys
+import string, StringIO, struct, array, os.path, sys, mmap
+from collections import OrderedDict
 
 #[PL] workaround to fix an issue with array item size on 64 bits systems:
 if array.array('L').itemsize == 4:
@@ -332,6 +333,147 @@ class _OleStream(StringIO.StringIO):
         # Then the _OleStream object can be used as a read-only file object.
 
 
+    def getbuffer(self):
+        """
+        Return the whole stream data, to be used for instance with
+        numpy.frombuffer. (same API as _OleBufferStream)
+        """
+        return self.getvalue()
+
+
+#--- _OleBufferStream ---------------------------------------------------------
+
+def _buffer_view(buf, offset, size):
+    """
+    Read-only view on size bytes of buf starting at offset, without copy.
+    """
+    try:
+        return buffer(buf, offset, size)
+    except NameError:
+        # Python 3
+        return memoryview(buf)[offset:offset+size]
+
+
+def _sector_runs(sect, size, sectorsize, fat):
+    """
+    Follow the chain of sectors of a stream in the given FAT, with the same
+    checks as _OleStream, and coalesce the contiguous sectors.
+
+    sect      : sector index of first sector in the stream
+    size      : total size of the stream (0x7FFFFFFF if unknown)
+    sectorsize: size of one sector
+    fat       : array/list of sector indexes (FAT or MiniFAT)
+    return    : (runs, size, unknown_size), runs being a list of
+                [first sector, number of sectors] of contiguous sectors
+    """
+    unknown_size = False
+    if size==0x7FFFFFFF:
+        size = len(fat)*sectorsize
+        unknown_size = True
+    nb_sectors = (size + (sectorsize-1)) / sectorsize
+    if nb_sectors > len(fat):
+        raise IOError, 'malformed OLE document, stream too large'
+    if size == 0 and sect != ENDOFCHAIN:
+        raise IOError, 'incorrect OLE sector index for empty stream'
+    runs = []
+    for i in xrange(nb_sectors):
+        if sect == ENDOFCHAIN:
+            if unknown_size:
+                break
+            else:
+                raise IOError, 'incomplete OLE stream'
+        if sect<0 or sect>=len(fat):
+            raise IOError, 'incorrect OLE FAT, sector index out of range'
+        if runs and runs[-1][0] + runs[-1][1] == sect:
+            runs[-1][1] += 1
+        else:
+            runs.append([sect, 1])
+        sect = fat[sect]
+    if sect != ENDOFCHAIN:
+        raise IOError, 'incorrect last sector index in OLE stream'
+    return runs, size, unknown_size
+
+
+class _OleBufferStream(object):
+    """
+    OLE2 Stream read from a memory mapped OLE container
+
+    Returns a read-only file object which can be used to read the contents
+    of a OLE stream, as _OleStream does. The contiguous sectors of the
+    stream are read as single slices, and if the whole stream is contiguous
+    no copy of the data is done at all: getbuffer() returns a view on the
+    memory mapped file, which can be used directly by numpy.frombuffer.
+
+    Attributes:
+        - size: actual size of data stream, after it was opened.
+    """
+
+    def __init__(self, buf, sect, size, offset, sectorsize, fat):
+        """
+        Constructor for _OleBufferStream class.
+
+        buf       : buffer (mmap of the OLE container, or MiniFAT stream
+                    buffer)
+        sect      : sector index of first sector in the stream
+        size      : total size of the stream
+        offset    : offset in bytes for the first FAT or MiniFAT sector
+        sectorsize: size of one sector
+        fat       : array/list of sector indexes (FAT or MiniFAT)
+        """
+        runs, size, unknown_size = _sector_runs(sect, size, sectorsize, fat)
+        buffer_size = len(buf)
+        slices = []
+        for first, nb_sectors in runs:
+            start = offset + sectorsize * first
+            end = start + sectorsize * nb_sectors
+            # the last sector of the file may be incomplete:
+            if end > buffer_size and first + nb_sectors != len(fat):
+                raise IOError, 'incomplete OLE sector'
+            slices.append((start, min(end, buffer_size)))
+        available = sum([end - start for start, end in slices])
+        if available >= size:
+            self.size = size
+        elif unknown_size:
+            self.size = available
+        else:
+            raise IOError, 'OLE stream size is less than declared'
+        if len(slices) == 1:
+            # contiguous stream: zero-copy view
+            self._buffer = _buffer_view(buf, slices[0][0], self.size)
+        else:
+            data = [buf[start:end] for start, end in slices]
+            self._buffer = b''.join(data)[:self.size]
+        self._pos = 0
+
+    def getbuffer(self):
+        """
+        Return a read-only buffer with the whole stream data.
+        """
+        return self._buffer
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            end = self.size
+        else:
+            end = min(self._pos + n, self.size)
+        data = bytes(self._buffer[self._pos:end])
+        self._pos = max(self._pos, end)
+        return data
+
+    def seek(self, pos, mode=0):
+        if mode == 1:
+            pos += self._pos
+        elif mode == 2:
+            pos += self.size
+        self._pos = max(0, pos)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._buffer = None
+
+
 #--- _OleDirectoryEntry -------------------------------------------------------
 
 class _OleDirectoryEntry:
@@ -558,6 +700,113 @@ class _OleDirectoryEntry:
             kid.dump(tab + 2)
 
 
+#--- _OleIndexCache ------------------------------------------------------------
+
+# Attributes of OleFileIO set when parsing the header, FAT and directory.
+_INDEX_ATTRIBUTES = (
+    'Sig', 'clsid', 'MinorVersion', 'DllVersion', 'ByteOrder', 'SectorShift',
+    'MiniSectorShift', 'Reserved', 'Reserved1', 'csectDir', 'csectFat',
+    'sectDirStart', 'signature', 'MiniSectorCutoff', 'MiniFatStart',
+    'csectMiniFat', 'sectDifStart', 'csectDif', 'SectorSize',
+    'MiniSectorSize', 'nb_sect', 'sectorsize', 'minisectorsize',
+    'minisectorcutoff', 'minifatsect', 'fat', 'direntries', 'root')
+
+# Rough memory used by a parsed directory entry object
+_DIRENTRY_COST = 1024
+
+
+class _OleIndexCache(object):
+    """
+    Process-level LRU cache of the parsed OLE headers, FAT, MiniFAT and
+    directory trees, indexed by file path.
+
+    An index is only reused while the size and modification time of the
+    file are unchanged. The indexes are never modified after parsing
+    (except to add the MiniFAT, which is loaded lazily), so they are
+    shared by all the OleFileIO objects opening the same file.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        max_bytes: memory cap of the cache (0 disables it)
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._indexes = OrderedDict()
+
+    def _index_bytes(self, index):
+        nbytes = len(index['fat']) * index['fat'].itemsize
+        nbytes += len(index['direntries']) * _DIRENTRY_COST
+        if index.get('minifat') is not None:
+            nbytes += len(index['minifat']) * index['minifat'].itemsize
+        return nbytes
+
+    def get(self, key, stamp):
+        """
+        Return the index of the file, or None if it is not cached or the
+        file changed since it was parsed (stamp: (size, mtime)).
+        """
+        index = self._indexes.pop(key, None)
+        if index is None:
+            return None
+        if index['stamp'] != stamp:
+            self.nbytes -= index['nbytes']
+            return None
+        # most recently used indexes are at the end
+        self._indexes[key] = index
+        return index
+
+    def put(self, key, index):
+        self.discard(key)
+        index['key'] = key
+        index['nbytes'] = self._index_bytes(index)
+        if index['nbytes'] > self.max_bytes:
+            return
+        self._indexes[key] = index
+        self.nbytes += index['nbytes']
+        self._shrink()
+
+    def update(self, index):
+        """
+        Account for attributes added to an index after it was cached.
+        """
+        if self._indexes.get(index.get('key')) is not index:
+            return
+        nbytes = self._index_bytes(index)
+        self.nbytes += nbytes - index['nbytes']
+        index['nbytes'] = nbytes
+        self._shrink()
+
+    def discard(self, key):
+        index = self._indexes.pop(key, None)
+        if index is not None:
+            self.nbytes -= index['nbytes']
+
+    def clear(self):
+        self._indexes.clear()
+        self.nbytes = 0
+
+    def _shrink(self):
+        while self.nbytes > self.max_bytes and self._indexes:
+            key, index = self._indexes.popitem(last=False)
+            self.nbytes -= index['nbytes']
+
+    def __len__(self):
+        return len(self._indexes)
+
+
+_index_cache = _OleIndexCache(64 * 1024 * 1024)
+
+
+def set_index_cache_size(max_bytes):
+    """
+    Set the memory cap (in bytes) of the cache of parsed OLE indexes
+    shared by the OleFileIO objects of the process. 0 disables the cache.
+    """
+    _index_cache.max_bytes = max_bytes
+    _index_cache._shrink()
+
+
 #--- OleFileIO ----------------------------------------------------------------
 
 class OleFileIO:
@@ -589,7 +838,8 @@ class OleFileIO:
     TIFF files).
     """
 
-    def __init__(self, filename = None, raise_defects=DEFECT_FATAL):
+    def __init__(self, filename = None, raise_defects=DEFECT_FATAL,
+                 use_mmap=False):
         """
         Constructor for OleFileIO class.
 
@@ -597,8 +847,13 @@ class OleFileIO:
         raise_defects: minimal level for defects to be raised as exceptions.
         (use DEFECT_FATAL for a typical application, DEFECT_INCORRECT for a
         security-oriented application, see source code for details)
+        use_mmap: if True, the file is memory mapped and openstream returns
+        _OleBufferStream objects (zero-copy for contiguous streams). Falls
+        back to the usual reading if the file cannot be mapped.
         """
         self._raise_defects_level = raise_defects
+        self.use_mmap = use_mmap
+        self._mmap = None
         if filename:
             self.open(filename)
 
@@ -627,6 +882,10 @@ class OleFileIO:
 
         """
         self.fp.close()
+        # The mapping is not closed explicitly: buffers returned by
+        # _OleBufferStream.getbuffer (e.g. numpy views on images) may still
+        # be in use, the file is unmapped once they are all released.
+        self._mmap = None
             
 
     def open(self, filename):
@@ -644,12 +903,34 @@ class OleFileIO:
         else:
             # string-like object
             self.fp = open(filename, "rb")
+            if self.use_mmap:
+                try:
+                    self._mmap = mmap.mmap(self.fp.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError):
+                    # e.g. empty file, or file system not supporting mmap
+                    self._mmap = None
+
         # old code fails if filename is not a plain string:   
         #if type(filename) == type(""):
         #    self.fp = open(filename, "rb")
         #else:
         #    self.fp = filename
 
+        # reuse the header, FAT and directory parsed by a previous open of
+        # the same unchanged file, if available:
+        self._index = None
+        self.minifat = None
+        index_key = None
+        if not hasattr(filename, 'read') and _index_cache.max_bytes > 0:
+            stat = os.fstat(self.fp.fileno())
+            index_stamp = (stat.st_size, stat.st_mtime)
+            index_key = (os.path.abspath(filename), self._raise_defects_level)
+            index = _index_cache.get(index_key, index_stamp)
+            if index is not None:
+                self._load_index(index)
+                return
+
         # lists of streams in FAT and MiniFAT, to detect duplicate references
         # (list of indexes of first sectors of each stream)
         self._used_streams_fat = []
@@ -799,6 +1080,40 @@ class OleFileIO:
         self.ministream = None
         self.minifatsect = self.MiniFatStart #i32(header, 60)
 
+        if index_key is not None:
+            self._store_index(index_key, index_stamp)
+
+
+    def _store_index(self, key, stamp):
+        """
+        Put the parsed header, FAT and directory in the index cache.
+        """
+        # the directory entries only use their OleFileIO while parsing, the
+        # reference is dropped to not keep this object (and its file)
+        # alive in the cache:
+        for entry in self.direntries:
+            if entry is not None:
+                entry.olefile = None
+        self.directory_fp = None
+        index = dict([(name, getattr(self, name))
+                      for name in _INDEX_ATTRIBUTES])
+        index['stamp'] = stamp
+        index['minifat'] = None
+        _index_cache.put(key, index)
+        self._index = index
+
+
+    def _load_index(self, index):
+        """
+        Set the header, FAT and directory from a cached index.
+        """
+        for name in _INDEX_ATTRIBUTES:
+            setattr(self, name, index[name])
+        if index['minifat'] is not None:
+            self.minifat = index['minifat']
+        self.ministream = None
+        self._index = index
+
 
     def _check_duplicate_stream(self, first_sect, minifat=False):
         """
@@ -1017,6 +1332,9 @@ class OleFileIO:
         # Then shrink the array to used size, to avoid indexes out of MiniStream:
         if DEBUG_MODE: print 'MiniFAT shrunk from %d to %d sectors' % (len(self.minifat), nb_minisectors)
         self.minifat = self.minifat[:nb_minisectors]
+        if self._index is not None:
+            self._index['minifat'] = self.minifat
+            _index_cache.update(self._index)
         if DEBUG_MODE: print 'loadminifat(): len=%d' % len(self.minifat)
         if DEBUG_MODE: print '\nMiniFAT:'
         self.dumpfat(self.minifat)
@@ -1130,7 +1448,8 @@ class OleFileIO:
             # ministream object
             if not self.ministream:
                 # load MiniFAT if it wasn't already done:
-                self.loadminifat()
+                if getattr(self, 'minifat', None) is None:
+                    self.loadminifat()
                 # The first sector index of the miniFAT stream is stored in the
                 # root directory entry:
                 size_ministream = self.root.size
@@ -1138,10 +1457,18 @@ class OleFileIO:
                     (self.root.isectStart, size_ministream))
                 self.ministream = self._open(self.root.isectStart,
                     size_ministream, force_FAT=True)
+            if self._mmap is not None:
+                return _OleBufferStream(self.ministream.getbuffer(), start,
+                                        size, 0, self.minisectorsize,
+                                        self.minifat)
             return _OleStream(self.ministream, start, size, 0,
                               self.minisectorsize, self.minifat)
         else:
             # standard stream
+            if self._mmap is not None:
+                return _OleBufferStream(self._mmap, start, size,
+                                        self.sectorsize, self.sectorsize,
+                                        self.fat)
 #            return _OleStream(self.fp, start, size, 512,
 #                              self.sectorsize, self.fat)
             return _OleStream(self.fp, start, size, self.sectorsize,
@@ -1203,7 +1530,8 @@ class OleFileIO:
 
     def openstream(self, filename):
         """
-        Open a stream as a read-only file object (StringIO).
+        Open a stream as a read-only file object (StringIO, or
+        _OleBufferStream if the file is memory mapped).
 
         filename: path of stream in storage tree (except root entry), either:
             - a string using Unix path syntax, for example:
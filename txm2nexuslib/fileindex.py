@@ -0,0 +1,340 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2019 ALBA-CELLS - CTGENSOFT
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Backends of the files index DataBase.
+
+The index of the data files (index.json) is a TinyDB DataBase by default.
+Big experiments can use instead an SQLite DataBase (index.sqlite), which
+offers the subset of the TinyDB API used by the pipeline, and which has
+indexes on the keys used to group the images (date, sample, energy, ...).
+Both are opened with open_index, depending on the file extension.
+"""
+
+import os
+import json
+import sqlite3
+from itertools import groupby
+
+from tinydb import TinyDB
+from tinydb.database import Document
+from tinydb.storages import JSONStorage
+from tinydb.middlewares import CachingMiddleware
+
+
+SQLITE_EXTENSIONS = ('.sqlite', '.db')
+DEFAULT_TABLE = "_default"
+
+# Record keys stored in their own (indexed) columns
+INDEXED_KEYS = ('date', 'sample', 'energy', 'angle', 'zpz', 'FF',
+                'repetition', 'filename')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    tbl TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    {columns},
+    document TEXT NOT NULL,
+    PRIMARY KEY (tbl, doc_id));
+CREATE INDEX IF NOT EXISTS documents_groups
+    ON documents (tbl, date, sample, energy, zpz, angle);
+CREATE INDEX IF NOT EXISTS documents_ff
+    ON documents (tbl, "FF", date, sample, energy);
+CREATE INDEX IF NOT EXISTS documents_filename
+    ON documents (tbl, filename);
+""".format(columns=",\n    ".join(['"%s"' % key for key in INDEXED_KEYS]))
+
+
+def is_sqlite_index(filename):
+    return os.path.splitext(filename)[1] in SQLITE_EXTENSIONS
+
+
+def open_index(filename, caching=True):
+    """Open a files index DataBase: SQLite if the filename extension is
+    .sqlite or .db, TinyDB (JSON) otherwise. The JSON DataBases are
+    written when closed if caching is True."""
+    if is_sqlite_index(filename):
+        return SQLiteIndex(filename)
+    if caching:
+        return TinyDB(filename, storage=CachingMiddleware(JSONStorage))
+    return TinyDB(filename)
+
+
+def _column_value(value):
+    """Value stored in an indexed column: only scalars are indexed"""
+    if isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    return None
+
+
+def _query_to_sql(hashval):
+    """Translate a TinyDB query to an SQL condition on the indexed
+    columns. The condition is necessary but may not be sufficient (the
+    records are always checked with the query itself): the parts of the
+    query which cannot be translated are replaced by a true condition.
+    Return (condition, parameters); condition is None if it is true."""
+    if not isinstance(hashval, tuple) or not hashval:
+        return None, []
+    operation = hashval[0]
+    if operation == '==':
+        path, value = hashval[1], hashval[2]
+        if (len(path) == 1 and path[0] in INDEXED_KEYS and
+                _column_value(value) is not None):
+            return '"%s" = ?' % path[0], [value]
+    elif operation in ('and', 'or'):
+        conditions = []
+        parameters = []
+        for operand in hashval[1]:
+            condition, operand_parameters = _query_to_sql(operand)
+            if condition is None:
+                if operation == 'or':
+                    return None, []
+                continue
+            conditions.append("(%s)" % condition)
+            parameters.extend(operand_parameters)
+        if conditions:
+            return (" %s " % operation.upper()).join(conditions), parameters
+    return None, []
+
+
+class SQLiteTable(object):
+    """Table of an SQLiteIndex, with the TinyDB Table API"""
+
+    def __init__(self, index, name):
+        self._index = index
+        self.name = name
+
+    @property
+    def _connection(self):
+        return self._index.connection
+
+    def _select(self, cond=None, order_by=None):
+        sql = "SELECT doc_id, document FROM documents WHERE tbl = ?"
+        parameters = [self.name]
+        if cond is not None:
+            condition, query_parameters = _query_to_sql(
+                getattr(cond, 'hashval', None))
+            if condition is not None:
+                sql += " AND (%s)" % condition
+                parameters.extend(query_parameters)
+        sql += " ORDER BY %s" % (order_by or "doc_id")
+        for doc_id, document in self._connection.execute(sql, parameters):
+            record = Document(json.loads(document), doc_id)
+            if cond is None or cond(record):
+                yield record
+
+    def _row(self, doc_id, document):
+        return ([self.name, doc_id] +
+                [_column_value(document.get(key)) for key in INDEXED_KEYS] +
+                [json.dumps(document)])
+
+    def _insert(self, documents, replace=False):
+        sql = "INSERT %s INTO documents VALUES (%s)" % (
+            "OR REPLACE" if replace else "",
+            ", ".join(["?"] * (len(INDEXED_KEYS) + 3)))
+        self._connection.executemany(
+            sql, [self._row(doc_id, document)
+                  for doc_id, document in documents])
+
+    def _write(self, documents, replace=False):
+        with self._connection:
+            self._insert(documents, replace=replace)
+
+    def _next_ids(self, count):
+        last_id = self._connection.execute(
+            "SELECT MAX(doc_id) FROM documents WHERE tbl = ?",
+            [self.name]).fetchone()[0] or 0
+        return range(last_id + 1, last_id + 1 + count)
+
+    def all(self):
+        return list(self._select())
+
+    def __iter__(self):
+        return self._select()
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM documents WHERE tbl = ?",
+            [self.name]).fetchone()[0]
+
+    def search(self, cond):
+        return list(self._select(cond))
+
+    def get(self, cond=None, doc_id=None):
+        if doc_id is not None:
+            row = self._connection.execute(
+                "SELECT document FROM documents WHERE tbl = ? AND "
+                "doc_id = ?", [self.name, doc_id]).fetchone()
+            return Document(json.loads(row[0]), doc_id) if row else None
+        for record in self._select(cond):
+            return record
+
+    def contains(self, cond=None, doc_ids=None):
+        if doc_ids is not None:
+            return any(self.get(doc_id=doc_id) for doc_id in doc_ids)
+        return self.get(cond) is not None
+
+    def count(self, cond):
+        return len(self.search(cond))
+
+    def insert(self, document):
+        return self.insert_multiple([document])[0]
+
+    def insert_multiple(self, documents):
+        documents = list(documents)
+        with self._connection:
+            # The DataBase is locked for writing before allocating the ids,
+            # so that concurrent processes cannot allocate the same ones
+            self._connection.execute("BEGIN IMMEDIATE")
+            doc_ids = self._next_ids(len(documents))
+            self._insert(zip(doc_ids, documents))
+        return doc_ids
+
+    def _records(self, cond=None, doc_ids=None):
+        if doc_ids is not None:
+            return [record for record in
+                    [self.get(doc_id=doc_id) for doc_id in doc_ids]
+                    if record is not None]
+        return list(self._select(cond))
+
+    def update(self, fields, cond=None, doc_ids=None):
+        """Update the records matching cond (or doc_ids) with the fields
+        dictionary, or by calling fields(record) if it is callable"""
+        records = self._records(cond, doc_ids)
+        for record in records:
+            if callable(fields):
+                fields(record)
+            else:
+                record.update(fields)
+        self._write([(record.doc_id, record) for record in records],
+                    replace=True)
+        return [record.doc_id for record in records]
+
+    def upsert(self, document, cond):
+        updated_ids = self.update(document, cond)
+        if updated_ids:
+            return updated_ids
+        return [self.insert(document)]
+
+    def remove(self, cond=None, doc_ids=None):
+        doc_ids = [record.doc_id for record in self._records(cond, doc_ids)]
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM documents WHERE tbl = ? AND doc_id = ?",
+                [(self.name, doc_id) for doc_id in doc_ids])
+        return doc_ids
+
+    def purge(self):
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM documents WHERE tbl = ?", [self.name])
+
+    def group_by(self, keys, cond=None):
+        """Group the records (matching cond, if given) by the values of
+        keys, with a single query using the indexes of the grouping keys.
+        Return a list of (values, records) ordered by values; records
+        without some of the keys have None as value of that key."""
+        keys = list(keys)
+        indexed_keys = [key for key in keys if key in INDEXED_KEYS]
+        order_by = ", ".join(['"%s"' % key for key in indexed_keys] +
+                             ["doc_id"])
+        records = self._select(cond, order_by=order_by)
+
+        def group_key(record):
+            return tuple(record.get(key) for key in keys)
+
+        if len(indexed_keys) < len(keys):
+            records = sorted(records, key=group_key)
+        return [(values, list(group))
+                for values, group in groupby(records, key=group_key)]
+
+
+class SQLiteIndex(object):
+    """Files index DataBase stored in SQLite, with the subset of the
+    TinyDB API used by the pipeline. The DataBase uses WAL journaling,
+    so that different processes can read it while it is being written."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+        self._tables = {}
+
+    def table(self, name=DEFAULT_TABLE, **kwargs):
+        if name not in self._tables:
+            self._tables[name] = SQLiteTable(self, name)
+        return self._tables[name]
+
+    def tables(self):
+        rows = self.connection.execute(
+            "SELECT DISTINCT tbl FROM documents").fetchall()
+        return set([row[0] for row in rows])
+
+    def purge_table(self, name):
+        self.table(name).purge()
+        self._tables.pop(name, None)
+
+    def purge_tables(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM documents")
+        self._tables = {}
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        # As TinyDB, the DataBase forwards unknown attributes
+        # to its default table
+        if name.startswith('_') or name in ('connection', 'filename'):
+            raise AttributeError(name)
+        return getattr(self.table(), name)
+
+    def __len__(self):
+        return len(self.table())
+
+    def __iter__(self):
+        return iter(self.table())
+
+
+def migrate_index(json_filename, sqlite_filename=None):
+    """Import the tables of a TinyDB (JSON) files index into an SQLite
+    files index, keeping the document ids. Return the SQLite filename."""
+    if sqlite_filename is None:
+        sqlite_filename = os.path.splitext(json_filename)[0] + '.sqlite'
+    json_db = TinyDB(json_filename, storage=CachingMiddleware(JSONStorage))
+    sqlite_db = SQLiteIndex(sqlite_filename)
+    for name in json_db.tables():
+        table = sqlite_db.table(name)
+        table.purge()
+        table._write([(record.doc_id, dict(record))
+                      for record in json_db.table(name).all()])
+    json_db.close()
+    sqlite_db.close()
+    return sqlite_filename
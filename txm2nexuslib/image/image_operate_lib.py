@@ -38,22 +38,61 @@ class Image(object):
         self.h5_image_filename = h5_image_filename
         self.f_h5_handler = h5py.File(h5_image_filename, mode)
         self.data_type = np.int32
-        self.image = 0
+        self._image = None
         self.image_dataset = ""
-        self.extract_single_image_from_h5(image_data_set)
+        self.image_data_set = image_data_set
+        self.extract_single_image_from_h5(image_data_set, read_image=False)
         self.workflow_step = 1
         self.metadata = None
 
-    def extract_single_image_from_h5(self, data_set="data"):
-        image = self.f_h5_handler[data_set].value
-        data_type = type(image[0][0])
-        self.data_type = data_type
-        self.image = np.array(image, dtype=self.data_type)
+    def extract_single_image_from_h5(self, data_set="data", read_image=True):
+        """Get the name, data type and (if read_image is True) the pixels
+        of the image. If the data set is a link (as "data"), it is
+        resolved, so the image is the same even if the link is moved to
+        a new stored image"""
+        link = self.f_h5_handler.get(data_set, getlink=True)
+        if isinstance(link, h5py.SoftLink):
+            data_set = link.path
+        self.image_data_set = data_set
+        image_data_set = self.f_h5_handler[data_set]
+        self.data_type = image_data_set.dtype.type
+        self._image = None
+        if read_image:
+            self._image = image_data_set[...]
         try:
-            self.image_dataset = self.f_h5_handler[data_set].attrs["dataset"]
+            self.image_dataset = image_data_set.attrs["dataset"]
         except:
             self.image_dataset = "unknown_dataset"
 
+    @property
+    def image(self):
+        """Image pixels, read from the hdf5 file on first access"""
+        if self._image is None:
+            self._image = self.f_h5_handler[self.image_data_set][...]
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+
+    @property
+    def shape(self):
+        """Shape of the image, without reading its pixels"""
+        if self._image is not None:
+            return np.shape(self._image)
+        return self.f_h5_handler[self.image_data_set].shape
+
+    def read_region(self, roi={"top": 26, "bottom": 24, "left": 21,
+                               "right": 19}):
+        """Read only the pixels of the image which are not cut off by
+        the roi (an hdf5 hyperslab), unless the image is already read"""
+        if self._image is not None:
+            return crop_image(self._image, roi)
+        rows, columns = self.shape
+        return self.f_h5_handler[self.image_data_set][
+            roi["top"]:rows - roi["bottom"],
+            roi["left"]:columns - roi["right"]]
+
     def store_image_in_h5(self, image, dataset="default",
                           description="default"):
         """Store a single image in an hdf5 file"""
@@ -120,13 +159,7 @@ class Image(object):
         """Crop an image. The roi indicates the pixels to be cut off.
         A default ROI is given to cut
         the image borders"""
-        [rows, columns] = np.shape(self.image)
-        rows_from = roi["top"]
-        rows_to = rows - roi["bottom"]
-        columns_from = roi["left"]
-        columns_to = columns - roi["right"]
-        image_cropped = self.image[rows_from:rows_to,
-                                   columns_from:columns_to]
+        image_cropped = self.read_region(roi)
         description = ("Image " + self.image_dataset +
                        " cropped by " + str(roi))
         return image_cropped, description
@@ -166,6 +199,47 @@ class Image(object):
         self.f_h5_handler.close()
 
 
+def crop_image(image, roi={"top": 26, "bottom": 24, "left": 21,
+                           "right": 19}):
+    """Crop an image array. The roi indicates the pixels to be cut off"""
+    [rows, columns] = np.shape(image)
+    rows_from = roi["top"]
+    rows_to = rows - roi["bottom"]
+    columns_from = roi["left"]
+    columns_to = columns - roi["right"]
+    return image[rows_from:rows_to, columns_from:columns_to]
+
+
+def average_image_arrays(images):
+    """Average of the images given by an iterable of image arrays.
+    The result is a float32 image"""
+    average_image = None
+    num_imgs = 0
+    for image in images:
+        if average_image is None:
+            average_image = np.zeros(np.shape(image),
+                                     dtype=type(np.float32))
+        average_image += image
+        num_imgs += 1
+    average_image /= num_imgs
+    return np.float32(average_image)
+
+
+def average_normalized_image_arrays(images):
+    """Average of the images given by an iterable of image arrays,
+    computed with the data type of the first image"""
+    average_image = None
+    num_imgs = 0
+    for image in images:
+        if average_image is None:
+            average_image = np.zeros(np.shape(image),
+                                     dtype=type(image[0][0]))
+        average_image += image
+        num_imgs += 1
+    average_image /= num_imgs
+    return average_image
+
+
 def copy_h5(input, output):
     """Copy file to a new file"""
     shutil.copy(input, output)
@@ -364,18 +438,15 @@ def average_images(image_filenames, dataset_for_average="data",
                    description="", store=False,
                    output_h5_fn="default", dataset_store="data"):
     """Average images"""
-    image_obj = Image(h5_image_filename=image_filenames[0])
-    average_image = np.zeros(np.shape(image_obj.image),
-                             dtype=type(np.float32))
-    num_imgs = len(image_filenames)
-    for image_fn in image_filenames:
-        image_obj = Image(h5_image_filename=image_fn,
-                          image_data_set=dataset_for_average)
-        average_image += image_obj.image
-        image_obj.close_h5()
+    def images():
+        for image_fn in image_filenames:
+            image_obj = Image(h5_image_filename=image_fn,
+                              image_data_set=dataset_for_average)
+            yield image_obj.image
+            image_obj.close_h5()
+
     # Average of images that have been beforehand normalized by a constant
-    average_image /= num_imgs
-    average_image = np.float32(average_image)
+    average_image = average_image_arrays(images())
     # Store the average image in the first of the input h5 image file
 
     if store:
@@ -400,20 +471,16 @@ def divide_by_constant_and_average_images(image_filenames, constant=None,
     If the constant is not indicated, as default, the constant is
     the exposure time multiplied by the machine current. If the images shall
     not be normalized, set the constant to 1."""
-    image_obj = Image(h5_image_filename=image_filenames[0])
-    image_norm_by_constant = image_obj.normalize_by_constant(constant)
-    average_image = np.zeros(np.shape(image_obj.image),
-                             dtype=type(image_norm_by_constant[0][0]))
-    image_obj.close_h5()
-    num_imgs = len(image_filenames)
-    for image_fn in image_filenames:
-        image_obj = Image(h5_image_filename=image_fn)
-        image_norm_by_constant = image_obj.normalize_by_constant(
-            constant, store_normalized_by_constant)
-        average_image += image_norm_by_constant
-        image_obj.close_h5()
+    def images_norm_by_constant():
+        for image_fn in image_filenames:
+            image_obj = Image(h5_image_filename=image_fn)
+            yield image_obj.normalize_by_constant(
+                constant, store_normalized_by_constant)
+            image_obj.close_h5()
+
     # Average of images that have been beforehand normalized by a constant
-    average_image /= num_imgs
+    average_image = average_normalized_image_arrays(
+        images_norm_by_constant())
     # Store the average image in the first of the input h5 image file
     if store:
         image_obj = Image(h5_image_filename=image_filenames[0])
@@ -485,7 +552,9 @@ def normalize_image(image_filename, ff_img_filenames=[],
         else:
             ff_img_obj = Image(h5_image_filename=ff_img_filenames)
 
-        if np.shape(image_obj.image) != np.shape(ff_img_obj.image):
+        ff_shape = ff_img_obj.shape
+        ff_img_obj.close_h5()
+        if image_obj.shape != ff_shape:
             raise Exception("Image dimensions does not correspond with "
                    "ff image dimensions")
         ff_norm_image = normalize_ff(ff_img_filenames)
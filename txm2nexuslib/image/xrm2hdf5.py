@@ -25,13 +25,18 @@ import sys
 import h5py
 import numpy as np
 from txm2nexuslib.xrmnex import XradiaFile
+from txm2nexuslib.image.image_operate_lib import crop_image
 
 
 class Xrm2H5Converter(object):
+    """Convert a single image xrm file to an hdf5 file. If a roi is
+    given, the pixels it cuts off (the image borders) are dropped while
+    the image is decoded, and only the cropped image is written"""
 
-    def __init__(self, xrm_filename, h5_filename=None):
+    def __init__(self, xrm_filename, h5_filename=None, roi=None):
         self.xrm_filename = xrm_filename
         self.h5_filename = h5_filename
+        self.roi = roi
         if h5_filename is None:
             self.h5_filename = os.path.splitext(xrm_filename)[0] + '.hdf5'
         self.h5_handler = h5py.File(self.h5_filename, 'w')
@@ -218,7 +223,14 @@ class Xrm2H5Converter(object):
     def _convert_raw_image_from_xrm_to_h5(self):
         with XradiaFile(self.xrm_filename) as self.xrm_file:
             try:
+                # Read-only view on the (memory mapped) image stream:
+                # cropping it does not read the cut off rows
                 self.data['data'] = self.xrm_file.get_image_2D()
+                description = "raw data"
+                if self.roi is not None:
+                    self.data['data'] = crop_image(self.data['data'],
+                                                   self.roi)
+                    description += " cropped by " + str(self.roi)
                 self.h5_handler.create_dataset(
                     "data_1",
                     dtype=np.uint16,
@@ -227,7 +239,7 @@ class Xrm2H5Converter(object):
                 dataset = "data_" + str(workflow_step)
                 self.h5_handler[dataset].attrs["step"] = workflow_step
                 self.h5_handler[dataset].attrs["dataset"] = dataset
-                self.h5_handler[dataset].attrs["description"] = "raw data"
+                self.h5_handler[dataset].attrs["description"] = description
                 self.h5_handler["data"] = h5py.SoftLink(dataset)
             except Exception:
                 print("image raw data could not be converted from xrm to hdf5")
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2019 ALBA-CELLS - CTGENSOFT
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+"""Cache of the averaged FlatField (FF) images.
+
+The images of a group (date, sample, energy, and jj's if used) are
+normalized by the average of the FF images of the group, each FF image
+being normalized beforehand by its exposure time and machine current.
+The averaged FF of each group is kept in an in-memory LRU cache of the
+running process, and in an hdf5 sidecar file of the files index
+(index_ffcache.hdf5), for later runs. An averaged FF is only reused
+while the size and modification time of the FF files are unchanged.
+"""
+
+import os
+import json
+from collections import OrderedDict
+
+import h5py
+
+
+FF_CACHE_SUFFIX = "_ffcache.hdf5"
+
+
+def ff_cache_filename(file_index_fn):
+    """Sidecar hdf5 file of the averaged FF of a files index"""
+    return os.path.splitext(file_index_fn)[0] + FF_CACHE_SUFFIX
+
+
+def ff_files_stamp(ff_filenames):
+    """(basename, size, modification time) of each FF file"""
+    stamp = []
+    for ff_filename in sorted(ff_filenames):
+        stat = os.stat(ff_filename)
+        stamp.append([os.path.basename(ff_filename), stat.st_size,
+                      stat.st_mtime])
+    return stamp
+
+
+def _group_name(group_key):
+    return "_".join([str(value) for value in group_key]).replace("/", "-")
+
+
+class FFCache(object):
+    """Averaged FF images by group key, stored in memory (at most
+    max_images) and, if a sidecar filename is given, in an hdf5 file"""
+
+    def __init__(self, sidecar_filename=None, max_images=8):
+        self.sidecar_filename = sidecar_filename
+        self.max_images = max_images
+        self._images = OrderedDict()
+
+    def _read_sidecar(self, group_key, stamp):
+        if (self.sidecar_filename is None or
+                not os.path.exists(self.sidecar_filename)):
+            return None
+        with h5py.File(self.sidecar_filename, "r") as f:
+            name = _group_name(group_key)
+            if name not in f:
+                return None
+            if json.loads(f[name].attrs["ff_files"]) != stamp:
+                return None
+            return f[name][...]
+
+    def _write_sidecar(self, group_key, stamp, ff_image):
+        if self.sidecar_filename is None:
+            return
+        with h5py.File(self.sidecar_filename, "a") as f:
+            name = _group_name(group_key)
+            if name in f:
+                del f[name]
+            f.create_dataset(name, data=ff_image)
+            f[name].attrs["ff_files"] = json.dumps(stamp)
+
+    def get(self, group_key, ff_filenames):
+        """Averaged FF of the group, or None if it is not cached or the
+        FF files changed since it was cached"""
+        group_key = tuple(group_key)
+        stamp = ff_files_stamp(ff_filenames)
+        entry = self._images.pop(group_key, None)
+        if entry is not None and entry[0] == stamp:
+            # most recently used images are at the end
+            self._images[group_key] = entry
+            return entry[1]
+        ff_image = self._read_sidecar(group_key, stamp)
+        if ff_image is not None:
+            self._put(group_key, stamp, ff_image)
+        return ff_image
+
+    def put(self, group_key, ff_filenames, ff_image):
+        """Cache the averaged FF of the group. It must be called once the
+        FF files are written (the normalized FF images are stored in
+        them)"""
+        group_key = tuple(group_key)
+        stamp = ff_files_stamp(ff_filenames)
+        self._put(group_key, stamp, ff_image)
+        self._write_sidecar(group_key, stamp, ff_image)
+
+    def _put(self, group_key, stamp, ff_image):
+        self._images.pop(group_key, None)
+        self._images[group_key] = (stamp, ff_image)
+        while len(self._images) > self.max_images:
+            self._images.popitem(last=False)
+
+    def clear(self):
+        """Clear the in-memory cache (the sidecar file is kept)"""
+        self._images.clear()
+
+    def __len__(self):
+        return len(self._images)
+
+
+_ff_caches = {}
+
+
+def get_ff_cache(file_index_fn):
+    """FF cache of a files index, shared by the stages of the process"""
+    sidecar_filename = ff_cache_filename(os.path.abspath(file_index_fn))
+    if sidecar_filename not in _ff_caches:
+        _ff_caches[sidecar_filename] = FFCache(sidecar_filename)
+    return _ff_caches[sidecar_filename]
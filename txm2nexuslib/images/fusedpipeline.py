@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2019 ALBA-CELLS - CTGENSOFT
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Fused pre-processing of single image xrm files.
+
+The usual pre-processing runs one stage after the other (xrm -> hdf5 raw
+-> hdf5 for processing -> crop -> normalize -> align -> average), each
+stage reading the images written by the previous one. The fused
+pre-processing loads each group of raw xrm images once, and applies all
+the operations in memory, writing only the averaged images (and, as
+checkpoints, the normalized images in the hdf5 files for processing).
+The same image operations are used, so the results are identical.
+"""
+
+import os
+import time
+
+import numpy as np
+from joblib import delayed
+from tinydb import Query
+
+from txm2nexuslib.util import get_parallel
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.xrmnex import XradiaFile
+from txm2nexuslib.image.util import align
+from txm2nexuslib.image.xrm2hdf5 import Xrm2H5Converter
+from txm2nexuslib.image.image_operate_lib import (
+    Image, crop_image, average_image_arrays, average_normalized_image_arrays,
+    store_single_image_in_new_h5)
+from txm2nexuslib.images.util import group_records
+from txm2nexuslib.images.multipleaverage import (zpz_average_record,
+                                                 store_average_metadata)
+
+
+DEFAULT_ROI = {"top": 26, "bottom": 24, "left": 21, "right": 19}
+
+
+def read_xrm_image(xrm_filename, roi=None):
+    """Raw image of a single image xrm file (as stored in the hdf5 raw
+    files), cropped by the roi if given, and its metadata"""
+    with XradiaFile(xrm_filename) as xrm_file:
+        image = xrm_file.get_image_2D()
+        if roi is not None:
+            image = crop_image(image, roi)
+        image = np.array(image, dtype=np.uint16)
+        metadata = {"angle": xrm_file.get_angles()[0],
+                    "energy": xrm_file.get_energies()[0],
+                    "exposure_time": xrm_file.get_exp_times()[0],
+                    "machine_current": xrm_file.get_machine_currents()[0],
+                    "pixel_size": xrm_file.pixel_size,
+                    "magnification": xrm_file.get_xray_magnification()}
+    return image, metadata
+
+
+def _proc_filename(xrm_filename, suffix="_proc"):
+    return os.path.splitext(xrm_filename)[0] + suffix + ".hdf5"
+
+
+def _store_checkpoint(xrm_filename, images_and_descriptions):
+    """Store the images in the hdf5 file for processing of the xrm file,
+    as the successive pre-processing stages do"""
+    proc_filename = _proc_filename(xrm_filename)
+    Xrm2H5Converter(xrm_filename, proc_filename).convert_xrm_to_h5_file()
+    image_obj = Image(h5_image_filename=proc_filename)
+    for image, description in images_and_descriptions:
+        image_obj.store_image_in_h5(image, description=description)
+    image_obj.close_h5()
+
+
+def _load_cropped(xrm_filename, crop, roi):
+    image, metadata = read_xrm_image(xrm_filename,
+                                     roi=roi if crop else None)
+    steps = []
+    if crop:
+        steps.append((image, "Image data_1 cropped by " + str(roi)))
+    return image, metadata, steps
+
+
+def normalize_ff_images(ff_filenames, crop=True, roi=DEFAULT_ROI,
+                        checkpoint=False):
+    """Average FF image, each FF image being normalized by its exposure
+    time and machine current"""
+    ff_images_norm = []
+    for ff_filename in ff_filenames:
+        image, metadata, steps = _load_cropped(ff_filename, crop, roi)
+        constant = metadata["exposure_time"] * metadata["machine_current"]
+        image_norm = image / constant
+        ff_images_norm.append(image_norm)
+        if len(ff_filenames) > 1:
+            steps.append((image_norm, "Image normalized by a constant"))
+        if checkpoint:
+            _store_checkpoint(ff_filename, steps)
+    if len(ff_images_norm) == 1:
+        return ff_images_norm[0]
+    ff_norm_image = average_normalized_image_arrays(ff_images_norm)
+    if checkpoint:
+        image_obj = Image(h5_image_filename=_proc_filename(ff_filenames[0]))
+        image_obj.store_image_in_h5(
+            ff_norm_image,
+            description=("Average image calculated after normalizing each "
+                         "of the input images by a constant. If the "
+                         "constant is not indicated, its default value is "
+                         "the multiplication of the exposure time by the "
+                         "machine current"))
+        image_obj.close_h5()
+    return ff_norm_image
+
+
+def normalize_and_average(xrm_filenames, ff_norm_image, group_key=None,
+                          central_zpz=None, crop=True, roi=DEFAULT_ROI,
+                          align_method='cv2.TM_SQDIFF_NORMED',
+                          roi_size=0.5, average=True, checkpoint=False):
+    """Crop and normalize the images of a same angle (different zpz),
+    align them to the first image and average them. Return the record
+    of the average image, or None if average is False"""
+    normalized_images = []
+    first_metadata = None
+    for xrm_filename in xrm_filenames:
+        image, metadata, steps = _load_cropped(xrm_filename, crop, roi)
+        if first_metadata is None:
+            first_metadata = metadata
+        constant = metadata["exposure_time"] * metadata["machine_current"]
+        normalized_image = (image / constant) / ff_norm_image
+        normalized_images.append(normalized_image)
+        if checkpoint:
+            steps.append((normalized_image,
+                          os.path.basename(xrm_filename) +
+                          " normalized by average FF, using exposure time "
+                          "and machine current"))
+            _store_checkpoint(xrm_filename, steps)
+    if not average:
+        return None
+
+    reference_image = normalized_images[0]
+    aligned_images = [reference_image]
+    for normalized_image in normalized_images[1:]:
+        aligned_image, _ = align(reference_image, normalized_image,
+                                 align_method=align_method,
+                                 roi_size=roi_size)
+        aligned_images.append(aligned_image)
+    average_image = average_image_arrays(aligned_images)
+
+    output_fn, record = zpz_average_record(group_key, central_zpz)
+    output_complete_fn = os.path.join(os.path.dirname(xrm_filenames[0]),
+                                      output_fn)
+    store_single_image_in_new_h5(output_complete_fn, average_image,
+                                 data_set="data")
+    image_obj = Image(output_complete_fn)
+    store_average_metadata(image_obj.f_h5_handler, first_metadata)
+    image_obj.close_h5()
+    return record
+
+
+def fused_preprocessing(file_index_fn, crop=True, roi=DEFAULT_ROI,
+                        align_method='cv2.TM_SQDIFF_NORMED', roi_size=0.5,
+                        average=True, checkpoint=False, subfolders=False,
+                        cores=-2, query=None, executor=None):
+    """Pre-process the xrm images of the files index in a single pass:
+    xrm -> crop -> normalize -> align for same angle and variable zpz ->
+    average all images with same angle.
+    The average images are stored and indexed (table hdf5_averages) as
+    average_image_groups does. If checkpoint is True, the normalized
+    images (and the FF images) are also stored in the hdf5 files for
+    processing, and indexed in the table hdf5_proc, as the stages of the
+    usual pre-processing do.
+    The groups of images of a same angle are processed in parallel: all
+    cores but one used (Value=-2), or the workers of the executor if given.
+    """
+    start_time = time.time()
+    root_path = os.path.dirname(os.path.abspath(file_index_fn))
+    db = open_index(file_index_fn)
+    file_records = db.all()
+    n_files = 0
+
+    records = []
+    for group in group_records(file_records, ("date", "sample", "energy"),
+                               sort_by=None, query=query,
+                               root_path=root_path,
+                               use_subfolders=subfolders):
+        if not group.ff_files:
+            msg = "FlatFields are not present, images cannot be normalized"
+            raise Exception(msg)
+        ff_norm_image = normalize_ff_images(group.ff_files, crop=crop,
+                                            roi=roi, checkpoint=checkpoint)
+        angle_groups = []
+        for angle_group in group_records(
+                group.records, ("date", "sample", "energy", "angle"),
+                sort_by=None, split_ff=False, root_path=root_path,
+                use_subfolders=subfolders):
+            num_zpz = len(angle_group.records)
+            central_zpz = 0
+            for img_record in angle_group.records:
+                central_zpz += img_record["zpz"]
+            central_zpz /= round(float(num_zpz), 1)
+            angle_groups.append((angle_group.files, angle_group.key,
+                                 central_zpz))
+            n_files += len(angle_group.files)
+
+        records.extend(get_parallel(executor, cores)(
+            delayed(normalize_and_average)(
+                files, ff_norm_image, group_key=key,
+                central_zpz=central_zpz, crop=crop, roi=roi,
+                align_method=align_method, roi_size=roi_size,
+                average=average, checkpoint=checkpoint
+            ) for files, key, central_zpz in angle_groups))
+        if checkpoint:
+            _index_proc_files(db, group.records + group.ff_records)
+
+    if average:
+        averages_table = db.table("hdf5_averages")
+        averages_table.purge()
+        averages_table.insert_multiple(records)
+    db.close()
+
+    print("--- Fused pre-processing of %d files took %s seconds ---\n" %
+          (n_files, (time.time() - start_time)))
+
+
+def _index_proc_files(db, xrm_records):
+    """Index the hdf5 files for processing of the xrm records"""
+    proc_records = []
+    for record in xrm_records:
+        record = dict(record)
+        record.update({'filename': _proc_filename(record['filename']),
+                       'extension': '.hdf5', 'processed': True})
+        proc_records.append(record)
+    proc_table = db.table("hdf5_proc")
+    proc_table.remove(Query().filename.one_of(
+        [record['filename'] for record in proc_records]))
+    proc_table.insert_multiple(proc_records)
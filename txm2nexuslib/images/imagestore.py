@@ -0,0 +1,623 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2019 ALBA-CELLS - CTGENSOFT
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""Consolidated image store of an experiment.
+
+The usual pre-processing writes one hdf5 file per xrm image, and each
+stage opens and closes all these files. The image store keeps instead all
+the images of a same date and sample in a single hdf5 file:
+- one dataset (N, rows, columns) per processing step (data_1, data_2...),
+  the last one being linked by the SoftLink data, as in the single image
+  files. Each step records its operation (crop, normalize or align) and is
+  computed from the step of the preceding operation (or from the raw
+  images, data_1), so running a stage again rewrites its own step instead
+  of processing the images twice;
+- one metadata column (N values) per metadata name (angle, energy, zpz,
+  exposure_time, machine_current, pixel_size, magnification, jj_u and
+  jj_d; NaN when unknown).
+The records of the table hdf5_store of the files index keep the store
+filename and the row of each image. The stages (crop, normalize, align,
+average and stacks) read and write slabs of the store.
+"""
+
+import os
+import time
+
+import h5py
+import numpy as np
+from joblib import delayed
+
+from txm2nexuslib.util import get_parallel
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.parser import get_file_paths
+from txm2nexuslib.image.util import align
+from txm2nexuslib.image.image_operate_lib import (
+    crop_image, average_image_arrays, average_normalized_image_arrays)
+from txm2nexuslib.images.util import group_records, dict2hdf5
+from txm2nexuslib.images.fusedpipeline import read_xrm_image, DEFAULT_ROI
+from txm2nexuslib.images.multipleaverage import (AVERAGE_METADATA,
+                                                 zpz_average_record)
+from txm2nexuslib.images.imagestostack import (
+    create_structure_dict, metadata_rows_2_stack_dict, stack_record,
+    stack_dataset_names)
+
+
+STORE_TABLE = "hdf5_store"
+STORE_AVERAGES_TABLE = "hdf5_store_averages"
+# The images of a same date and sample are stored in the same file
+STORE_KEYS = ("date", "sample")
+METADATA_COLUMNS = ("angle", "energy", "zpz", "exposure_time",
+                    "machine_current", "pixel_size", "magnification",
+                    "jj_u", "jj_d")
+METADATA_UNITS = {"angle": "degrees", "energy": "eV", "exposure_time": "s",
+                  "machine_current": "mA", "pixel_size": "um"}
+# Processing steps of the stores, in the order they are applied
+STORE_OPERATIONS = ("crop", "normalize", "align")
+# Number of images read or written at once
+BLOCK_SIZE = 64
+
+
+def store_filename(date, sample, suffix="_store"):
+    return str(date) + "_" + str(sample) + suffix + ".hdf5"
+
+
+class ImageStore(object):
+    """Images of a same date and sample, stored in a single hdf5 file"""
+
+    def __init__(self, filename, mode="r+"):
+        self.filename = filename
+        self.f_h5_handler = h5py.File(filename, mode)
+
+    def __len__(self):
+        if "data_1" not in self.f_h5_handler:
+            return 0
+        return self.f_h5_handler["data_1"].shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def data(self):
+        """Dataset of the last processing step"""
+        return self.f_h5_handler["data"]
+
+    def steps(self):
+        """Datasets of the processing steps, sorted by step"""
+        f = self.f_h5_handler
+        steps = [f[name] for name in f if name.startswith("data_")]
+        return sorted(steps, key=lambda dataset: int(dataset.attrs["step"]))
+
+    def step(self, operation):
+        """Dataset of the step of the given operation (None if the
+        operation has not been applied)"""
+        for dataset in self.steps():
+            if dataset.attrs.get("operation") == operation:
+                return dataset
+        return None
+
+    def source(self, operation):
+        """Dataset from which the step of the given operation is computed:
+        the step of the last preceding operation already applied, or the raw
+        images"""
+        preceding = STORE_OPERATIONS[:STORE_OPERATIONS.index(operation)]
+        for previous in reversed(preceding):
+            dataset = self.step(previous)
+            if dataset is not None:
+                return dataset
+        return self.f_h5_handler["data_1"]
+
+    def append(self, images, metadata_rows):
+        """Append raw images (array (n, rows, columns)) and their metadata
+        (one dictionary per image) to the store. Return their rows. If the
+        images have already been processed, the rows are added as well to
+        the processing steps, and they are filled when the stages are run
+        again"""
+        f = self.f_h5_handler
+        images = np.asarray(images)
+        if "data_1" not in f:
+            num_rows, num_columns = images.shape[1:]
+            dataset = f.create_dataset(
+                "data_1", shape=(0, num_rows, num_columns),
+                maxshape=(None, num_rows, num_columns),
+                chunks=(1, num_rows, num_columns), dtype=images.dtype)
+            dataset.attrs["step"] = 1
+            dataset.attrs["dataset"] = "data_1"
+            dataset.attrs["description"] = "Raw images"
+            f["data"] = h5py.SoftLink("data_1")
+            metadata_grp = f.create_group("metadata")
+            for name in METADATA_COLUMNS:
+                metadata_grp.create_dataset(name, shape=(0,),
+                                            maxshape=(None,),
+                                            chunks=(BLOCK_SIZE,),
+                                            dtype=np.float64)
+                if name in METADATA_UNITS:
+                    metadata_grp[name].attrs["units"] = METADATA_UNITS[name]
+
+        first_row = len(self)
+        last_row = first_row + len(images)
+        for dataset in self.steps():
+            dataset.resize(last_row, axis=0)
+            step_metadata = "metadata_" + dataset.attrs["dataset"]
+            if step_metadata in f:
+                for column in f[step_metadata].values():
+                    column.resize(last_row, axis=0)
+        f["data_1"][first_row:last_row] = images
+        for name in METADATA_COLUMNS:
+            column = f["metadata"][name]
+            column.resize((last_row,))
+            column[first_row:last_row] = [
+                np.nan if row.get(name) is None else row[name]
+                for row in metadata_rows]
+        return range(first_row, last_row)
+
+    def metadata(self, rows):
+        """Metadata of the given rows: one dictionary per row, without the
+        unknown values"""
+        columns = dict([(name, self.f_h5_handler["metadata"][name][...])
+                        for name in METADATA_COLUMNS])
+        metadata_rows = []
+        for row in rows:
+            metadata_rows.append(dict(
+                [(name, columns[name][row]) for name in METADATA_COLUMNS
+                 if not np.isnan(columns[name][row])]))
+        return metadata_rows
+
+    def read(self, rows, dataset="data"):
+        """Images of the given rows, in the given order"""
+        rows = list(rows)
+        unique_rows = sorted(set(rows))
+        if unique_rows == range(unique_rows[0], unique_rows[-1] + 1):
+            images = self.f_h5_handler[dataset][
+                unique_rows[0]:unique_rows[-1] + 1]
+        else:
+            images = self.f_h5_handler[dataset][unique_rows]
+        if rows == unique_rows:
+            return images
+        positions = dict([(row, i) for i, row in enumerate(unique_rows)])
+        return images[[positions[row] for row in rows]]
+
+    def blocks(self, block_size=BLOCK_SIZE):
+        """Consecutive slices of rows covering the store"""
+        num_images = len(self)
+        for start in range(0, num_images, block_size):
+            yield start, min(start + block_size, num_images)
+
+    def create_step(self, operation, image_shape, dtype,
+                    description="default"):
+        """Create the dataset of the processing step of the given
+        operation, which becomes the data of the store (as
+        store_image_in_h5 does for the single image files). If the operation
+        has already been applied, its step is replaced, and the steps of the
+        following operations, computed from it, are removed"""
+        f = self.f_h5_handler
+        previous = self.step(operation)
+        if previous is not None:
+            step = int(previous.attrs["step"])
+            following = STORE_OPERATIONS[
+                STORE_OPERATIONS.index(operation):]
+            for dataset in self.steps():
+                if dataset.attrs.get("operation") in following:
+                    name = dataset.attrs["dataset"]
+                    del f[name]
+                    if "metadata_" + name in f:
+                        del f["metadata_" + name]
+        else:
+            step = int(self.steps()[-1].attrs["step"]) + 1
+        name = "data_" + str(step)
+        image_shape = tuple(image_shape)
+        dataset = f.create_dataset(name, shape=(len(self),) + image_shape,
+                                   maxshape=(None,) + image_shape,
+                                   chunks=(1,) + image_shape, dtype=dtype)
+        dataset.attrs["step"] = step
+        dataset.attrs["dataset"] = name
+        dataset.attrs["operation"] = operation
+        dataset.attrs["description"] = description
+        del f["data"]
+        f["data"] = h5py.SoftLink(name)
+        return dataset
+
+    def close(self):
+        self.f_h5_handler.flush()
+        self.f_h5_handler.close()
+
+
+def _store_groups(file_index_fn, table_name=STORE_TABLE, query=None):
+    """Records of the store table grouped by store, sorted by row. Only
+    the stores having some record matching query are returned"""
+    db = open_index(file_index_fn)
+    records = db.table(table_name).all()
+    db.close()
+    root_path = os.path.dirname(os.path.abspath(file_index_fn))
+    for group in group_records(records, ("store",), sort_by="row",
+                               split_ff=False):
+        if query is None or any([query(record) for record in group.records]):
+            yield os.path.join(root_path, group.key[0]), group.records
+
+
+def xrm_to_store(file_index_fn, subfolders=False, cores=-2, query=None,
+                 suffix="_store", executor=None):
+    """Store the xrm images of the files index in image stores (one per
+    date and sample), and index them in the table hdf5_store. The images
+    already stored are skipped, so the stores can be built while the
+    images are acquired. The xrm files are read in parallel: all cores
+    but one used (Value=-2), or the workers of the executor if given"""
+    start_time = time.time()
+    root_path = os.path.dirname(os.path.abspath(file_index_fn))
+    db = open_index(file_index_fn)
+    if query is not None:
+        file_records = db.search(query)
+    else:
+        file_records = db.all()
+    store_table = db.table(STORE_TABLE)
+    stored = set([record["filename"] for record in store_table.all()])
+    file_records = [record for record in file_records
+                    if record["filename"] not in stored]
+
+    paths = get_file_paths(file_records, root_path,
+                           use_subfolders=subfolders)
+    paths = dict([(os.path.basename(path), path) for path in paths])
+    file_records = [record for record in file_records
+                    if record["filename"] in paths]
+
+    store_records = []
+    for group in group_records(file_records, STORE_KEYS, sort_by=None,
+                               split_ff=False):
+        date, sample = group.key
+        filename = store_filename(date, sample, suffix=suffix)
+        with ImageStore(os.path.join(root_path, filename), "a") as store:
+            for start in range(0, len(group.records), BLOCK_SIZE):
+                records = group.records[start:start + BLOCK_SIZE]
+                images_and_metadata = get_parallel(executor, cores)(
+                    delayed(read_xrm_image)(paths[record["filename"]])
+                    for record in records)
+                metadata_rows = []
+                for record, (_, metadata) in zip(records,
+                                                 images_and_metadata):
+                    metadata = dict(metadata)
+                    for name in ("zpz", "jj_u", "jj_d"):
+                        metadata[name] = record.get(name)
+                    metadata_rows.append(metadata)
+                rows = store.append([image for image, _ in
+                                     images_and_metadata], metadata_rows)
+                for record, row in zip(records, rows):
+                    record = dict(record)
+                    record.update({"store": filename, "row": row})
+                    store_records.append(record)
+    store_table.insert_multiple(store_records)
+    db.close()
+
+    print("--- Store %d xrm files took %s seconds ---\n" %
+          (len(store_records), (time.time() - start_time)))
+
+
+def crop_store(file_index_fn, roi=DEFAULT_ROI, query=None):
+    """Crop all the images of the stores (of the records matching query,
+    if given)"""
+    start_time = time.time()
+    n_images = 0
+    for filename, _ in _store_groups(file_index_fn, query=query):
+        with ImageStore(filename) as store:
+            data = store.source("crop")
+            image_shape = np.shape(crop_image(data[0], roi))
+            cropped = store.create_step(
+                "crop", image_shape, data.dtype,
+                description=("Images " + data.attrs["dataset"] +
+                             " cropped by " + str(roi)))
+            for start, stop in store.blocks():
+                cropped[start:stop] = data[start:stop, roi["top"]:
+                                           data.shape[1] - roi["bottom"],
+                                           roi["left"]:
+                                           data.shape[2] - roi["right"]]
+            n_images += len(store)
+    print("--- Crop %d stored images took %s seconds ---\n" %
+          (n_images, (time.time() - start_time)))
+
+
+def normalize_store(file_index_fn, query=None, jj=False):
+    """Normalize the images of the stores by their exposure time and
+    machine current, and by the average FF of their date, sample and
+    energy (and jj's). As normalize_images does with the single image
+    files, each FF image is beforehand normalized by its exposure time and
+    machine current, and if there are many FF images, the first one is
+    replaced by their average. Only the images matching query (if given)
+    are normalized; the other ones are kept."""
+    start_time = time.time()
+    keys = ["date", "sample", "energy"]
+    if jj is True:
+        keys += ["jj_u", "jj_d"]
+
+    n_images = 0
+    for filename, records in _store_groups(file_index_fn, query=query):
+        with ImageStore(filename) as store:
+            data = store.source("normalize")
+            metadata_rows = store.metadata(range(len(store)))
+            constants = [metadata["exposure_time"] *
+                         metadata["machine_current"]
+                         for metadata in metadata_rows]
+            # Images replacing the FF images, and average FF image used to
+            # normalize each data image
+            ff_images = {}
+            ff_norm_images = {}
+            for group in group_records(records, keys, sort_by=None,
+                                       query=query):
+                if not group.ff_records:
+                    msg = ("FlatFields are not present, images cannot be "
+                           "normalized")
+                    raise Exception(msg)
+                ff_rows = [record["row"] for record in group.ff_records]
+                ff_images_norm = [image / constants[row] for row, image in
+                                  zip(ff_rows, store.read(
+                                      ff_rows, dataset=data.name))]
+                if len(ff_rows) > 1:
+                    ff_norm_image = average_normalized_image_arrays(
+                        ff_images_norm)
+                    ff_images.update(zip(ff_rows, ff_images_norm))
+                    ff_images[ff_rows[0]] = ff_norm_image
+                else:
+                    ff_norm_image = ff_images_norm[0]
+                for record in group.records:
+                    ff_norm_images[record["row"]] = ff_norm_image
+                n_images += len(group.records)
+
+            normalized = store.create_step(
+                "normalize", data.shape[1:], np.float64,
+                description=("Images " + data.attrs["dataset"] +
+                             " normalized by average FF, using exposure "
+                             "time and machine current. To calculate the "
+                             "average FF, each FF image has been, "
+                             "beforehand, normalized by its exposure time "
+                             "and machine current"))
+            for start, stop in store.blocks():
+                images = data[start:stop]
+                normalized_images = np.array(images, dtype=np.float64)
+                for row in range(start, stop):
+                    if row in ff_images:
+                        normalized_images[row - start] = ff_images[row]
+                    elif row in ff_norm_images:
+                        normalized_images[row - start] = (
+                            (images[row - start] / constants[row]) /
+                            ff_norm_images[row])
+                normalized[start:stop] = normalized_images
+    print("--- Normalize %d stored images took %s seconds ---\n" %
+          (n_images, (time.time() - start_time)))
+
+
+def _align_images(couples_to_align, align_method='cv2.TM_CCOEFF_NORMED',
+                  roi_size=0.5):
+    return [align(image_ref, image_to_align, align_method=align_method,
+                  roi_size=roi_size)
+            for image_ref, image_to_align in couples_to_align]
+
+
+def align_store(file_index_fn, variable="zpz",
+                align_method='cv2.TM_CCOEFF_NORMED', roi_size=0.5,
+                cores=-2, query=None, jj=True, executor=None):
+    """Align the images of the stores as align_images does: the images of
+    a same date, sample, energy and angle (variable zpz), or of a same
+    date, sample, energy, jj's and angle (variable repetition) are aligned
+    to the first image of their group. The images which are not aligned
+    are kept. The move vectors are stored in metadata_<dataset>. The
+    alignments are computed in parallel: all cores but one used
+    (Value=-2), or the workers of the executor if given"""
+    start_time = time.time()
+    keys = None
+    if variable == "zpz":
+        keys = ("date", "sample", "energy", "angle")
+    elif variable == "repetition" and jj:
+        keys = ("date", "sample", "energy", "jj_u", "jj_d", "angle")
+    elif variable == "repetition" and not jj:
+        keys = ("date", "sample", "energy")
+
+    n_images = 0
+    for filename, records in _store_groups(file_index_fn, query=query):
+        data_records = [record for record in records
+                        if record.get("FF") is not True]
+        # Row of the reference image of each image to be aligned
+        references = {}
+        if keys is not None:
+            for group in group_records(data_records, keys, sort_by=None,
+                                       split_ff=False, query=query):
+                ref_row = group.records[0]["row"]
+                for record in group.records[1:]:
+                    references[record["row"]] = ref_row
+        n_images += len(data_records)
+
+        with ImageStore(filename) as store:
+            data = store.source("align")
+            aligned = store.create_step(
+                "align", data.shape[1:],
+                np.result_type(data.dtype, np.float32),
+                description=("Images " + data.attrs["dataset"] +
+                             " aligned taking as reference the first image "
+                             "of their group (same " + ", ".join(keys) +
+                             ")"))
+            move_vectors = store.f_h5_handler.create_group(
+                "metadata_" + aligned.attrs["dataset"]).create_dataset(
+                "move_vector", shape=(len(store), 2), maxshape=(None, 2),
+                dtype=np.int64)
+            for start, stop in store.blocks():
+                images = np.array(data[start:stop], dtype=aligned.dtype)
+                rows = [row for row in range(start, stop)
+                        if row in references]
+                if rows:
+                    reference_images = store.read(
+                        [references[row] for row in rows],
+                        dataset=data.name)
+                    couples = zip(reference_images,
+                                  [images[row - start] for row in rows])
+                    results = get_parallel(executor, cores)(
+                        delayed(_align_images)(
+                            couples[i:i + 4], align_method=align_method,
+                            roi_size=roi_size)
+                        for i in range(0, len(couples), 4))
+                    results = [result for chunk in results
+                               for result in chunk]
+                    for row, (aligned_image, mv_vector) in zip(rows,
+                                                               results):
+                        images[row - start] = aligned_image
+                        move_vectors[row] = mv_vector
+                aligned[start:stop] = images
+    print("--- Align %d stored images took %s seconds ---\n" %
+          (n_images, (time.time() - start_time)))
+
+
+def average_store(file_index_fn, query=None, suffix="_avg_store"):
+    """Average the images of the stores having the same date, sample,
+    energy and angle (and different zpz), as average_image_groups does.
+    The average images are stored in new image stores (one per date and
+    sample), and indexed in the table hdf5_store_averages"""
+    start_time = time.time()
+    root_path = os.path.dirname(os.path.abspath(file_index_fn))
+    average_records = []
+    n_images = 0
+    for filename, records in _store_groups(file_index_fn, query=query):
+        data_records = [record for record in records
+                        if record.get("FF") is not True]
+        with ImageStore(filename, "r") as store:
+            average_images = []
+            metadata_rows = []
+            for group in group_records(data_records,
+                                       ("date", "sample", "energy",
+                                        "angle"),
+                                       sort_by=None, split_ff=False,
+                                       query=query):
+                rows = [record["row"] for record in group.records]
+                num_zpz = len(rows)
+                central_zpz = 0
+                for img_record in group.records:
+                    central_zpz += img_record["zpz"]
+                central_zpz /= round(float(num_zpz), 1)
+                average_images.append(average_image_arrays(store.read(rows)))
+
+                # Metadata of the first averaged image
+                metadata = store.metadata(rows[:1])[0]
+                metadata = dict([(name, metadata[name])
+                                 for name in AVERAGE_METADATA
+                                 if name in metadata])
+                if "energy" in metadata:
+                    metadata["energy"] = round(metadata["energy"], 1)
+                if "angle" in metadata:
+                    metadata["angle"] = round(metadata["angle"], 2)
+                metadata["zpz"] = central_zpz
+                metadata_rows.append(metadata)
+
+                _, record = zpz_average_record(group.key, central_zpz)
+                del record["filename"], record["extension"]
+                average_records.append(record)
+                n_images += num_zpz
+        if not average_images:
+            continue
+        date, sample = data_records[0]["date"], data_records[0]["sample"]
+        average_filename = store_filename(date, sample, suffix=suffix)
+        with ImageStore(os.path.join(root_path, average_filename),
+                        "w") as average_store_obj:
+            rows = average_store_obj.append(average_images, metadata_rows)
+        for record, row in zip(average_records[-len(rows):], rows):
+            record.update({"store": average_filename, "row": row})
+
+    db = open_index(file_index_fn)
+    averages_table = db.table(STORE_AVERAGES_TABLE)
+    averages_table.purge()
+    averages_table.insert_multiple(average_records)
+    db.close()
+    print("--- Average %d stored images by groups, took %s seconds ---\n" %
+          (n_images, (time.time() - start_time)))
+
+
+def _write_stack_dataset(h5_grp, dataset_name, store, rows):
+    num_rows, num_columns = store.data.shape[1:]
+    dataset = h5_grp.create_dataset(
+        dataset_name, shape=(len(rows), num_rows, num_columns),
+        chunks=(1, num_rows, num_columns), dtype='float32')
+    dataset.attrs['Number of Frames'] = len(rows)
+    for start in range(0, len(rows), BLOCK_SIZE):
+        dataset[start:start + BLOCK_SIZE] = store.read(
+            rows[start:start + BLOCK_SIZE])
+
+
+def store_to_stack(file_index_fn, table_name=STORE_TABLE,
+                   type_struct="normalized", suffix="_stack"):
+    """Build the stacks of images from the image stores, as
+    many_images_to_h5_stack does from the single image files (for the
+    normalized, normalized_multifocus, normalized_simple, aligned and
+    aligned_multifocus stacks). The stacks are indexed in the table
+    hdf5_stacks"""
+    print("--- Stored images to stacks ---")
+    start_time = time.time()
+    root_path = os.path.dirname(os.path.abspath(file_index_fn))
+    records = []
+    for filename, store_records in _store_groups(file_index_fn,
+                                                 table_name=table_name):
+        if type_struct == "normalized" or type_struct == "aligned":
+            # The FF of a stack are the ones of its date, sample and energy
+            groups = group_records(store_records,
+                                   ("date", "sample", "energy", "zpz"),
+                                   ff_keys=("date", "sample", "energy"))
+            keys = ("date", "sample", "energy", "zpz")
+        else:
+            groups = group_records(store_records,
+                                   ("date", "sample", "energy"),
+                                   split_ff=False)
+            keys = ("date", "sample", "energy")
+        main_grp, main_dataset, ff_dataset = stack_dataset_names(
+            type_struct)
+
+        with ImageStore(filename, "r") as store:
+            for group in groups:
+                files_for_stack = dict(zip(keys, group.key))
+                rows = [record["row"] for record in group.records]
+                ff_rows = [record["row"] for record in group.ff_records]
+                average_ff = None
+                if ff_rows and type_struct == "normalized":
+                    average_ff = store.read(ff_rows[:1])[0]
+                data_dict = metadata_rows_2_stack_dict(
+                    create_structure_dict(type_struct=type_struct),
+                    store.metadata(rows),
+                    ff_metadata_rows=store.metadata(ff_rows),
+                    average_ff=average_ff, type_struct=type_struct)
+
+                h5_out_fn, record = stack_record(
+                    files_for_stack, type_struct=type_struct, suffix=suffix)
+                h5_stack_file_handler = h5py.File(
+                    os.path.join(root_path, h5_out_fn), "w")
+                dict2hdf5(h5_stack_file_handler, data_dict)
+                _write_stack_dataset(h5_stack_file_handler[main_grp],
+                                     main_dataset, store, rows)
+                if ff_rows and ff_dataset is not None:
+                    _write_stack_dataset(h5_stack_file_handler[main_grp],
+                                         ff_dataset, store, ff_rows)
+                h5_stack_file_handler.flush()
+                h5_stack_file_handler.close()
+                records.append(record)
+
+    db = open_index(file_index_fn)
+    stack_table = db.table("hdf5_stacks")
+    stack_table.purge()
+    stack_table.insert_multiple(records)
+    db.close()
+    print("Created stacks:")
+    for record in records:
+        print(record["filename"])
+    print("--- Stored images to stacks took %s seconds ---\n" %
+          (time.time() - start_time))
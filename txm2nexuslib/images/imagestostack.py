@@ -26,17 +26,16 @@ import time
 import h5py
 import pprint
 import numpy as np
-from operator import itemgetter
 
-from joblib import Parallel, delayed
+from joblib import delayed, effective_n_jobs
 
-from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
-from tinydb.storages import MemoryStorage
+from tinydb import Query
 
-from txm2nexuslib.parser import get_file_paths
-from txm2nexuslib.images.util import filter_file_index, dict2hdf5
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.util import (ordered_imap, worker_pool, FrameWriter,
+                               get_parallel)
+from txm2nexuslib.images.util import (filter_file_index, dict2hdf5,
+                                      group_records)
 
 
 def create_structure_dict(type_struct="normalized"):
@@ -88,16 +87,14 @@ def create_structure_dict(type_struct="normalized"):
         pass
     return hdf5_metadata_structure_dict
 
-def metadata_2_stack_dict(hdf5_structure_dict,
-                          files_for_stack, ff_filenames=None,
-                          type_struct="normalized",
-                          avg_ff_dataset="data"):
-    """ Transfer data from many hdf5 individual image files
-    into a single hdf5 stack file.
+def metadata_rows_2_stack_dict(hdf5_structure_dict, metadata_rows,
+                               ff_metadata_rows=None, average_ff=None,
+                               type_struct="normalized", jj_offset=None):
+    """Fill the metadata structure of a stack from the metadata of its
+    images: each metadata row is a mapping from the metadata names to the
+    values of an image. average_ff is the average FF image of the stack.
     This method is quite specific for normalized BL09 images"""
 
-    data_filenames = files_for_stack["data"]
-
     num_keys = len(hdf5_structure_dict)
     if num_keys == 1:
         k, hdf5_structure_dict = hdf5_structure_dict.items()[0]
@@ -105,7 +102,7 @@ def metadata_2_stack_dict(hdf5_structure_dict,
     def extract_metadata_original(metadata_original, hdf5_structure_dict):
         for dataset_name in hdf5_structure_dict:
             if dataset_name in metadata_original:
-                value = metadata_original[dataset_name].value
+                value = metadata_original[dataset_name]
                 if (dataset_name == "energy" and
                         type_struct != "normalized_spectroscopy"):
                     value = round(value, 1)
@@ -115,15 +112,11 @@ def metadata_2_stack_dict(hdf5_structure_dict,
                 hdf5_structure_dict[dataset_name].append(value)
 
     if type_struct == "normalized_magnetism_many_repetitions":
-        jj_offset = files_for_stack["jj_offset"]
         hdf5_structure_dict["jj_offset"] = [jj_offset]
 
     c = 0
-    for file in data_filenames:
-        # print(file)
-        f = h5py.File(file, "r")
+    for metadata_original in metadata_rows:
         # Process metadata
-        metadata_original = f["metadata"]
         extract_metadata_original(metadata_original, hdf5_structure_dict)
         if (type_struct == "normalized" or
                 type_struct == "normalized_simple" or
@@ -134,60 +127,87 @@ def metadata_2_stack_dict(hdf5_structure_dict,
                 type_struct == "aligned_multifocus"):
             if c == 0:
                 hdf5_structure_dict["x_pixel_size"].append(
-                    round(metadata_original["pixel_size"].value, 6))
+                    round(metadata_original["pixel_size"], 6))
                 hdf5_structure_dict["y_pixel_size"].append(
-                    round(metadata_original["pixel_size"].value, 6))
+                    round(metadata_original["pixel_size"], 6))
             if ("energy" not in hdf5_structure_dict and
                     type_struct != "normalized_spectroscopy"):
                 hdf5_structure_dict["energy"].append(
-                    round(metadata_original["energy"].value, 1))
+                    round(metadata_original["energy"], 1))
             elif ("energy" not in hdf5_structure_dict and
                   type_struct == "normalized_spectroscopy"):
                 hdf5_structure_dict["energy"].append(
-                    round(metadata_original["energy"].value, 2))
+                    round(metadata_original["energy"], 2))
             hdf5_structure_dict["rotation_angle"].append(
-                round(metadata_original["angle"].value, 1))
+                round(metadata_original["angle"], 1))
         if type_struct == "normalized":
             hdf5_structure_dict["ExpTimesTomo"].append(
-                round(metadata_original["exposure_time"].value, 2))
+                round(metadata_original["exposure_time"], 2))
             hdf5_structure_dict["CurrentsTomo"].append(
-                round(metadata_original["machine_current"].value, 6))
-        f.close()
+                round(metadata_original["machine_current"], 6))
         c += 1
 
     c = 0
-    if ff_filenames and type_struct == "normalized":
-        for ff_file in ff_filenames:
-            f = h5py.File(ff_file, "r")
-            metadata_original = f["metadata"]
+    if ff_metadata_rows and type_struct == "normalized":
+        for metadata_original in ff_metadata_rows:
             # Process metadata
             if c == 0:
                 hdf5_structure_dict["Avg_FF_ExpTime"].append(
-                    metadata_original["exposure_time"].value)
-                hdf5_structure_dict["AverageFF"] = f[avg_ff_dataset].value
+                    metadata_original["exposure_time"])
+                hdf5_structure_dict["AverageFF"] = average_ff
             hdf5_structure_dict["CurrentsFF"].append(
-                metadata_original["machine_current"].value)
-            f.close()
+                metadata_original["machine_current"])
             c += 1
     if num_keys == 1:
         hdf5_structure_dict = {k: hdf5_structure_dict}
     return hdf5_structure_dict
 
 
-def data_2_hdf5(h5_stack_file_handler,
-                data_filenames, ff_filenames=None,
-                type_struct="normalized",
-                dataset="data"):
-    """Generic method to create an hdf5 stack of images from individual
-    images"""
+def _read_metadata(filename):
+    f = h5py.File(filename, "r")
+    metadata_original = f["metadata"]
+    metadata = dict([(name, metadata_original[name].value)
+                     for name in metadata_original])
+    f.close()
+    return metadata
+
+
+def metadata_2_stack_dict(hdf5_structure_dict,
+                          files_for_stack, ff_filenames=None,
+                          type_struct="normalized",
+                          avg_ff_dataset="data"):
+    """ Transfer data from many hdf5 individual image files
+    into a single hdf5 stack file.
+    This method is quite specific for normalized BL09 images"""
+
+    data_filenames = files_for_stack["data"]
+    metadata_rows = [_read_metadata(file) for file in data_filenames]
+    ff_metadata_rows = None
+    average_ff = None
+    if ff_filenames and type_struct == "normalized":
+        ff_metadata_rows = [_read_metadata(ff_file)
+                            for ff_file in ff_filenames]
+        f = h5py.File(ff_filenames[0], "r")
+        average_ff = f[avg_ff_dataset].value
+        f.close()
+    return metadata_rows_2_stack_dict(
+        hdf5_structure_dict, metadata_rows,
+        ff_metadata_rows=ff_metadata_rows, average_ff=average_ff,
+        type_struct=type_struct,
+        jj_offset=files_for_stack.get("jj_offset"))
 
+
+def stack_dataset_names(type_struct="normalized"):
+    """Group and dataset of the images of a stack, and dataset of its FF
+    images (None if the stack type has no FF images)"""
+    ff_dataset = None
     if (type_struct == "normalized" or
             type_struct == "normalized_simple" or
             type_struct == "normalized_multifocus" or
             type_struct == "normalized_magnetism_many_repetitions"):
         main_grp = "TomoNormalized"
         main_dataset = "TomoNormalized"
-        if ff_filenames and type_struct == "normalized":
+        if type_struct == "normalized":
             ff_dataset = "FFNormalizedWithCurrent"
     elif type_struct == "normalized_spectroscopy":
         main_grp = "SpecNormalized"
@@ -195,57 +215,159 @@ def data_2_hdf5(h5_stack_file_handler,
     elif type_struct == "aligned" or type_struct == "aligned_multifocus":
         main_grp = "FastAligned"
         main_dataset = "tomo_aligned"
-    else:
-        pass
+    return main_grp, main_dataset, ff_dataset
+
+
+def read_stack_frame(filename_and_dataset):
+    """Image of a single image file, as a float32 stack frame"""
+    filename, dataset = filename_and_dataset
+    f = h5py.File(filename, "r")
+    image = np.array(f[dataset], dtype=np.float32)
+    f.close()
+    return image
+
+
+def _write_stack_frames(h5_grp, dataset_name, filenames, dataset="data",
+                        readers=1, pool=None):
+    """Create a stack dataset and write in it the images of the single
+    image files. With several readers, a pool of processes (or the given
+    pool) reads ahead the next image files while a thread writes the
+    current images"""
+    f = h5py.File(filenames[0], "r")
+    num_rows, num_columns = f[dataset].shape
+    f.close()
+    n_frames = len(filenames)
+    h5_dataset = h5_grp.create_dataset(
+        dataset_name, shape=(n_frames, num_rows, num_columns),
+        chunks=(1, num_rows, num_columns), dtype='float32')
+    h5_dataset.attrs['Number of Frames'] = n_frames
+
+    files_and_datasets = [(file, dataset) for file in filenames]
+    if readers <= 1 or n_frames < 2:
+        for num_img, file_and_dataset in enumerate(files_and_datasets):
+            h5_dataset[num_img] = read_stack_frame(file_and_dataset)
+        return
+    images = ordered_imap(read_stack_frame, files_and_datasets, readers,
+                          pool=pool)
+    writer = FrameWriter(h5_dataset, queue_size=2 * readers)
+    writer.start()
+    try:
+        for image in images:
+            writer.put(image)
+    finally:
+        writer.close()
 
-    num_img = 0
-    for file in data_filenames:
-        # Images normalized
-        f = h5py.File(file, "r")
-        if num_img == 0:
-            n_frames = len(data_filenames)
-            num_rows, num_columns = np.shape(f[dataset].value)
-            h5_stack_file_handler[main_grp].create_dataset(
-                main_dataset,
-                shape=(n_frames, num_rows, num_columns),
-                chunks=(1, num_rows, num_columns),
-                dtype='float32')
-            h5_stack_file_handler[main_grp][main_dataset].attrs[
-                'Number of Frames'] = n_frames
-        h5_stack_file_handler[main_grp][main_dataset][
-            num_img] = f[dataset].value
-        f.close()
-        num_img += 1
 
-    if ff_filenames and type_struct == "normalized":
-        # FF images normalized by machine_current and exp time
-        num_img_ff = 0
-        for ff_file in ff_filenames:
-            f = h5py.File(ff_file, "r")
-            if num_img_ff == 0:
-                n_ff_frames = len(ff_filenames)
-                num_rows, num_columns = np.shape(f[dataset].value)
-                h5_stack_file_handler[main_grp].create_dataset(
-                    ff_dataset,
-                    shape=(n_ff_frames, num_rows, num_columns),
-                    chunks=(1, num_rows, num_columns),
-                    dtype='float32')
-                h5_stack_file_handler[main_grp][ff_dataset].attrs[
-                    'Number of Frames'] = n_ff_frames
-            h5_stack_file_handler[main_grp][ff_dataset][
-                num_img_ff] = f[dataset].value
-            f.close()
-            num_img_ff += 1
+def data_2_hdf5(h5_stack_file_handler,
+                data_filenames, ff_filenames=None,
+                type_struct="normalized",
+                dataset="data", readers=1, pool=None):
+    """Generic method to create an hdf5 stack of images from individual
+    images. readers is the number of processes reading the images (the
+    workers of pool, if given)"""
 
+    main_grp, main_dataset, ff_dataset = stack_dataset_names(type_struct)
 
-def make_stack(files_for_stack, root_path, type_struct="normalized",
-               suffix="_stack"):
+    # Images normalized
+    _write_stack_frames(h5_stack_file_handler[main_grp], main_dataset,
+                        data_filenames, dataset=dataset, readers=readers,
+                        pool=pool)
 
-    data_files = files_for_stack["data"]
-    if "ff" in files_for_stack:
-        data_files_ff = files_for_stack["ff"]
-    else:
-        data_files_ff = None
+    if ff_filenames and type_struct == "normalized":
+        # FF images normalized by machine_current and exp time
+        _write_stack_frames(h5_stack_file_handler[main_grp], ff_dataset,
+                            ff_filenames, dataset=dataset, readers=readers,
+                            pool=pool)
+
+
+def read_image_file(filename, dataset="data", read_image=False):
+    """Open a single image file once, to get its metadata, and the name
+    (following the SoftLink data), shape and dtype of its image dataset.
+    If read_image is True, the image is read as well"""
+    f = h5py.File(filename, "r")
+    link = f.get(dataset, getlink=True)
+    if isinstance(link, h5py.SoftLink):
+        dataset = link.path
+    image_dataset = f[dataset]
+    image_info = {"filename": filename, "dataset": dataset,
+                  "shape": image_dataset.shape, "dtype": image_dataset.dtype,
+                  "metadata": {}}
+    if "metadata" in f:
+        metadata_original = f["metadata"]
+        image_info["metadata"] = dict([(name, metadata_original[name].value)
+                                       for name in metadata_original])
+    if read_image:
+        image_info["image"] = image_dataset.value
+    f.close()
+    return image_info
+
+
+def virtual_data_2_hdf5(h5_stack_file_handler, stack_dir,
+                        data_image_infos, ff_image_infos=None,
+                        type_struct="normalized"):
+    """Create the datasets of an hdf5 stack as virtual datasets, mapping
+    each frame to the image dataset of its single image file (see
+    read_image_file). The single image files are referenced by their
+    paths relative to the directory of the stack (stack_dir): the stack
+    needs them (see materialize_stack)"""
+
+    main_grp, main_dataset, ff_dataset = stack_dataset_names(type_struct)
+
+    def create_virtual_dataset(dataset_name, image_infos):
+        n_frames = len(image_infos)
+        num_rows, num_columns = image_infos[0]["shape"]
+        layout = h5py.VirtualLayout(shape=(n_frames, num_rows, num_columns),
+                                    dtype='float32')
+        for num_img, image_info in enumerate(image_infos):
+            layout[num_img] = h5py.VirtualSource(
+                os.path.relpath(image_info["filename"], stack_dir),
+                image_info["dataset"], shape=image_info["shape"])
+        h5_stack_file_handler[main_grp].create_virtual_dataset(
+            dataset_name, layout)
+        h5_stack_file_handler[main_grp][dataset_name].attrs[
+            'Number of Frames'] = n_frames
+
+    create_virtual_dataset(main_dataset, data_image_infos)
+    if ff_image_infos and type_struct == "normalized":
+        # FF images normalized by machine_current and exp time
+        create_virtual_dataset(ff_dataset, ff_image_infos)
+
+
+def materialize_stack(stack_filename):
+    """Replace the virtual datasets of an hdf5 stack by copies of their
+    images, so that the stack does not need the single image files
+    anymore. Return the names of the materialized datasets"""
+    f = h5py.File(stack_filename, "r+")
+    virtual_datasets = []
+
+    def find_virtual_dataset(name, h5_object):
+        if isinstance(h5_object, h5py.Dataset) and h5_object.is_virtual:
+            virtual_datasets.append(name)
+
+    f.visititems(find_virtual_dataset)
+    for name in virtual_datasets:
+        virtual_dataset = f[name]
+        n_frames = virtual_dataset.shape[0]
+        materialized_name = name + "_materialized"
+        dataset = f.create_dataset(
+            materialized_name, shape=virtual_dataset.shape,
+            chunks=(1,) + virtual_dataset.shape[1:],
+            dtype=virtual_dataset.dtype)
+        for num_img in range(n_frames):
+            dataset[num_img] = virtual_dataset[num_img]
+        for attr_name, value in virtual_dataset.attrs.items():
+            dataset.attrs[attr_name] = value
+        del f[name]
+        f.move(materialized_name, name)
+    f.flush()
+    f.close()
+    return virtual_datasets
+
+
+def stack_record(files_for_stack, type_struct="normalized",
+                 suffix="_stack"):
+    """Filename and DataBase record of the stack of the given date,
+    sample (and energy, zpz or jj_offset, depending on the stack type)"""
     date = files_for_stack["date"]
     sample = files_for_stack["sample"]
     if type_struct != "normalized_spectroscopy":
@@ -255,14 +377,6 @@ def make_stack(files_for_stack, root_path, type_struct="normalized",
     elif type_struct == "normalized_magnetism_many_repetitions":
         jj_offset = files_for_stack["jj_offset"]
 
-    # Creation of dictionary
-    h5_struct_dict = create_structure_dict(type_struct=type_struct)
-    data_dict = metadata_2_stack_dict(h5_struct_dict,
-                                      files_for_stack,
-                                      ff_filenames=data_files_ff,
-                                      type_struct=type_struct)
-
-    # Creation of hdf5 stack
     record = {}
     if type_struct == "normalized":
         h5_out_fn = (str(date) + "_" + str(sample) + "_" +
@@ -288,36 +402,82 @@ def make_stack(files_for_stack, root_path, type_struct="normalized",
         h5_out_fn = (str(date) + "_" + str(sample) + "_" +
                      str(energy) + suffix + "_ali.hdf5")
         record.update({"energy": energy})
+    record.update({"filename": h5_out_fn, "extension": ".hdf5",
+                   "type": type_struct, "stack": True,
+                   "date": date, "sample": sample})
+    return h5_out_fn, record
+
+
+def make_stack(files_for_stack, root_path, type_struct="normalized",
+               suffix="_stack", virtual=False, readers=1, pool=None):
+
+    data_files = files_for_stack["data"]
+    if "ff" in files_for_stack:
+        data_files_ff = files_for_stack["ff"]
+    else:
+        data_files_ff = None
+
+    # Creation of dictionary
+    h5_struct_dict = create_structure_dict(type_struct=type_struct)
+    if virtual:
+        # Single pass: each image file is opened once
+        data_image_infos = [read_image_file(file) for file in data_files]
+        ff_image_infos = None
+        average_ff = None
+        if data_files_ff and type_struct == "normalized":
+            ff_image_infos = [read_image_file(ff_file, read_image=(c == 0))
+                              for c, ff_file in enumerate(data_files_ff)]
+            average_ff = ff_image_infos[0]["image"]
+        data_dict = metadata_rows_2_stack_dict(
+            h5_struct_dict,
+            [image_info["metadata"] for image_info in data_image_infos],
+            ff_metadata_rows=(
+                [image_info["metadata"] for image_info in ff_image_infos]
+                if ff_image_infos else None),
+            average_ff=average_ff, type_struct=type_struct,
+            jj_offset=files_for_stack.get("jj_offset"))
+    else:
+        data_dict = metadata_2_stack_dict(h5_struct_dict,
+                                          files_for_stack,
+                                          ff_filenames=data_files_ff,
+                                          type_struct=type_struct)
+
+    # Creation of hdf5 stack
+    h5_out_fn, record = stack_record(files_for_stack,
+                                     type_struct=type_struct, suffix=suffix)
     h5_out_fn = root_path + "/" + h5_out_fn
     h5_stack_file_handler = h5py.File(h5_out_fn, "w")
     dict2hdf5(h5_stack_file_handler, data_dict)
-    data_2_hdf5(h5_stack_file_handler,
-                data_files, ff_filenames=data_files_ff,
-                type_struct=type_struct)
+    if virtual:
+        virtual_data_2_hdf5(h5_stack_file_handler, root_path,
+                            data_image_infos, ff_image_infos=ff_image_infos,
+                            type_struct=type_struct)
+    else:
+        data_2_hdf5(h5_stack_file_handler,
+                    data_files, ff_filenames=data_files_ff,
+                    type_struct=type_struct, readers=readers, pool=pool)
 
     h5_stack_file_handler.flush()
     h5_stack_file_handler.close()
-
-    record.update({"filename": os.path.basename(h5_out_fn),
-                   "extension": ".hdf5",
-                   "type": type_struct, "stack": True,
-                   "date": date, "sample": sample})
     return record
 
 
 def many_images_to_h5_stack(file_index_fn, table_name="hdf5_proc",
                             type_struct="normalized", suffix="_stack",
                             date=None, sample=None, energy=None, zpz=None,
-                            ff=None, subfolders=False, cores=-2):
+                            ff=None, subfolders=False, cores=-2,
+                            virtual=False, executor=None):
     """Go from many images hdf5 files to a single stack of images
-    hdf5 file.
-    Using all cores but one, for the computations"""
+    hdf5 file. If virtual is True, the images of the stacks are virtual
+    datasets mapping the images of the single image files, which are
+    not copied.
+    Using all cores but one, for the computations (or the workers of the
+    executor, if given)"""
 
     # TODO: spectroscopy normalized not implemented (no Avg FF, etc)
     print("--- Individual images to stacks ---")
     start_time = time.time()
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -337,135 +497,70 @@ def many_images_to_h5_stack(file_index_fn, table_name="hdf5_proc",
     files_list = []
 
     if type_struct == "normalized" or type_struct == "aligned":
-        dates_samples_energies_zpzs = []
-        for record in all_file_records:
-            dates_samples_energies_zpzs.append((record["date"],
-                                                record["sample"],
-                                                record["energy"],
-                                                record["zpz"]))
-        dates_samples_energies_zpzs = list(set(dates_samples_energies_zpzs))
-        for date_sample_energy_zpz in dates_samples_energies_zpzs:
-            date = date_sample_energy_zpz[0]
-            sample = date_sample_energy_zpz[1]
-            energy = date_sample_energy_zpz[2]
-            zpz = date_sample_energy_zpz[3]
-
-            # Query building parts
-            da = (files_query.date == date)
-            sa = (files_query.sample == sample)
-            en = (files_query.energy == energy)
-            zp = (files_query.zpz == zpz)
-            ff_false = (files_query.FF == False)
-            ff_true = (files_query.FF == True)
-
-            data_files_ff = []
-            if file_index_db.search(files_query.FF.exists()):
-                # Query command
-                query_cmd_ff = (da & sa & en & ff_true)
-                h5_ff_records = file_index_db.search(query_cmd_ff)
-                data_files_ff = get_file_paths(h5_ff_records, root_path,
-                                               use_subfolders=subfolders)
-            if file_index_db.search(files_query.FF.exists()):
-                # Query command
-                query_cmd = (da & sa & en & zp & ff_false)
-            else:
-                # Query command
-                query_cmd = (da & sa & en & zp)
-            h5_records = file_index_db.search(query_cmd)
-            h5_records = sorted(h5_records, key=itemgetter('angle'))
-
-            data_files = get_file_paths(h5_records, root_path,
-                                        use_subfolders=subfolders)
-            files_dict = {"data": data_files, "ff": data_files_ff,
+        # The FF of a stack are the ones of its date, sample and energy
+        for group in group_records(all_file_records,
+                                   ("date", "sample", "energy", "zpz"),
+                                   ff_keys=("date", "sample", "energy"),
+                                   root_path=root_path,
+                                   use_subfolders=subfolders):
+            date, sample, energy, zpz = group.key
+            files_dict = {"data": group.files, "ff": group.ff_files,
                           "date": date, "sample": sample, "energy": energy,
                           "zpz": zpz}
             files_list.append(files_dict)
     elif (type_struct == "normalized_multifocus" or
           type_struct == "normalized_simple" or
           type_struct == "aligned_multifocus"):
-        dates_samples_energies = []
-        for record in all_file_records:
-            dates_samples_energies.append((record["date"],
-                                           record["sample"],
-                                           record["energy"]))
-        dates_samples_energies = list(set(dates_samples_energies))
-        for date_sample_energy in dates_samples_energies:
-            date = date_sample_energy[0]
-            sample = date_sample_energy[1]
-            energy = date_sample_energy[2]
-
-            # Query building parts
-            da = (files_query.date == date)
-            sa = (files_query.sample == sample)
-            en = (files_query.energy == energy)
-
-            # Query command
-            query_cmd = (da & sa & en)
-            h5_records = file_index_db.search(query_cmd)
-            h5_records = sorted(h5_records, key=itemgetter('angle'))
-
-            data_files = get_file_paths(h5_records, root_path,
-                                        use_subfolders=subfolders)
-            files_dict = {"data": data_files, "date": date, "sample": sample,
-                          "energy": energy}
+        for group in group_records(all_file_records,
+                                   ("date", "sample", "energy"),
+                                   split_ff=False, root_path=root_path,
+                                   use_subfolders=subfolders):
+            date, sample, energy = group.key
+            files_dict = {"data": group.files, "date": date,
+                          "sample": sample, "energy": energy}
             files_list.append(files_dict)
 
     elif type_struct == "normalized_magnetism_many_repetitions":
-        dates_samples_energies_jjs = []
-        for record in all_file_records:
-            dates_samples_energies_jjs.append((record["date"],
-                                               record["sample"],
-                                               record["energy"],
-                                               record["jj_offset"]))
-
-        dates_samples_energies_jjs = list(set(dates_samples_energies_jjs))
-        for date_sample_energy_jj in dates_samples_energies_jjs:
-            date = date_sample_energy_jj[0]
-            sample = date_sample_energy_jj[1]
-            energy = date_sample_energy_jj[2]
-            jj_offset = date_sample_energy_jj[3]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy) &
-                         (files_query.jj_offset == jj_offset))
-            h5_records = file_index_db.search(query_cmd)
-            h5_records = sorted(h5_records, key=itemgetter('angle'))
-            data_files = get_file_paths(h5_records, root_path,
-                                        use_subfolders=subfolders)
-            files_dict = {"data": data_files, "date": date, "sample": sample,
-                          "energy": energy, "jj_offset": jj_offset}
+        for group in group_records(all_file_records,
+                                   ("date", "sample", "energy", "jj_offset"),
+                                   split_ff=False, root_path=root_path,
+                                   use_subfolders=subfolders):
+            date, sample, energy, jj_offset = group.key
+            files_dict = {"data": group.files, "date": date,
+                          "sample": sample, "energy": energy,
+                          "jj_offset": jj_offset}
             files_list.append(files_dict)
     elif type_struct == "normalized_spectroscopy":
-        dates_samples = []
-        for record in all_file_records:
-            dates_samples.append((record["date"],
-                                  record["sample"]))
-        dates_samples = list(set(dates_samples))
-        for date_sample in dates_samples:
-            date = date_sample[0]
-            sample = date_sample[1]
-
-            # Query building parts
-            da = (files_query.date == date)
-            sa = (files_query.sample == sample)
-
-            # Query command
-            query_cmd = (da & sa)
-            h5_records = file_index_db.search(query_cmd)
-            h5_records = sorted(h5_records, key=itemgetter('energy'))
-
-            data_files = get_file_paths(h5_records, root_path,
-                                        use_subfolders=subfolders)
-            files_dict = {"data": data_files, "date": date, "sample": sample}
+        for group in group_records(all_file_records, ("date", "sample"),
+                                   sort_by="energy", split_ff=False,
+                                   root_path=root_path,
+                                   use_subfolders=subfolders):
+            date, sample = group.key
+            files_dict = {"data": group.files, "date": date,
+                          "sample": sample}
             files_list.append(files_dict)
 
-    # Parallelization of making the stacks
-    records = Parallel(n_jobs=cores, backend="multiprocessing")(
-        delayed(make_stack)(files_for_stack, root_path,
-                            type_struct=type_struct, suffix=suffix
-                            ) for files_for_stack in files_list)
+    if executor is not None:
+        cores = executor.cores
+    n_jobs = effective_n_jobs(cores)
+    if len(files_list) < n_jobs and not virtual:
+        # Fewer stacks than cores (usually a single tomography): the
+        # stacks are made one after the other, and the images of each
+        # stack are read in parallel, by a single pool of the kind of the
+        # executor
+        kind = "processes" if executor is None else executor.kind
+        with worker_pool(n_jobs, kind=kind) as pool:
+            records = [make_stack(files_for_stack, root_path,
+                                  type_struct=type_struct, suffix=suffix,
+                                  readers=n_jobs, pool=pool)
+                       for files_for_stack in files_list]
+    else:
+        # Parallelization of making the stacks
+        records = get_parallel(executor, cores)(
+            delayed(make_stack)(files_for_stack, root_path,
+                                type_struct=type_struct, suffix=suffix,
+                                virtual=virtual
+                                ) for files_for_stack in files_list)
 
     stack_table.insert_multiple(records)
     pretty_printer = pprint.PrettyPrinter(indent=4)
@@ -484,7 +579,7 @@ def main():
                  "PARALLEL_IMAGING/PARALLEL_XRM2H5/TOMOFEW/tomo_few_2/" \
                  "index.json"
 
-    db = TinyDB(file_index)
+    db = open_index(file_index)
     a = db.table("hdf5_proc")
     print(a.all())
 
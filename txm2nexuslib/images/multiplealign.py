@@ -23,27 +23,30 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import pprint
 import os
 import time
-from joblib import Parallel, delayed
-from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
-from tinydb.storages import MemoryStorage
+from joblib import delayed
+from tinydb import Query
 
 from util import create_subset_db
-from txm2nexuslib.parser import get_file_paths
+from txm2nexuslib.util import SharedArrays, get_parallel
+from txm2nexuslib.fileindex import open_index
 from txm2nexuslib.image.image_operate_lib import Image
-from txm2nexuslib.images.util import filter_file_index
+from txm2nexuslib.images.util import filter_file_index, group_records
 
 
 def align_and_store_from_fn(couple_imgs_to_align_filenames,
                             dataset_reference="data",
                             dataset_for_aligning="data",
                             align_method='cv2.TM_CCOEFF_NORMED',
-                            roi_size=0.5):
+                            roi_size=0.5, reference_image=None):
+    """Align the second image of the couple taking the first one as
+    reference. The reference image can be given as a SharedArray (read
+    by the main process), so it is not read by each worker"""
     image_ref_fn = couple_imgs_to_align_filenames[0]
     img_ref_obj = Image(h5_image_filename=image_ref_fn,
                         image_data_set=dataset_reference,
                         mode="r")
+    if reference_image is not None:
+        img_ref_obj.image = reference_image.array
 
     image_to_align_fn = couple_imgs_to_align_filenames[1]
     img_to_align_obj = Image(h5_image_filename=image_to_align_fn,
@@ -61,19 +64,22 @@ def align_images(file_index_fn, table_name="hdf5_proc",
                  roi_size=0.5, variable="zpz",
                  align_method='cv2.TM_CCOEFF_NORMED',
                  date=None, sample=None, energy=None, cores=-2,
-                 query=None, jj=True):
+                 query=None, jj=True, shared_memory=False,
+                 executor=None):
     """Align images of one experiment by zpz.
     If date, sample and/or energy are indicated, only the corresponding
     images for the given date, sample and/or energy are cropped.
     The crop of the different images will be done in parallel: all cores
     but one used (Value=-2). Each file, contains a single image to be cropped.
+    If shared_memory is True, each reference image is read once, and
+    handed to the worker processes in a shared memory block.
+    If an executor is given, its workers are used instead of cores.
     """
 
     start_time = time.time()
     root_path = os.path.dirname(os.path.abspath(file_index_fn))
 
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -90,38 +96,11 @@ def align_images(file_index_fn, table_name="hdf5_proc",
     n_files = len(file_records)
 
     couples_to_align = []
+    keys = None
     # The goal in this case is to align all the images for a same date,
     # sample, energy and angle, and a variable zpz.
     if variable == "zpz":
-        dates_samples_energies_angles = []
-        for record in file_records:
-            dates_samples_energies_angles.append((record["date"],
-                                                  record["sample"],
-                                                  record["energy"],
-                                                  record["angle"]))
-        dates_samples_energies_angles = list(
-            set(dates_samples_energies_angles))
-
-        for date_sample_energy_angle in dates_samples_energies_angles:
-            date = date_sample_energy_angle[0]
-            sample = date_sample_energy_angle[1]
-            energy = date_sample_energy_angle[2]
-            angle = date_sample_energy_angle[3]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy) &
-                         (files_query.angle == angle))
-            if query is not None:
-                query_cmd &= query
-            h5_records = file_index_db.search(query_cmd)
-
-            # pobj = pprint.PrettyPrinter(indent=4)
-            # print("group for align")
-            # for rec in h5_records:
-            #    pobj.pprint(rec["filename"])
-            _get_couples_to_align(couples_to_align, h5_records, root_path)
+        keys = ("date", "sample", "energy", "angle")
 
     # The goal in this case is to align all the images for a same date,
     # sample, jj_offset and angle, and a variable repetition.
@@ -130,68 +109,42 @@ def align_images(file_index_fn, table_name="hdf5_proc",
     # usually used in this kind of experiments, which allows to set the
     # two different circular polarizations (right and left)
     elif variable == "repetition" and jj:
-        dates_samples_energies_jjs_angles = []
-        for record in file_records:
-            dates_samples_energies_jjs_angles.append((record["date"],
-                                                      record["sample"],
-                                                      record["energy"],
-                                                      record["jj_u"],
-                                                      record["jj_d"],
-                                                      record["angle"]))
-        dates_samples_energies_jjs_angles = list(
-            set(dates_samples_energies_jjs_angles))
-
-        for date_sample_energy_jj_angle in dates_samples_energies_jjs_angles:
-            date = date_sample_energy_jj_angle[0]
-            sample = date_sample_energy_jj_angle[1]
-            energy = date_sample_energy_jj_angle[2]
-            jj_u = date_sample_energy_jj_angle[3]
-            jj_d = date_sample_energy_jj_angle[4]
-            angle = date_sample_energy_jj_angle[5]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy) &
-                         (files_query.jj_u == jj_u) &
-                         (files_query.jj_d == jj_d) &
-                         (files_query.angle == angle))
-            h5_records = file_index_db.search(query_cmd)
-
-            # pobj = pprint.PrettyPrinter(indent=4)
-            # print("group for align")
-            # for rec in h5_records:
-            #    pobj.pprint(rec["filename"])
-
-            _get_couples_to_align(couples_to_align, h5_records, root_path)
+        keys = ("date", "sample", "energy", "jj_u", "jj_d", "angle")
     elif variable == "repetition" and not jj:
-        dates_samples_energies = []
-        for record in file_records:
-            dates_samples_energies.append((record["date"],
-                                           record["sample"],
-                                           record["energy"]))
-        dates_samples_energies = list(
-            set(dates_samples_energies))
-
-        for date_sample_energy in dates_samples_energies:
-            date = date_sample_energy[0]
-            sample = date_sample_energy[1]
-            energy = date_sample_energy[2]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy))
-            h5_records = file_index_db.search(query_cmd)
+        keys = ("date", "sample", "energy")
 
+    # The first image of each group is the reference for the alignment
+    if keys is not None:
+        for group in group_records(file_records, keys, sort_by=None,
+                                   split_ff=False, root_path=root_path):
             # pobj = pprint.PrettyPrinter(indent=4)
             # print("group for align")
-            # for rec in h5_records:
+            # for rec in group.records:
             #    pobj.pprint(rec["filename"])
-            _get_couples_to_align(couples_to_align, h5_records, root_path)
-
-    if couples_to_align:
-        Parallel(n_jobs=cores, backend="multiprocessing")(
+            _get_couples_to_align(couples_to_align, group.files)
+
+    if couples_to_align and shared_memory:
+        with SharedArrays() as shared:
+            reference_images = {}
+            for image_ref_fn, _ in couples_to_align:
+                if image_ref_fn not in reference_images:
+                    img_ref_obj = Image(h5_image_filename=image_ref_fn,
+                                        image_data_set=dataset_reference,
+                                        mode="r")
+                    reference_images[image_ref_fn] = shared.share(
+                        img_ref_obj.image)
+                    img_ref_obj.close_h5()
+            get_parallel(executor, cores)(
+                delayed(align_and_store_from_fn)(
+                    couple_to_align,
+                    dataset_reference=dataset_reference,
+                    dataset_for_aligning=dataset_for_aligning,
+                    align_method=align_method,
+                    roi_size=roi_size,
+                    reference_image=reference_images[couple_to_align[0]])
+                for couple_to_align in couples_to_align)
+    elif couples_to_align:
+        get_parallel(executor, cores)(
             delayed(align_and_store_from_fn)(
                 couple_to_align,
                 dataset_reference=dataset_reference,
@@ -204,11 +157,9 @@ def align_images(file_index_fn, table_name="hdf5_proc",
     db.close()
 
 
-def _get_couples_to_align(couples_to_align, h5_records, root_path):
-    files = get_file_paths(h5_records, root_path)
+def _get_couples_to_align(couples_to_align, files):
     ref_file = files[0]
-    files.pop(0)
-    for file in files:
+    for file in files[1:]:
         couple_to_align = (ref_file, file)
         couples_to_align.append(couple_to_align)
 
@@ -23,15 +23,64 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import time
-from joblib import Parallel, delayed
-from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
+from joblib import delayed
+from tinydb import Query
 
+from txm2nexuslib.util import get_parallel
+from txm2nexuslib.fileindex import open_index
 from txm2nexuslib.image.image_operate_lib import Image
-from txm2nexuslib.parser import get_file_paths
 from txm2nexuslib.image.image_operate_lib import average_images
-from txm2nexuslib.images.util import filter_file_index
+from txm2nexuslib.images.util import filter_file_index, group_records
+
+
+# Metadata of the first averaged image stored in the average image file
+AVERAGE_METADATA = ("energy", "angle", "pixel_size", "magnification",
+                    "exposure_time", "machine_current")
+
+
+def zpz_average_record(date_sample_energy_angle, zp_central):
+    """Filename and DataBase record of the average of the images having
+    the same date, sample, energy and angle, and different zpz"""
+    date, sample, energy, angle = date_sample_energy_angle
+    output_fn = (str(date) + "_" + str(sample) + "_" + str(energy) +
+                 "_" + str(angle) + "_" +
+                 str(zp_central) + "_avg_zpz.hdf5")
+    record = {"filename": output_fn, "extension": ".hdf5",
+              "date": date, "sample": sample, "energy": energy,
+              "angle": angle, "average": True, "avg_by": "zpz",
+              "zpz": zp_central, "zpz_central": zp_central}
+    return output_fn, record
+
+
+def store_average_metadata(h5_avg, metadata):
+    """Store in the average image file the metadata (dictionary) of
+    the first averaged image"""
+    meta_out_grp = h5_avg.require_group("metadata")
+    if "energy" in metadata:
+        energy = round(metadata["energy"], 1)
+        meta_out_grp.create_dataset("energy", data=energy)
+        meta_out_grp["energy"].attrs["units"] = "eV"
+    if "angle" in metadata:
+        angle = round(metadata["angle"], 2)
+        if angle == 0:
+            angle = 0.0
+        meta_out_grp.create_dataset("angle", data=angle)
+        meta_out_grp["angle"].attrs["units"] = "degree"
+    if "pixel_size" in metadata:
+        meta_out_grp.create_dataset("pixel_size",
+                                    data=metadata["pixel_size"])
+        meta_out_grp["pixel_size"].attrs["units"] = "um"
+    if "magnification" in metadata:
+        meta_out_grp.create_dataset("magnification",
+                                    data=metadata["magnification"])
+    if "exposure_time" in metadata:
+        meta_out_grp.create_dataset("exposure_time",
+                                    data=metadata["exposure_time"])
+        meta_out_grp["exposure_time"].attrs["units"] = "s"
+    if "machine_current" in metadata:
+        meta_out_grp.create_dataset("machine_current",
+                                    data=metadata["machine_current"])
+        meta_out_grp["machine_current"].attrs["units"] = "mA"
 
 
 def average_and_store(group_to_average_image_filenames,
@@ -45,13 +94,8 @@ def average_and_store(group_to_average_image_filenames,
         date_sample_energy_angle = group_to_average_image_filenames[2]
         fn_first = images_to_average_filenames[0]
         dir_name = os.path.dirname(fn_first)
-        date = date_sample_energy_angle[0]
-        sample = date_sample_energy_angle[1]
-        energy = date_sample_energy_angle[2]
-        angle = date_sample_energy_angle[3]
-        output_fn = (str(date) + "_" + str(sample) + "_" + str(energy) +
-                     "_" + str(angle) + "_" +
-                     str(zp_central) + "_avg_zpz.hdf5")
+        output_fn, record = zpz_average_record(date_sample_energy_angle,
+                                               zp_central)
         output_complete_fn = dir_name + "/" + output_fn
         average_images(images_to_average_filenames,
                        dataset_for_average=dataset_for_averaging,
@@ -63,11 +107,6 @@ def average_and_store(group_to_average_image_filenames,
         # TODO: Do average of values of each group of images to be averaged
         # For the moment we take the first image ([0] index)
 
-        record = {"filename": output_fn, "extension": ".hdf5",
-                  "date": date, "sample": sample, "energy": energy,
-                  "angle": angle, "average": True, "avg_by": "zpz",
-                  "zpz": zp_central, "zpz_central": zp_central}
-
     elif variable == "repetition" and jj:
 
         num_repetitions = group_to_average_image_filenames[0]
@@ -134,40 +173,12 @@ def average_and_store(group_to_average_image_filenames,
     img_avg_obj = Image(output_complete_fn)
     h5_avg = img_avg_obj.f_h5_handler
 
-    metadata_in = "metadata"
-    metadata_out = "metadata"
-    if metadata_in in h5_in:
-        meta_in_grp = h5_in[metadata_in]
-        if metadata_out not in h5_avg:
-            meta_out_grp = h5_avg.create_group(metadata_out)
-        if "/metadata/energy" in h5_in:
-            energy = round(meta_in_grp["energy"].value, 1)
-            meta_out_grp.create_dataset("energy", data=energy)
-            meta_out_grp["energy"].attrs["units"] = "eV"
-        if "/metadata/angle" in h5_in:
-            angle = round(meta_in_grp["angle"].value, 2)
-            if angle == 0:
-                angle = 0.0
-            meta_out_grp.create_dataset("angle", data=angle)
-            meta_out_grp["angle"].attrs["units"] = "degree"
-        if "/metadata/pixel_size" in h5_in:
-            pixel_size = meta_in_grp["pixel_size"].value
-            meta_out_grp.create_dataset("pixel_size", data=pixel_size)
-            meta_out_grp["pixel_size"].attrs["units"] = "um"
-        if "/metadata/magnification" in h5_in:
-            magnification = meta_in_grp["magnification"].value
-            meta_out_grp.create_dataset("magnification",
-                                        data=magnification)
-        if "/metadata/exposure_time" in h5_in:
-            exposure_time = meta_in_grp["exposure_time"].value
-            meta_out_grp.create_dataset("exposure_time",
-                                        data=exposure_time)
-            meta_out_grp["exposure_time"].attrs["units"] = "s"
-        if "/metadata/machine_current" in h5_in:
-            machine_current = meta_in_grp["machine_current"].value
-            meta_out_grp.create_dataset("machine_current",
-                                        data=machine_current)
-            meta_out_grp["machine_current"].attrs["units"] = "mA"
+    if "metadata" in h5_in:
+        meta_in_grp = h5_in["metadata"]
+        metadata = dict([(name, meta_in_grp[name].value)
+                         for name in AVERAGE_METADATA
+                         if name in meta_in_grp])
+        store_average_metadata(h5_avg, metadata)
 
     h5_in.close()
     img_avg_obj.close_h5()
@@ -190,8 +201,7 @@ def average_image_group_by_energy(file_index_fn, table_name="hdf5_proc",
 
     root_path = os.path.dirname(os.path.abspath(file_index_fn))
 
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -206,34 +216,15 @@ def average_image_group_by_energy(file_index_fn, table_name="hdf5_proc",
 
     # We only have files for a single energy
     if variable == "repetition":
-        dates_samples_energies = []
-        for record in all_file_records:
-            dates_samples_energies.append((record["date"],
-                                           record["sample"],
-                                           record["energy"]))
-        dates_samples_energies = list(
-            set(dates_samples_energies))
-
-        for date_sample_energy in dates_samples_energies:
-            date = date_sample_energy[0]
-            sample = date_sample_energy[1]
-            energy = date_sample_energy[2]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy))
-            img_records = file_index_db.search(query_cmd)
-
-            num_repetitions = len(img_records)
-            files = get_file_paths(img_records, root_path)
+        # Raw image records by given date, sample and energy
+        for group in group_records(all_file_records,
+                                   ("date", "sample", "energy"),
+                                   sort_by=None, split_ff=False,
+                                   root_path=root_path):
+            num_repetitions = len(group.records)
             complete_group_to_average = [num_repetitions]
-            group_to_average = []
-            for file in files:
-                group_to_average.append(file)
-            complete_group_to_average.append(group_to_average)
-            complete_group_to_average.append(
-                date_sample_energy)
+            complete_group_to_average.append(group.files)
+            complete_group_to_average.append(group.key)
 
             record = average_and_store(
                 complete_group_to_average,
@@ -267,8 +258,7 @@ def average_image_group_by_angle(file_index_fn, table_name="hdf5_proc",
 
     root_path = os.path.dirname(os.path.abspath(file_index_fn))
 
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -283,43 +273,16 @@ def average_image_group_by_angle(file_index_fn, table_name="hdf5_proc",
 
     # We only have files for a single angle
     if variable == "repetition":
-        dates_samples_energies_jjs_angles = []
-        for record in all_file_records:
-            dates_samples_energies_jjs_angles.append((record["date"],
-                                                      record["sample"],
-                                                      record["energy"],
-                                                      record["jj_u"],
-                                                      record["jj_d"],
-                                                      record["angle"]))
-        dates_samples_energies_jjs_angles = list(
-            set(dates_samples_energies_jjs_angles))
-
-        for date_sample_energy_jj_angle in dates_samples_energies_jjs_angles:
-            date = date_sample_energy_jj_angle[0]
-            sample = date_sample_energy_jj_angle[1]
-            energy = date_sample_energy_jj_angle[2]
-            jj_u = date_sample_energy_jj_angle[3]
-            jj_d = date_sample_energy_jj_angle[4]
-            angle = date_sample_energy_jj_angle[5]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy) &
-                         (files_query.jj_u == jj_u) &
-                         (files_query.jj_d == jj_d) &
-                         (files_query.angle == angle))
-            img_records = file_index_db.search(query_cmd)
-
-            num_repetitions = len(img_records)
-            files = get_file_paths(img_records, root_path)
+        # Raw image records by given date, sample, energy, jj's and angle
+        for group in group_records(all_file_records,
+                                   ("date", "sample", "energy",
+                                    "jj_u", "jj_d", "angle"),
+                                   sort_by=None, split_ff=False,
+                                   root_path=root_path):
+            num_repetitions = len(group.records)
             complete_group_to_average = [num_repetitions]
-            group_to_average = []
-            for file in files:
-                group_to_average.append(file)
-            complete_group_to_average.append(group_to_average)
-            complete_group_to_average.append(
-                date_sample_energy_jj_angle)
+            complete_group_to_average.append(group.files)
+            complete_group_to_average.append(group.key)
 
             record = average_and_store(
                 complete_group_to_average,
@@ -342,13 +305,14 @@ def average_image_groups(file_index_fn, table_name="hdf5_proc",
                          dataset_for_averaging="data", variable="zpz",
                          description="", dataset_store="data",
                          date=None, sample=None, energy=None, cores=-2,
-                         jj=True):
+                         jj=True, executor=None):
     """Average images of one experiment by zpz.
     If date, sample and/or energy are indicated, only the corresponding
     images for the given date, sample and/or energy are processed.
     The average of the different groups of images will be done in parallel:
     all cores but one used (Value=-2). All data images of the same angle,
     for the different ZPz are averaged.
+    If an executor is given, its workers are used instead of cores.
     """
 
     """
@@ -366,8 +330,7 @@ def average_image_groups(file_index_fn, table_name="hdf5_proc",
     start_time = time.time()
     root_path = os.path.dirname(os.path.abspath(file_index_fn))
 
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -385,111 +348,39 @@ def average_image_groups(file_index_fn, table_name="hdf5_proc",
 
     groups_to_average = []
     if variable == "zpz":
-        dates_samples_energies_angles = []
-        for record in all_file_records:
-            dates_samples_energies_angles.append((record["date"],
-                                                  record["sample"],
-                                                  record["energy"],
-                                                  record["angle"]))
-        dates_samples_energies_angles = list(
-            set(dates_samples_energies_angles))
-        for date_sample_energy_angle in dates_samples_energies_angles:
-            date = date_sample_energy_angle[0]
-            sample = date_sample_energy_angle[1]
-            energy = date_sample_energy_angle[2]
-            angle = date_sample_energy_angle[3]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy) &
-                         (files_query.angle == angle))
-            img_records = file_index_db.search(query_cmd)
-            num_zpz = len(img_records)
+        # Raw image records by given date, sample, energy and angle
+        for group in group_records(all_file_records,
+                                   ("date", "sample", "energy", "angle"),
+                                   sort_by=None, split_ff=False,
+                                   root_path=root_path):
+            num_zpz = len(group.records)
             central_zpz = 0
-            for img_record in img_records:
+            for img_record in group.records:
                 central_zpz += img_record["zpz"]
             central_zpz /= round(float(num_zpz), 1)
 
-            files = get_file_paths(img_records, root_path)
             central_zpz_with_group_to_average = [central_zpz]
-            group_to_average = []
-            for file in files:
-                group_to_average.append(file)
-            central_zpz_with_group_to_average.append(group_to_average)
-            central_zpz_with_group_to_average.append(date_sample_energy_angle)
+            central_zpz_with_group_to_average.append(group.files)
+            central_zpz_with_group_to_average.append(group.key)
             groups_to_average.append(central_zpz_with_group_to_average)
 
-    elif variable == "repetition" and jj:
-        dates_samples_energies_jjs_angles = []
-        for record in all_file_records:
-            dates_samples_energies_jjs_angles.append((record["date"],
-                                                      record["sample"],
-                                                      record["energy"],
-                                                      record["jj_u"],
-                                                      record["jj_d"],
-                                                      record["angle"]))
-        dates_samples_energies_jjs_angles = list(
-            set(dates_samples_energies_jjs_angles))
-
-        for date_sample_energy_jj_angle in dates_samples_energies_jjs_angles:
-            date = date_sample_energy_jj_angle[0]
-            sample = date_sample_energy_jj_angle[1]
-            energy = date_sample_energy_jj_angle[2]
-            jj_u = date_sample_energy_jj_angle[3]
-            jj_d = date_sample_energy_jj_angle[4]
-            angle = date_sample_energy_jj_angle[5]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy) &
-                         (files_query.jj_u == jj_u) &
-                         (files_query.jj_d == jj_d) &
-                         (files_query.angle == angle))
-            img_records = file_index_db.search(query_cmd)
-            num_repetitions = len(img_records)
-            files = get_file_paths(img_records, root_path)
-            complete_group_to_average = [num_repetitions]
-            group_to_average = []
-            for file in files:
-                group_to_average.append(file)
-            complete_group_to_average.append(group_to_average)
-            complete_group_to_average.append(
-                date_sample_energy_jj_angle)
-            groups_to_average.append(complete_group_to_average)
-
-    elif variable == "repetition" and not jj:
-        dates_samples_energies = []
-        for record in all_file_records:
-            dates_samples_energies.append((record["date"],
-                                           record["sample"],
-                                           record["energy"]))
-        dates_samples_energies = list(
-            set(dates_samples_energies))
-
-        for date_sample_energy in dates_samples_energies:
-            date = date_sample_energy[0]
-            sample = date_sample_energy[1]
-            energy = date_sample_energy[2]
-
-            # Raw image records by given date, sample and energy
-            query_cmd = ((files_query.date == date) &
-                         (files_query.sample == sample) &
-                         (files_query.energy == energy))
-            img_records = file_index_db.search(query_cmd)
-            num_repetitions = len(img_records)
-            files = get_file_paths(img_records, root_path)
+    elif variable == "repetition":
+        if jj:
+            keys = ("date", "sample", "energy", "jj_u", "jj_d", "angle")
+        else:
+            keys = ("date", "sample", "energy")
+        # Raw image records by given date, sample and energy
+        # (and jj's and angle)
+        for group in group_records(all_file_records, keys, sort_by=None,
+                                   split_ff=False, root_path=root_path):
+            num_repetitions = len(group.records)
             complete_group_to_average = [num_repetitions]
-            group_to_average = []
-            for file in files:
-                group_to_average.append(file)
-            complete_group_to_average.append(group_to_average)
-            complete_group_to_average.append(date_sample_energy)
+            complete_group_to_average.append(group.files)
+            complete_group_to_average.append(group.key)
             groups_to_average.append(complete_group_to_average)
 
     if groups_to_average[0][1]:
-        records = Parallel(n_jobs=cores, backend="multiprocessing")(
+        records = get_parallel(executor, cores)(
             delayed(average_and_store)(
                 group_to_average,
                 dataset_for_averaging=dataset_for_averaging,
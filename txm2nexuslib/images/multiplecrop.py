@@ -23,13 +23,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import time
-from joblib import Parallel, delayed
+from joblib import delayed
 from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
 from tinydb.storages import MemoryStorage
 
 from util import create_subset_db
+from txm2nexuslib.util import get_parallel
+from txm2nexuslib.fileindex import open_index
 from txm2nexuslib.parser import get_file_paths
 from txm2nexuslib.image.image_operate_lib import Image
 
@@ -65,16 +65,18 @@ def filter_file_index(file_index_db, date=None, sample=None, energy=None,
 
 def crop_images(file_index_fn, table_name="hdf5_proc", dataset="data",
                 roi={"top": 26, "bottom": 24, "left": 21, "right": 19},
-                date=None, sample=None, energy=None, cores=-2, query=None):
+                date=None, sample=None, energy=None, cores=-2, query=None,
+                executor=None):
     """Crop images of one experiment.
     If date, sample and/or energy are indicated, only the corresponding
     images for the given date, sample and/or energy are cropped.
     The crop of the different images will be done in parallel: all cores
     but one used (Value=-2). Each file, contains a single image to be cropped.
+    Only the pixels inside the roi are read from the hdf5 files.
+    If an executor is given, its workers are used instead of cores.
     """
     start_time = time.time()
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -91,7 +93,7 @@ def crop_images(file_index_fn, table_name="hdf5_proc", dataset="data",
         file_records = file_index_db.all()
     files = get_file_paths(file_records, root_path)
     if files:
-        Parallel(n_jobs=cores, backend="multiprocessing")(
+        get_parallel(executor, cores)(
             delayed(crop_and_store)(h5_file, dataset=dataset,
                                     roi=roi) for h5_file in files)
     n_files = len(files)
@@ -22,25 +22,41 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import time
-from joblib import Parallel, delayed
+from joblib import delayed
 from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
 from tinydb.storages import MemoryStorage
 
-from util import create_subset_db
-from txm2nexuslib.parser import get_file_paths
+from util import create_subset_db, group_records
+from txm2nexuslib.util import SharedArray, SharedArrays, get_parallel
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.images.ffcache import get_ff_cache
 from txm2nexuslib.image.image_operate_lib import (normalize_image,
                                                   get_normalized_ff,
                                                   normalize_ff)
 
 
+def normalize_and_store(h5_file, ff_norm_image):
+    """Normalize an image by the averaged FF image (which can be given
+    as a SharedArray), storing the normalized image"""
+    if isinstance(ff_norm_image, SharedArray):
+        ff_norm_image = ff_norm_image.array
+    # The images are not returned to not send them back to the main process
+    normalize_image(h5_file, average_normalized_ff_img=ff_norm_image)
+
+
 def average_ff(file_index_fn, table_name="hdf5_proc",
                      date=None, sample=None, energy=None,
-                     cores=-2, query=None, jj=False):
+                     cores=-2, query=None, jj=False, cache_ff=True,
+                     executor=None):
+    """Average the FF images of each group (date, sample, energy and
+    jj's), each FF image being normalized beforehand by its exposure time
+    and machine current. If query is given, only the FF records matching
+    it are averaged. The groups are averaged in parallel. If cache_ff is
+    True, the averaged FF are kept in the FF cache of the files index, and
+    not computed again while the FF files are unchanged.
+    If an executor is given, its workers are used instead of cores."""
     start_time = time.time()
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -63,62 +79,58 @@ def average_ff(file_index_fn, table_name="hdf5_proc",
 
     root_path = os.path.dirname(os.path.abspath(file_index_fn))
 
-    file_records = file_index_db.all()
-
-    dates_samples_energies = []
-    for record in file_records:
-        data = (record["date"],
-                record["sample"],
-                record["energy"])
-        if jj is True:
-            data += (record["jj_u"],
-                     record["jj_d"]
-                     )
-        dates_samples_energies.append(data)
-
-    dates_samples_energies = list(set(dates_samples_energies))
-    num_files_total = 0
-    for date_sample_energy in dates_samples_energies:
-        date = date_sample_energy[0]
-        sample = date_sample_energy[1]
-        energy = date_sample_energy[2]
-
-       # FF records by given date, sample and energy
+    keys = ["date", "sample", "energy"]
+    if jj is True:
+        keys += ["jj_u", "jj_d"]
+
+    ff_query = (files_query.FF == True)
+    if query is not None:
+        ff_query &= query
+
+    # FF records by given date, sample and energy (and jj's)
+    ff_cache = get_ff_cache(file_index_fn) if cache_ff else None
+    groups = [group for group in
+              group_records(file_index_db, keys, sort_by=None,
+                            split_ff=False, query=ff_query,
+                            root_path=root_path)
+              if ff_cache is None or
+              ff_cache.get(group.key, group.files) is None]
+    ff_images = get_parallel(executor, cores)(
+        delayed(normalize_ff)(group.files) for group in groups)
+    if ff_cache is not None:
+        for group, ff_image in zip(groups, ff_images):
+            ff_cache.put(group.key, group.files, ff_image)
+
+    print("--- Average the FF of %d groups took %s seconds ---\n" %
+          (len(groups), (time.time() - start_time)))
 
-        query_cmd_ff = ((files_query.date == date) &
-                        (files_query.sample == sample) &
-                        (files_query.energy == energy) &
-                        (files_query.FF == True)
-                        )
-
-        if jj is True:
-            jj_u = date_sample_energy[3]
-            jj_d = date_sample_energy[4]
-            query_cmd_ff &= ((files_query.jj_u == jj_u) &
-                             (files_query.jj_d == jj_d))
-
-        h5_ff_records = file_index_db.search(query_cmd_ff)
-        files_ff = get_file_paths(h5_ff_records, root_path)
-        normalize_ff(files_ff)
+    db.close()
 
 
 def normalize_images(file_index_fn, table_name="hdf5_proc",
                      date=None, sample=None, energy=None,
                      average_ff=True, cores=-2, query=None, jj=False,
-                     read_norm_ff=False):
+                     read_norm_ff=False, cache_ff=True,
+                     shared_memory=False, executor=None):
     """Normalize images of one experiment.
     If date, sample and/or energy are indicated, only the corresponding
     images for the given date, sample and/or energy are normalized.
     The normalization of different images will be done in parallel. Each
     file, contains a single image to be normalized.
+    If cache_ff is True, the averaged FF of each group is taken from the
+    FF cache of the files index when the FF files are unchanged, so it is
+    computed only once, even if the images of the group are normalized
+    in several calls.
+    If shared_memory is True, the averaged FF is handed to the worker
+    processes in a shared memory block, instead of being serialized.
+    If an executor is given, its workers are used instead of cores.
     .. todo: This method should be divided in two. One should calculate
      the average FF, and the other (normalize_images), should receive
      as input argument, the averaged FF image (or the single FF image).
     """
 
     start_time = time.time()
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
     db = file_index_db
     if table_name is not None:
         file_index_db = file_index_db.table(table_name)
@@ -143,64 +155,21 @@ def normalize_images(file_index_fn, table_name="hdf5_proc",
 
     root_path = os.path.dirname(os.path.abspath(file_index_fn))
 
+    keys = ["date", "sample", "energy"]
+    if jj is True:
+        keys += ["jj_u", "jj_d"]
 
-    file_records = file_index_db.all()
-    #print(file_records)
-
-    dates_samples_energies = []
-    for record in file_records:
-        data = (record["date"],
-                record["sample"],
-                record["energy"])
-        if jj is True:
-            data += (record["jj_u"],
-                     record["jj_d"]
-                                       )
-        dates_samples_energies.append(data)
-
-    dates_samples_energies = list(set(dates_samples_energies))
+    ff_cache = get_ff_cache(file_index_fn) if cache_ff else None
     num_files_total = 0
-    for date_sample_energy in dates_samples_energies:
-        date = date_sample_energy[0]
-        sample = date_sample_energy[1]
-        energy = date_sample_energy[2]
-
-        # Raw image records by given date, sample and energy
-        query_cmd = ((files_query.date == date) &
-                     (files_query.sample == sample) &
-                     (files_query.energy == energy) &
-                     (files_query.FF == False))
-        if jj is True:
-            jj_u = date_sample_energy[3]
-            jj_d = date_sample_energy[4]
-            query_cmd &= ((files_query.jj_u == jj_u) &
-                          (files_query.jj_d == jj_d))
-
-        if query is not None:
-            query_cmd &= query
-
-        h5_records = file_index_db.search(query_cmd)
-        # FF records by given date, sample and energy
-        
-        query_cmd_ff = ((files_query.date == date) &
-                        (files_query.sample == sample) &
-                        (files_query.energy == energy) &
-                        (files_query.FF == True)
-                        )
-
-        if jj is True:
-            jj_u = date_sample_energy[3]
-            jj_d = date_sample_energy[4]
-            query_cmd_ff &= ((files_query.jj_u == jj_u) &
-                             (files_query.jj_d == jj_d))
-
-
-        h5_ff_records = file_index_db.search(query_cmd_ff)
-        files = get_file_paths(h5_records, root_path)
+    # Raw image records and FF records by given date, sample and energy
+    # (and jj's)
+    for group in group_records(file_index_db, keys, sort_by=None,
+                               query=query, root_path=root_path):
+        files = group.files
         #print(files)
         n_files = len(files)
         num_files_total += n_files
-        files_ff = get_file_paths(h5_ff_records, root_path)
+        files_ff = group.ff_files
 
         if not files_ff:
             msg = "FlatFields are not present, images cannot be normalized"
@@ -216,9 +185,12 @@ def normalize_images(file_index_fn, table_name="hdf5_proc",
             # Average the FF files and use always the same average (for a
             # same date, sample, energy and jj's)
             # Normally the case of magnetism
-            if read_norm_ff is True:
+            ff_norm_image = None
+            if ff_cache is not None:
+                ff_norm_image = ff_cache.get(group.key, files_ff)
+            if ff_norm_image is None and read_norm_ff is True:
                 ff_norm_image = get_normalized_ff(files_ff)
-            else:
+            elif ff_norm_image is None:
                 #print("---files ff")
                 #print(files_ff)
                 #print("---files")
@@ -226,11 +198,18 @@ def normalize_images(file_index_fn, table_name="hdf5_proc",
                 _, ff_norm_image = normalize_image(files[0],
                                                    ff_img_filenames=files_ff)
                 files.pop(0)
-            if len(files):
-                Parallel(n_jobs=cores, backend="multiprocessing")(
-                    delayed(normalize_image)(
-                        h5_file, average_normalized_ff_img=ff_norm_image
-                    ) for h5_file in files)
+                if ff_cache is not None:
+                    ff_cache.put(group.key, files_ff, ff_norm_image)
+            if len(files) and shared_memory:
+                with SharedArrays() as shared:
+                    shared_ff = shared.share(ff_norm_image)
+                    get_parallel(executor, cores)(
+                        delayed(normalize_and_store)(h5_file, shared_ff)
+                        for h5_file in files)
+            elif len(files):
+                get_parallel(executor, cores)(
+                    delayed(normalize_and_store)(h5_file, ff_norm_image)
+                    for h5_file in files)
         else:
             # Same number of FF as sample data files
             # Normalize each single sample data image for a single FF image
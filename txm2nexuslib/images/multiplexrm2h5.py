@@ -23,28 +23,36 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import time
 
-from joblib import Parallel, delayed
-from tinydb import TinyDB
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
+from joblib import delayed
 
+from txm2nexuslib.util import get_parallel
+from txm2nexuslib.fileindex import open_index
 from txm2nexuslib.parser import get_db, get_file_paths
 from txm2nexuslib.image.xrm2hdf5 import Xrm2H5Converter
 from txm2nexuslib.images import util
 
 
 
-def convert_xrm2h5(xrm_file):
-    xrm2h5_converter = Xrm2H5Converter(xrm_file)
+def convert_xrm2h5(xrm_file, roi=None):
+    xrm2h5_converter = Xrm2H5Converter(xrm_file, roi=roi)
     xrm2h5_converter.convert_xrm_to_h5_file()
 
 
 def multiple_xrm_2_hdf5(file_index_db, subfolders=False, cores=-2,
-                        update_db=True, query=None):
-    """Using all cores but one for the computations"""
+                        update_db=True, query=None, roi=None,
+                        executor=None, purge=True):
+    """Using all cores but one for the computations.
+    If a roi is given (as for crop_images), the image borders are
+    dropped while the xrm images are decoded: the raw hdf5 images are
+    already cropped, and no crop step is needed afterwards.
+    If an executor is given, its workers are used instead of cores.
+    If update_db is True, the converted records are flagged as processed
+    and added to the hdf5_raw table, which is emptied before if purge is
+    True; otherwise the records already in it are replaced. The records
+    whose xrm file is not found (not written yet) are left unprocessed."""
 
     start_time = time.time()
-    db = TinyDB(file_index_db, storage=CachingMiddleware(JSONStorage))
+    db = open_index(file_index_db)
 
     if query is not None:
         file_records = db.search(query)
@@ -57,13 +65,18 @@ def multiple_xrm_2_hdf5(file_index_db, subfolders=False, cores=-2,
     root_path = os.path.dirname(os.path.abspath(file_index_db))
     files = get_file_paths(file_records, root_path,
                            use_subfolders=subfolders)
+    found_filenames = set([os.path.basename(path) for path in files])
+    file_records = [record for record in file_records
+                    if record["filename"] in found_filenames]
 
     # The backend parameter can be either "threading" or "multiprocessing".
-    Parallel(n_jobs=cores, backend="multiprocessing")(
-        delayed(convert_xrm2h5)(xrm_file) for xrm_file in files)
+    get_parallel(executor, cores)(
+        delayed(convert_xrm2h5)(xrm_file, roi=roi) for xrm_file in files)
 
     if update_db:
-        util.update_db_func(db, "hdf5_raw", file_records)
+        util.update_db_func(db, "hdf5_raw", file_records, purge=purge)
+        db.update({'processed': True},
+                  doc_ids=[record.doc_id for record in file_records])
     db.close()
 
     n_files = len(files)
@@ -23,19 +23,83 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import time
+from collections import namedtuple
 
 import h5py
-from shutil import copy
+from shutil import copyfile
 
 from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
 from tinydb.storages import MemoryStorage
-from tinydb.middlewares import CachingMiddleware
-from joblib import Parallel, delayed
+from joblib import delayed
 
+from txm2nexuslib.util import get_parallel
+from txm2nexuslib.fileindex import open_index
 from txm2nexuslib.parser import get_file_paths
 
 
+RecordGroup = namedtuple("RecordGroup",
+                         ["key", "records", "files", "ff_records", "ff_files"])
+
+
+def _group_table(table, keys, split_ff, ff_keys, query):
+    """Group the records of an SQLite files index table as group_records
+    does, returning the groups and the FF groups dictionaries"""
+    ff_groups = {}
+    if split_ff:
+        ff_query = Query().FF == True
+        ff_groups = dict(table.group_by(ff_keys, ff_query))
+        query = ~ff_query if query is None else ~ff_query & query
+    return dict(table.group_by(keys, query)), ff_groups
+
+
+def group_records(records, keys, sort_by='angle', split_ff=True,
+                  ff_keys=None, query=None, root_path=None,
+                  use_subfolders=True):
+    """Group the records having the same values of keys, in a single pass.
+
+    Yield a RecordGroup for each group, ordered by the values of keys (the
+    group key). The records of each group are sorted by sort_by (if not
+    None; otherwise they keep their input order). If split_ff is True, the
+    FF records are not grouped with the data records: the FF records having
+    the same values of ff_keys (a subset of keys, by default keys) than the
+    group are given
+    in ff_records. If query is given, only the data records matching it are
+    grouped. If root_path is given, the file paths of the records are
+    resolved (files and ff_files); otherwise they are None.
+    records can also be a table of the files index: the tables of an
+    SQLite files index group their records with indexed queries.
+    """
+    keys = tuple(keys)
+    ff_keys = keys if ff_keys is None else tuple(ff_keys)
+    if hasattr(records, "group_by"):
+        groups, ff_groups = _group_table(records, keys, split_ff, ff_keys,
+                                         query)
+    else:
+        groups = {}
+        ff_groups = {}
+        for record in records:
+            if split_ff and record.get("FF") is True:
+                ff_key = tuple(record.get(key) for key in ff_keys)
+                ff_groups.setdefault(ff_key, []).append(record)
+            elif query is None or query(record):
+                group_key = tuple(record.get(key) for key in keys)
+                groups.setdefault(group_key, []).append(record)
+
+    for group_key in sorted(groups):
+        group = groups[group_key]
+        if sort_by is not None:
+            group = sorted(group, key=lambda record: record.get(sort_by))
+        values = dict(zip(keys, group_key))
+        ff_group = ff_groups.get(tuple(values[key] for key in ff_keys), [])
+        files = ff_files = None
+        if root_path is not None:
+            files = get_file_paths(group, root_path,
+                                   use_subfolders=use_subfolders)
+            ff_files = get_file_paths(ff_group, root_path,
+                                      use_subfolders=use_subfolders)
+        yield RecordGroup(group_key, group, files, ff_group, ff_files)
+
+
 def filter_file_index(file_index_db, files_query,
                       date=None, sample=None, energy=None, angle=None,
                       zpz=None, ff=None):
@@ -85,10 +149,8 @@ def create_subset_db(file_index_fn, subset_file_index_fn,
     directory = os.path.dirname(file_index_fn) + "/"
     subset_file_index_fn = directory + subset_file_index_fn
 
-    file_index_db = TinyDB(file_index_fn,
-                           storage=CachingMiddleware(JSONStorage))
-    subset_file_index_db = TinyDB(subset_file_index_fn,
-                                  storage=CachingMiddleware(JSONStorage))
+    file_index_db = open_index(file_index_fn)
+    subset_file_index_db = open_index(subset_file_index_fn)
     subset_file_index_db.purge()
     files = Query()
 
@@ -103,11 +165,47 @@ def create_subset_db(file_index_fn, subset_file_index_fn,
     return subset_file_index_db
 
 
-def copy_2_proc(filename, suffix):
-    """Copy a raw file into another file which can be used  processed file"""
+def link_raw_data(raw_filename, proc_filename):
+    """Create a file for processing which does not copy the raw image:
+    its dataset data_1 is a virtual dataset mapping the dataset data_1 of
+    the raw file (referenced by its relative path, as both files are in
+    the same folder), and data is a SoftLink to data_1. The metadata group,
+    which is small, is copied. The new datasets are written in the file
+    for processing: the raw file is never modified, but it has to be kept,
+    and to be writable (HDF5 opens the sources of a virtual dataset with
+    the access mode of the file containing it)."""
+    raw_basename = os.path.basename(raw_filename)
+    with h5py.File(raw_filename, 'r') as f_raw:
+        with h5py.File(proc_filename, 'w') as f_proc:
+            raw_dataset = f_raw["data_1"]
+            layout = h5py.VirtualLayout(shape=raw_dataset.shape,
+                                        dtype=raw_dataset.dtype)
+            layout[...] = h5py.VirtualSource(raw_basename, "data_1",
+                                             shape=raw_dataset.shape)
+            f_proc.create_virtual_dataset("data_1", layout)
+            for name, value in raw_dataset.attrs.items():
+                f_proc["data_1"].attrs[name] = value
+            if "metadata" in f_raw:
+                f_raw.copy("metadata", f_proc)
+            f_proc["data"] = h5py.SoftLink("data_1")
+
+
+def copy_2_proc(filename, suffix, copy_free=False):
+    """Copy a raw file into another file which can be used  processed file.
+    If copy_free is True, the raw image is not copied but mapped by the
+    new file (see link_raw_data). A raw file which is not writable is
+    copied anyway: the processed file could not read its image when
+    opened for writing. The permissions of the raw file are not copied,
+    so that the processed file is always writable."""
     base, extension = os.path.splitext(filename)
     filename_processed = base + suffix + extension
-    copy(filename, filename_processed)
+    if copy_free and not os.access(filename, os.W_OK):
+        print("%s is not writable: it is copied for processing" % filename)
+        copy_free = False
+    if copy_free:
+        link_raw_data(filename, filename_processed)
+    else:
+        copyfile(filename, filename_processed)
 
 
 def update_db_func(files_db, table_name, files_records, suffix=None, purge=True):
@@ -115,7 +213,9 @@ def update_db_func(files_db, table_name, files_records, suffix=None, purge=True)
     extension to hdf5), or with records of processed files (adding a suffix).
     If suffix is not given (suffix None), the new DB will contain the same
     file names as the original DB but with .hdf5 extension; otherwise,
-    a suffix is added to the already hdf5 filenames."""
+    a suffix is added to the already hdf5 filenames.
+    If purge is False, the records are added to the table, replacing the
+    ones having the same file name."""
     table = files_db.table(table_name)
     if purge is True:
         table.purge()
@@ -131,6 +231,9 @@ def update_db_func(files_db, table_name, files_records, suffix=None, purge=True)
             record.update({'processed': True})
         record.update({'filename': filename})
         records.append(record)
+    if purge is not True and records:
+        filenames = [record['filename'] for record in records]
+        table.remove(Query().filename.one_of(filenames))
     table.insert_multiple(records)
 
 
@@ -138,13 +241,16 @@ def copy2proc_multiple(file_index_db, table_in_name="hdf5_raw",
                        table_out_name="hdf5_proc", suffix="_proc",
                        use_subfolders=False, cores=-1, update_db=True,
                        query=None, purge=False,
-                       magnetism_partial=False):
-    """Copy many files to processed files"""
+                       magnetism_partial=False, copy_free=False,
+                       executor=None):
+    """Copy many files to processed files. If copy_free is True, the
+    processed files map the raw images instead of copying them.
+    If an executor is given, its workers are used instead of cores"""
     # printer = pprint.PrettyPrinter(indent=4)
 
     start_time = time.time()
 
-    db = TinyDB(file_index_db, storage=CachingMiddleware(JSONStorage))
+    db = open_index(file_index_db)
 
     files_query = Query()
     if table_in_name == "default":
@@ -154,7 +260,10 @@ def copy2proc_multiple(file_index_db, table_in_name="hdf5_raw",
         hdf5_records = db.search(query_cmd)
     else:
         table_in = db.table(table_in_name)
-        hdf5_records = table_in.all()
+        if query is not None:
+            hdf5_records = table_in.search(query)
+        else:
+            hdf5_records = table_in.all()
 
     if magnetism_partial:
         query_cmd = (files_query.extension == ".hdf5")
@@ -173,15 +282,17 @@ def copy2proc_multiple(file_index_db, table_in_name="hdf5_raw",
 
     # The backend parameter can be either "threading" or "multiprocessing"
 
-    Parallel(n_jobs=cores, backend="multiprocessing")(
-        delayed(copy_2_proc)(h5_file, suffix) for h5_file in files)
+    get_parallel(executor, cores)(
+        delayed(copy_2_proc)(h5_file, suffix, copy_free=copy_free)
+        for h5_file in files)
 
     if update_db:
         update_db_func(db, table_out_name, hdf5_records, suffix, purge=purge)
 
     n_files = len(files)
-    print("--- Copy for processing %d files took %s seconds ---\n" %
-          (n_files, (time.time() - start_time)))
+    print("--- %s for processing %d files took %s seconds ---\n" %
+          ("Link" if copy_free else "Copy", n_files,
+           (time.time() - start_time)))
 
     #print(db.table(table_out_name).all())
     db.close()
@@ -193,7 +304,7 @@ def query_command_for_same_sample(db_filename, table_name="hdf5_proc"):
     Thanks to it, we could check in other functions/methods if many
     a single zpz (single focus) or multiple zpz (multi focus) are used."""
 
-    db = TinyDB(db_filename, storage=CachingMiddleware(JSONStorage))
+    db = open_index(db_filename)
     stack_table = db.table(table_name)
     file_records = stack_table.all()
     dates_samples_energies = []
@@ -220,8 +331,7 @@ def query_command_for_same_sample(db_filename, table_name="hdf5_proc"):
 
 def check_if_multiple_zps(db_filename, query=None):
     single_zp_bool = True
-    db = TinyDB(db_filename,
-                storage=CachingMiddleware(JSONStorage))
+    db = open_index(db_filename)
     if query is not None:
         file_records = db.search(query)
 
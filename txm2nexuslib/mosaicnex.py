@@ -28,13 +28,42 @@ import datetime
 import time
 import argparse
 
+from txm2nexuslib.util import XRADIA_DTYPES
+
+
+# Maximum size of the blocks of mosaic rows read and written at once
+BLOCK_BYTES = 64 * 1024 * 1024
+# Side of the square chunks of the mosaic datasets
+CHUNK_SIDE = 256
+# Downsampling factors of the levels of the mosaic pyramid
+PYRAMID_FACTORS = (2, 4, 8)
+
+
+def _downsample(data, factor):
+    """Mean of the factor x factor blocks of a 2D array; the rows and
+    columns not filling a whole block are discarded"""
+    rows = data.shape[0] // factor
+    cols = data.shape[1] // factor
+    data = data[:rows * factor, :cols * factor]
+    return data.reshape(rows, factor, cols, factor).mean(axis=3).mean(axis=1)
+
+
+def _rows_per_block(row_bytes):
+    """Number of mosaic rows read and written at once: a multiple of the
+    chunk side, so that each chunk is written only once, and thus of the
+    biggest pyramid factor, so that the downsampled levels can be
+    computed block by block"""
+    block_rows = BLOCK_BYTES // row_bytes
+    block_rows -= block_rows % CHUNK_SIDE
+    return max(CHUNK_SIDE, block_rows)
+
 
 class MosaicNex:
 
     def __init__(self, files, files_order='s', title='X-ray Mosaic', 
                  sourcename='ALBA', sourcetype='Synchrotron X-ray Source', 
                  sourceprobe='x-ray', instrument='BL09 @ ALBA', 
-                 sample='Unknown'): 
+                 sample='Unknown', pyramid=False):
 
         self.files = files
         self.num_input_files = len(files)  # number of files.
@@ -81,6 +110,8 @@ class MosaicNex:
         self.sourceprobe = sourceprobe
         self.instrumentname = instrument
         self.samplename = sample
+        # Store also 2x, 4x and 8x downsampled levels of the mosaic
+        self.pyramid = pyramid
         self.sampledistance = 0
         self.datatype = 'uint16'  # two bytes
         self.sequence_number = 0
@@ -459,14 +490,20 @@ class MosaicNex:
         verbose = False
         print("Converting mosaic image data from xrm to NeXus HDF5.")
 
+        if self.datatype not in XRADIA_DTYPES:
+            print "Wrong data type"
+            return
+        dt = XRADIA_DTYPES[self.datatype]
+
         # Opening the mosaic .xrm file as an Ole structure.
-        olemosaic = OleFileIO(self.mosaic_file_xrm)
+        olemosaic = OleFileIO(self.mosaic_file_xrm, use_mmap=True)
 
         # Mosaic data image
         self.inst_sample_grp.create_dataset(
             "data",
             shape=(self.numrows, self.numcols),
-            chunks=(1, self.numcols),
+            chunks=(min(CHUNK_SIDE, self.numrows),
+                    min(CHUNK_SIDE, self.numcols)),
             dtype=self.datatype)
 
         self.inst_sample_grp['data'].attrs['Data Type'] = self.datatype
@@ -475,26 +512,37 @@ class MosaicNex:
         self.inst_sample_grp['data'].attrs['Image Height'] = self.numrows
         self.inst_sample_grp['data'].attrs['Image Width'] = self.numcols
 
+        if self.pyramid:
+            pyramid_grp = self.inst_sample_grp.create_group("pyramid")
+            for factor in PYRAMID_FACTORS:
+                shape = (self.numrows // factor, self.numcols // factor)
+                level = pyramid_grp.create_dataset(
+                    "%dx" % factor,
+                    shape=shape,
+                    chunks=(max(1, min(CHUNK_SIDE, shape[0])),
+                            max(1, min(CHUNK_SIDE, shape[1]))),
+                    dtype='float32')
+                level.attrs['Downsampling'] = factor
+
         img_string = "ImageData1/Image1"
         stream = olemosaic.openstream(img_string)
 
-        for i in range(0, self.numrows):
-            if self.datatype == 'uint16':
-                dt = np.uint16
-                data = stream.read(self.numcols*2)
-            elif self.datatype == 'float':  
-
-                dt = np.float          
-                data = stream.read(self.numcols*4)                      
-            else:
-                print "Wrong data type"
-                return
-
-            imgdata = np.frombuffer(data, dtype=dt, count=self.numcols)
-            imgdata = np.reshape(imgdata, (1, self.numcols), order='A')
-            self.inst_sample_grp['data'][i] = imgdata
-            if i % 100 == 0:
-                print('Mosaic row %i converted' % (i + 1))
+        row_bytes = self.numcols * dt.itemsize
+        block_rows = _rows_per_block(row_bytes)
+        for start in range(0, self.numrows, block_rows):
+            stop = min(start + block_rows, self.numrows)
+            data = stream.read((stop - start) * row_bytes)
+            imgdata = np.frombuffer(data, dtype=dt).reshape(stop - start,
+                                                            self.numcols)
+            self.inst_sample_grp['data'][start:stop] = imgdata
+            if self.pyramid:
+                level = imgdata
+                for factor in PYRAMID_FACTORS:
+                    level = _downsample(level, 2)
+                    first = start // factor
+                    pyramid_grp["%dx" % factor][
+                        first:first + level.shape[0]] = level
+            print('Mosaic rows %i to %i converted' % (start + 1, stop))
 
         olemosaic.close()
 
@@ -515,21 +563,14 @@ class MosaicNex:
             img_string = "ImageData1/Image1"
             stream = oleFF.openstream(img_string)        
 
-            if self.datatypeFF == 'uint16':
-                data = stream.read()
-                struct_fmt = "<{0:10}H".format(self.numrowsFF*self.numcolsFF)
-
-            elif self.datatypeFF == 'float':
-                data = stream.read()
-                struct_fmt = "<{0:10}f".format(self.numrowsFF*self.numcolsFF)
-
-            else:
+            if self.datatypeFF not in XRADIA_DTYPES:
                 print "Wrong FF data type"
                 return
 
-            imgdata = struct.unpack(struct_fmt, data)
-            imgdataFF = np.reshape(imgdata,
-                                   (self.numrowsFF, self.numcolsFF), order='A')
+            imgdataFF = np.frombuffer(
+                stream.read(), dtype=XRADIA_DTYPES[self.datatypeFF],
+                count=self.numrowsFF * self.numcolsFF).reshape(
+                self.numrowsFF, self.numcolsFF)
 
             self.inst_FF_grp['data'] = imgdataFF
             self.inst_FF_grp['data'].attrs['Data Type'] = self.datatypeFF
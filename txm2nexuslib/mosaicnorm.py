@@ -26,7 +26,11 @@ import h5py
 
 class MosaicNormalize:
 
-    def __init__(self, inputfile, ratio=1):
+    # Side of the square chunks of the normalized mosaic: square tiles are
+    # efficient both for writing blocks of rows and for viewing regions
+    chunk_side = 256
+
+    def __init__(self, inputfile, ratio=1, memory=1024):
 
         # Input File: HDF5 Raw Data
         filename_nexus = inputfile
@@ -39,7 +43,9 @@ class MosaicNormalize:
         self.norm_grp.attrs['NX_class'] = "NXentry"
 
         self.ratio_exptimes = ratio
-            
+        # Memory budget (MB) of the blocks of rows normalized at once
+        self.memory = memory
+
         # Mosaic images
         self.nFrames = 0                
         self.numrows = 0
@@ -53,6 +59,15 @@ class MosaicNormalize:
         self.numcolsFF = 0
         self.dim_imagesFF = (1, 1, 0)
 
+    def _rows_per_block(self, chunk_rows):
+        """Number of mosaic rows normalized at once within the memory
+        budget, as a multiple of the chunk rows: a block is computed in
+        float64 (mosaic and FF rows) and written in float32."""
+        row_bytes = (8 + 8 + 4) * self.numcols
+        rows = self.memory * 1024 * 1024 // row_bytes
+        rows = max(chunk_rows, rows - rows % chunk_rows)
+        return int(min(rows, self.numrows))
+
     def normalizeMosaic(self):
 
         nxmosaic_grp = self.input_nexusfile["NXmosaic"]
@@ -111,10 +126,12 @@ class MosaicNormalize:
 
             rel_cols_mosaic_to_FF = int(self.numcols / self.numcolsFF)
 
+            chunks = (min(self.chunk_side, self.numrows),
+                      min(self.chunk_side, self.numcols))
             self.norm_grp.create_dataset(
                 "mosaic_normalized",
                 shape=(self.numrows, self.numcols),
-                chunks=(1, self.numcols),
+                chunks=chunks,
                 dtype='float32')
 
             self.norm_grp['mosaic_normalized'].attrs[
@@ -122,36 +139,27 @@ class MosaicNormalize:
             self.norm_grp['mosaic_normalized'].attrs[
                 'Pixel Columns'] = self.numcols
 
-            FF_image = FF_image_data.value
+            # FF image repeated along the columns of the mosaic
+            FF_image = FF_image_data[...].astype(float)
+            collageFF = np.tile(FF_image, (1, rel_cols_mosaic_to_FF))
+            collageFF *= self.ratio_exptimes
 
             #########################################
-            # Normalization row by row              #
+            # Normalization by blocks of rows       #
             #########################################
-            for numrow in range(self.numrows):
-
-                individual_FF_row = list(FF_image[numrow%self.numrowsFF])
-
-                collageFFrow = individual_FF_row * rel_cols_mosaic_to_FF 
-
-                individual_mosaic_row = sample_image_data[numrow]
+            rows_per_block = self._rows_per_block(chunks[0])
+            for start in range(0, self.numrows, rows_per_block):
+                stop = min(start + rows_per_block, self.numrows)
 
                 # Formula #
-                numerator = np.array(individual_mosaic_row)
-                numerator = numerator.astype(float)
-                denominator = np.array(collageFFrow)
-                denominator = denominator.astype(float)
-
-                self.norm_mosaic_row = np.array(numerator / (
-                    denominator * self.ratio_exptimes), dtype = np.float32)
-
-                imgdata = np.reshape(self.norm_mosaic_row,
-                                     (1, self.numcols),
-                                     order='A')
-
-                self.norm_grp['mosaic_normalized'][numrow] = imgdata
-
-                if numrow % 200 == 0:
-                    print('Row %d has been normalized' % numrow)
+                numerator = sample_image_data[start:stop].astype(float)
+                denominator = collageFF[
+                    np.arange(start, stop) % self.numrowsFF]
+                self.norm_grp['mosaic_normalized'][start:stop] = np.array(
+                    numerator / denominator, dtype=np.float32)
+
+                print('Rows %d to %d have been normalized' % (start,
+                                                               stop - 1))
 
             print('\nMosaic has been normalized using the FF image.\n')
 
@@ -23,12 +23,24 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import copy
+import json
+import time
 import pprint
+from fnmatch import fnmatch
 from shutil import copy2
-from glob import glob
-from tinydb import TinyDB
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import CachingMiddleware
+from glob import has_magic
+
+from txm2nexuslib.fileindex import open_index
+
+
+# Filename of the files index DataBase of each backend
+DB_FILENAMES = {'json': 'index.json', 'sqlite': 'index.sqlite'}
+# Table of the files index DataBase storing the parser state (position in
+# the TXM script and parser state at that position)
+PARSER_TABLE = 'txm_script'
+# Bytes of the TXM script, before the parsed position, stored to check
+# that the script has only been appended
+SCRIPT_TAIL_SIZE = 256
 
 
 class ParserTXMScript(object):
@@ -152,70 +164,356 @@ class ParserTXMScript(object):
         store_parameters = copy.deepcopy(self.parameters)
         self.collected_files.append(store_parameters)
 
-    def parse_script(self, txm_txt_script):
-        f = open(txm_txt_script, 'r')
-        lines = f.readlines()
-        for i, line in enumerate(lines):
-            if "moveto energy" in line:
-                self.parse_energy(line)
-            if "moveto T" in line:
-                self.parse_angle(line)
-            if "moveto ZPz" in line:
-                self.parse_zpz(line)
-            if "moveto folder" in line:
-                self.parse_subfolder(line)
-            if "moveto phx" in line:
-                self.parse_jj_u(line)
-            if "moveto phy" in line:
-                self.parse_jj_d(line)
-            if "collect" in line:
-                self.parse_collect(line)    
+    def get_state(self):
+        """Parser state (positions of the motors, previous image, ...),
+        which allows resuming the parsing of a script"""
+        state = dict([(key, value) for key, value in vars(self).items()
+                      if key not in ('collected_files', 'offset',
+                                     'state', 'partial_files')])
+        return copy.deepcopy(state)
+
+    def set_state(self, state):
+        for key, value in copy.deepcopy(state).items():
+            setattr(self, key, value)
+
+    def parse_line(self, line):
+        if "moveto energy" in line:
+            self.parse_energy(line)
+        if "moveto T" in line:
+            self.parse_angle(line)
+        if "moveto ZPz" in line:
+            self.parse_zpz(line)
+        if "moveto folder" in line:
+            self.parse_subfolder(line)
+        if "moveto phx" in line:
+            self.parse_jj_u(line)
+        if "moveto phy" in line:
+            self.parse_jj_d(line)
+        if "collect" in line:
+            self.parse_collect(line)
+
+    def parse_script(self, txm_txt_script, offset=0):
+        """Parse the script from the given byte offset, and return the
+        collected files. After parsing, the attributes 'offset' and
+        'state' give the position in the script after its last complete
+        line, and the parser state at that position: a last line not yet
+        ended (script being written) is parsed, but it will be parsed
+        again when resuming from that position. The files collected in
+        that line are given by the attribute 'partial_files'."""
+        with open(txm_txt_script, 'rb') as f:
+            f.seek(offset)
+            lines = f.readlines()
+        partial_line = None
+        if lines and not lines[-1].endswith('\n'):
+            partial_line = lines.pop()
+        for line in lines:
+            self.parse_line(line)
+        self.offset = offset + sum([len(line) for line in lines])
+        self.state = self.get_state()
+        num_collected = len(self.collected_files)
+        if partial_line is not None:
+            self.parse_line(partial_line)
+        self.partial_files = [parameters['filename'] for parameters in
+                              self.collected_files[num_collected:]]
         return self.collected_files
 
 
-def get_db_path(txm_txt_script):
+def get_db_path(txm_txt_script, backend='json'):
     txm_file_dir = os.path.dirname(os.path.abspath(txm_txt_script))
-    return os.path.join(txm_file_dir, "index.json")
+    return os.path.join(txm_file_dir, DB_FILENAMES[backend])
 
-def create_db(txm_txt_script):
-    db = get_db(txm_txt_script)
+def create_db(txm_txt_script, backend='json', incremental=False):
+    db = get_db(txm_txt_script, backend=backend, incremental=incremental)
     #import pprint
     #pp = pprint.PrettyPrinter(indent=4)
     #pp.pprint(db.all())
     db.close()
 
-def get_db(txm_txt_script, use_existing_db=False):
+
+def _script_tail(txm_txt_script, offset):
+    """Last bytes of the script before offset: they allow checking that
+    the script has only been appended since it was parsed"""
+    start = max(offset - SCRIPT_TAIL_SIZE, 0)
+    with open(txm_txt_script, 'rb') as f:
+        f.seek(start)
+        return f.read(offset - start).decode('latin-1')
+
+
+def _get_parser_state(db, txm_txt_script):
+    """Parser state stored in the DataBase, if the script has only been
+    appended since the previous parsing"""
+    state_records = db.table(PARSER_TABLE).all()
+    if not state_records:
+        return None
+    state_record = state_records[-1]
+    offset = state_record['offset']
+    if (os.path.getsize(txm_txt_script) < offset or
+            _script_tail(txm_txt_script, offset) != state_record['tail']):
+        return None
+    return state_record
+
+
+def _store_parser_state(db, txm_txt_script, parser):
+    table = db.table(PARSER_TABLE)
+    table.purge()
+    table.insert({'offset': parser.offset,
+                  'tail': _script_tail(txm_txt_script, parser.offset),
+                  'state': parser.state,
+                  'partial_files': parser.partial_files})
+
+
+def _upsert_collected_images(db, collected_images):
+    """Insert the new collected images; the images already in the
+    DataBase (same filename) are updated, keeping their processed flag"""
+    existing = dict([(record['filename'], record.doc_id)
+                     for record in db.all()])
+    new_images = []
+    for image in collected_images:
+        if image['filename'] in existing:
+            image = dict(image)
+            image.pop('processed', None)
+            db.update(image, doc_ids=[existing[image['filename']]])
+        else:
+            new_images.append(image)
+    db.insert_multiple(new_images)
+    return len(new_images)
+
+
+def get_db(txm_txt_script, use_existing_db=False, backend='json',
+           incremental=False):
     """Get the data files DataBase if exisiting, or create the DataBase
-    if not existing yet or if the creation is specified explicitely"""
+    if not existing yet or if the creation is specified explicitely.
+    The backend of the DataBase can be 'json' (TinyDB) or 'sqlite'.
+
+    If incremental is True, only the lines appended to the script since
+    the DataBase was created (or last updated) are parsed, and the new
+    images are added to the existing DataBase. The DataBase is created
+    again if the script has been modified in another way."""
 
     if not os.path.isfile(txm_txt_script):
         raise Exception('TXM txt script does not exist')
 
-    # root_path: folder in which raw data files are organized in subfolders.
-    root_path = os.path.dirname(os.path.abspath(txm_txt_script))
-
-    db_name = 'index.json'
-    db_full_path = os.path.join(root_path, db_name)
-    if os.path.isfile(db_full_path) and use_existing_db:
+    db_full_path = get_db_path(txm_txt_script, backend=backend)
+    db_exists = os.path.isfile(db_full_path)
+    if db_exists and use_existing_db:
         print("\nUsing existing files DataBase\n")
-        db = TinyDB(db_full_path, storage=CachingMiddleware(JSONStorage))
+        return open_index(db_full_path)
+
+    db = open_index(db_full_path)
+    parser = ParserTXMScript()
+    state_record = None
+    if db_exists and incremental:
+        state_record = _get_parser_state(db, txm_txt_script)
+    if state_record is not None:
+        print("\nUpdating files DataBase\n")
+        parser.set_state(state_record['state'])
+        # The files of a line which was not completely written are
+        # collected again from the complete line
+        partial_files = set(state_record.get('partial_files', []))
+        if partial_files:
+            db.remove(doc_ids=[record.doc_id for record in db.all()
+                               if record['filename'] in partial_files])
+        collected_images = parser.parse_script(txm_txt_script,
+                                               state_record['offset'])
+        num_new = _upsert_collected_images(db, collected_images)
+        print("%d new files added to the DataBase\n" % num_new)
     else:
         print("\nCreating files DataBase\n")
-        db = TinyDB(db_full_path, storage=CachingMiddleware(JSONStorage))
         db.purge()
-        parser = ParserTXMScript()
         collected_images = parser.parse_script(txm_txt_script)
         db.insert_multiple(collected_images)
+    _store_parser_state(db, txm_txt_script, parser)
     return db
 
 
+class FilesPathsIndex(object):
+    """Persistent index of the files contained in a root folder and in all
+    its subfolders, giving the paths of the files from their filenames.
+
+    The listing of each folder is stored (in index_file, by default
+    index_paths.json beside the files index) together with the folder
+    modification time, and a folder is only listed again when it has been
+    modified since its last listing. Refreshing the index thus costs one
+    stat per folder, instead of a full walk of the root folder for each
+    file searched. If index_file cannot be written, the index is only
+    kept in memory."""
+
+    index_filename = "index_paths.json"
+    # Listings made less than racy_interval seconds after the last
+    # modification of a folder are not trusted: the folder could have been
+    # modified again without changing its modification time.
+    racy_interval = 2.0
+
+    def __init__(self, root_path, index_file=None):
+        self.root_path = os.path.abspath(root_path)
+        if index_file is None:
+            index_file = os.path.join(self.root_path, self.index_filename)
+        self.index_file = os.path.abspath(index_file)
+        self._folders = {}
+        self._paths = None
+        self._file_sets = {}
+        self._modified = False
+        self._load()
+
+    def _invalidate(self):
+        self._paths = None
+        self._file_sets = {}
+        self._modified = True
+
+    def _load(self):
+        try:
+            with open(self.index_file) as f:
+                self._folders = json.load(f)["folders"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self._folders = {}
+
+    def save(self):
+        """Store the index in index_file if it has been modified. The file
+        is rewritten in place, to not modify its folder."""
+        if not self._modified:
+            return
+        try:
+            with open(self.index_file, "w") as f:
+                json.dump({"folders": self._folders}, f)
+            self._modified = False
+        except (IOError, OSError):
+            # Read only folder: the index is only kept in memory
+            pass
+
+    def _relative(self, folder):
+        """Folder path relative to the root folder, or None if the folder
+        is not inside the root folder"""
+        relative = os.path.relpath(os.path.abspath(folder), self.root_path)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return "" if relative == os.curdir else relative
+
+    def _refresh_folder(self, relative):
+        """List again the folder if it has been modified since its last
+        listing. Return its entry, or None if the folder does not exist"""
+        folder = os.path.join(self.root_path, relative)
+        entry = self._folders.get(relative)
+        try:
+            mtime = os.stat(folder).st_mtime
+            if (entry is not None and entry["mtime"] == mtime and
+                    entry["listed"] - mtime > self.racy_interval):
+                return entry
+            listed = time.time()
+            names = sorted(os.listdir(folder))
+        except OSError:
+            if entry is not None:
+                del self._folders[relative]
+                self._invalidate()
+            return None
+        files = []
+        folders = []
+        for name in names:
+            if os.path.isdir(os.path.join(folder, name)):
+                folders.append(name)
+            elif os.path.join(folder, name) != self.index_file:
+                files.append(name)
+        entry = {"mtime": mtime, "listed": listed,
+                 "files": files, "folders": folders}
+        self._folders[relative] = entry
+        self._invalidate()
+        return entry
+
+    def refresh(self, folders=None):
+        """Update the listings of the modified folders. By default all the
+        folders of the root folder are checked (one stat per folder);
+        otherwise only the given folders (not their subfolders)."""
+        if folders is not None:
+            for folder in folders:
+                relative = self._relative(folder)
+                if relative is not None:
+                    self._refresh_folder(relative)
+        else:
+            found = set()
+            pending = [""]
+            while pending:
+                relative = pending.pop()
+                entry = self._refresh_folder(relative)
+                if entry is None:
+                    continue
+                found.add(relative)
+                pending.extend([os.path.join(relative, name)
+                                for name in entry["folders"]])
+            for relative in set(self._folders) - found:
+                del self._folders[relative]
+                self._invalidate()
+        self.save()
+
+    def _walk(self):
+        """Relative folders of the index, in walk (top-down) order"""
+        pending = [""]
+        while pending:
+            relative = pending.pop(0)
+            entry = self._folders.get(relative)
+            if entry is None:
+                continue
+            yield relative, entry
+            pending[0:0] = [os.path.join(relative, name)
+                            for name in entry["folders"]]
+
+    def _get_paths(self):
+        if self._paths is None:
+            self._paths = {}
+            for relative, entry in self._walk():
+                folder = os.path.join(self.root_path, relative)
+                for name in entry["files"]:
+                    self._paths.setdefault(name, []).append(
+                        os.path.join(folder, name))
+        return self._paths
+
+    def find(self, filename):
+        """Paths of the files called filename (which can be a glob
+        pattern) in the root folder or in any of its subfolders"""
+        paths = self._get_paths()
+        if not has_magic(filename):
+            return list(paths.get(filename, []))
+        found = []
+        for relative, entry in self._walk():
+            folder = os.path.join(self.root_path, relative)
+            found.extend([os.path.join(folder, name)
+                          for name in entry["files"]
+                          if fnmatch(name, filename)])
+        return found
+
+    def isfile(self, path):
+        """Check if the file exists according to the index. The files
+        outside of the root folder are checked on the file system."""
+        relative = self._relative(os.path.dirname(path))
+        if relative is None:
+            return os.path.isfile(path)
+        if relative not in self._folders:
+            self._refresh_folder(relative)
+        if relative not in self._folders:
+            return False
+        if relative not in self._file_sets:
+            self._file_sets[relative] = set(self._folders[relative]["files"])
+        return os.path.basename(path) in self._file_sets[relative]
+
+
+_paths_indexes = {}
+
+
+def get_paths_index(root_path):
+    """Get the FilesPathsIndex of the root folder, shared by the calls
+    done in the same process"""
+    root_path = os.path.abspath(root_path)
+    if root_path not in _paths_indexes:
+        _paths_indexes[root_path] = FilesPathsIndex(root_path)
+    return _paths_indexes[root_path]
+
+
 def _get_paths_from_root(root_path, query_output):
     """ Get the paths of the queried files by looking in the root folder and
     all subfolders inside the root folder containing the data files"""
+    paths_index = get_paths_index(root_path)
+    paths_index.refresh()
     files = []
     for entry in query_output:
-        for dir,_,_ in os.walk(root_path):
-            files.extend(glob(os.path.join(dir, entry["filename"])))
+        files.extend(paths_index.find(entry["filename"]))
     return files
 
 
@@ -246,7 +544,10 @@ def get_file_paths(query_output, root_path, use_subfolders=True,
         files = _get_paths_from_subfolders(root_path, query_output)
         # Filter existing files
         if only_existing_files:
-            files = filter(os.path.isfile, files)
+            paths_index = get_paths_index(root_path)
+            paths_index.refresh(
+                set([os.path.dirname(path) for path in files]))
+            files = filter(paths_index.isfile, files)
     else:
         files = _get_paths_from_root(root_path, query_output)
 
@@ -255,9 +556,10 @@ def get_file_paths(query_output, root_path, use_subfolders=True,
 
 def search_and_get_file_paths(txm_txt_script, query_impl,
                               use_subfolders=True, only_existing_files=True, 
-                              use_existing_db=False):
+                              use_existing_db=False, backend='json'):
     root_path = os.path.dirname(os.path.abspath(txm_txt_script))
-    db = get_db(txm_txt_script, use_existing_db=use_existing_db)
+    db = get_db(txm_txt_script, use_existing_db=use_existing_db,
+                backend=backend)
     query_output = db.search(query_impl)
     files = get_file_paths(query_output, root_path, 
                            use_subfolders=use_subfolders,
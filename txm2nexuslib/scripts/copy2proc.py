@@ -71,12 +71,18 @@ def main():
                         help='DB output table of raw hdf5 file records\n'
                              '(default: hdf5_proc)')
 
+    parser.add_argument('--copy_free', action='store_true',
+                        help='Do not copy the raw images: the files for\n'
+                             'processing map the raw images of the raw\n'
+                             'hdf5 files, which must be kept')
+
     args = parser.parse_args()
 
     copy2proc_multiple(args.file_index_db, table_in_name=args.table_h5_in,
                        table_out_name=args.table_h5_out,
                        use_subfolders=args.subfolders, cores=args.cores,
-                       update_db=args.update_db)
+                       update_db=args.update_db,
+                       copy_free=args.copy_free)
 
     # printer.pprint(files)
 
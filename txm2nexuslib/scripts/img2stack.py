@@ -81,12 +81,17 @@ def main():
                              'conversion\n'
                              '(default: all CPUs but one are used: -2)')
 
+    parser.add_argument('--virtual', action='store_true',
+                        help='Build the stacks as virtual datasets mapping\n'
+                             'the images of the single image files, which\n'
+                             'are not copied (see materializestack)')
+
     args = parser.parse_args()
     many_images_to_h5_stack(args.file_index_fn, table_name=args.table_h5,
                             type_struct=args.structure,
                             date=args.date, sample=args.sample,
                             energy=args.energy, zpz=args.zpz,
-                            cores=args.cores)
+                            cores=args.cores, virtual=args.virtual)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2019 ALBA-CELLS
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+from argparse import RawTextHelpFormatter
+
+from txm2nexuslib.fileindex import migrate_index
+
+
+def main():
+
+    description = ('Import a files index DataBase (index.json) into an\n'
+                   'SQLite files index DataBase (index.sqlite)')
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('file_index_db', metavar='file_index_db',
+                        type=str, help='json index of xrm and hdf5 files')
+
+    parser.add_argument('-o', '--output', type=str,
+                        default=None,
+                        help='SQLite index filename\n'
+                             '(default: json index name with .sqlite '
+                             'extension)')
+
+    args = parser.parse_args()
+
+    sqlite_filename = migrate_index(args.file_index_db, args.output)
+    print("Files index imported into %s" % sqlite_filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -81,6 +81,9 @@ def main():
                              "'x-ray', 'neutron','electron'")
     parser.add_argument('--instrument-name', type=str, default='BL09 @ ALBA',
                         help="Sets the instrument name")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes decoding the xrm "
+                             "images (default: 1, serial conversion)")
 
     args = parser.parse_args()
 
@@ -117,6 +120,7 @@ def main():
                             sourcetype=args.source_type,
                             sourceprobe=args.source_probe,
                             instrument=args.instrument_name,
+                            workers=args.workers,
                             )
             xrm.convert_metadata()
             xrm.convert_tomography()
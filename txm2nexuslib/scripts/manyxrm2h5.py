@@ -24,6 +24,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
 from argparse import RawTextHelpFormatter
 
+from tinydb import Query
+
 from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
 from txm2nexuslib.parser import create_db, get_db_path
 
@@ -59,13 +61,31 @@ def main():
                         help='Update DB with hdf5 records\n'
                              '(default: True)')
 
+    parser.add_argument('--db_backend', type=str, default='json',
+                        choices=['json', 'sqlite'],
+                        help="Backend of the files index DataBase:\n"
+                             "index.json (json) or index.sqlite (sqlite)\n"
+                             "(default: json)")
+
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only parse the lines appended to the TXM\n"
+                             "script since the files index DataBase was\n"
+                             "created, and only convert the files not\n"
+                             "converted yet")
+
     args = parser.parse_args()
 
-    db_filename = get_db_path(args.txm_txt_script)
-    create_db(args.txm_txt_script)
+    db_filename = get_db_path(args.txm_txt_script,
+                              backend=args.db_backend)
+    create_db(args.txm_txt_script, backend=args.db_backend,
+              incremental=args.incremental)
 
+    query = None
+    if args.incremental:
+        query = Query().processed == False
     multiple_xrm_2_hdf5(db_filename, subfolders=args.subfolders,
-                        cores=args.cores, update_db=args.update_db)
+                        cores=args.cores, update_db=args.update_db,
+                        query=query, purge=not args.incremental)
 
 
 if __name__ == "__main__":
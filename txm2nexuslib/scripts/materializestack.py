@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2019 ALBA-CELLS - CTGENSOFT
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+import argparse
+from argparse import RawTextHelpFormatter
+
+from txm2nexuslib.images.imagestostack import materialize_stack
+
+
+def main():
+
+    description = ('Copy the images of hdf5 stacks built as virtual\n'
+                   'datasets (img2stack --virtual), so that the stacks do\n'
+                   'not need the single image files anymore')
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('stack_filenames', metavar='stack_filenames',
+                        type=str, nargs='+', help='hdf5 stack filenames')
+
+    args = parser.parse_args()
+
+    for stack_filename in args.stack_filenames:
+        virtual_datasets = materialize_stack(stack_filename)
+        print("%s: %d datasets materialized" % (stack_filename,
+                                                 len(virtual_datasets)))
+
+
+if __name__ == "__main__":
+    main()
@@ -57,13 +57,16 @@ def main():
               "Possible options are: 'x-ray', 'neutron', 'electron'"))        
     parser.add_argument('--sample-name', type=str, default='Unknown', 
         help="Sets the sample name") 
+    parser.add_argument('--pyramid', action='store_true',
+        help="Stores also 2x, 4x and 8x downsampled levels of the mosaic")
 
     args = parser.parse_args()
 
     nexusmosaic = mosaicnex.MosaicNex(args.files, args.files_order, args.title,
                                       args.source_name, args.source_type, 
                                       args.source_probe, args.instrument_name, 
-                                      args.sample_name)
+                                      args.sample_name,
+                                      pyramid=args.pyramid)
 
     if nexusmosaic.exitprogram != 1:
         nexusmosaic.NXmosaic_structure()  
@@ -88,12 +88,24 @@ def main():
                         help='Correct diffraction pattern by passing'
                              + '\nan external avgFF (-d=1).')
 
+    parser.add_argument('-M', '--memory', type=int, default=1024,
+                        help='Memory (in MB) used by the blocks of images'
+                             + '\n(or of mosaic rows) normalized at once.'
+                             + '\nDefault: -M=1024.')
+
+    parser.add_argument('-fr', '--ffreduction', type=str, default='mean',
+                        choices=['mean', 'median', 'sigmaclip'],
+                        help='Reduction of the FF images to the average FF:'
+                             + '\nmean, median or sigma-clipped mean.'
+                             + '\nDefault: -fr=mean.')
+
     args = parser.parse_args()
 
     if args.mosaicnorm == 1:
         print("\nNormalizing Mosaic")
         normalize_object = mosaicnorm.MosaicNormalize(args.inputfile,
-                                                      ratio=args.ratio)
+                                                      ratio=args.ratio,
+                                                      memory=args.memory)
         normalize_object.normalizeMosaic()  
         
     else:
@@ -104,7 +116,8 @@ def main():
             and the machine current for each image."""
             normalize_object = tomonorm.TomoNormalize(
                 args.inputfile, args.darkfield, args.avgtomnorm,
-                args.gaussianblur, args.avgff, args.diffraction)
+                args.gaussianblur, args.avgff, args.diffraction,
+                memory=args.memory, ff_reduction=args.ffreduction)
             normalize_object.normalize_tomo()
         else:
             print("\nNormalizing Spectroscopy images")
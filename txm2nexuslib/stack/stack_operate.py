@@ -26,6 +26,8 @@ import h5py
 import numpy as np
 from tinydb import TinyDB, Query
 
+from txm2nexuslib.fileindex import open_index
+
 try:
     import mrcfile
 except Exception:
@@ -73,7 +75,7 @@ def hdf5_2_mrc_stacks(db_filename, table_name="hdf5_stacks"):
     """Convert multiple hdf5 stack to mrc"""
     print("--- Converting multiple hdf5 stacks to mrc ---")
     start_time = time.time()
-    db = TinyDB(db_filename)
+    db = open_index(db_filename, caching=False)
     stack_table = db.table(table_name)
     mrc_stack_table = db.table("mrc_stacks")
     mrc_stack_table.purge()
@@ -129,7 +131,7 @@ def deconvolve_stacks(db_filename, in_table_name="hdf5_stacks",
     """Deconvolve multiple mrc stacks"""
     print("--- Deconvolve hdf5 stack(s) (outputs are mrc stacks) ---")
     start_time = time.time()
-    db = TinyDB(db_filename)
+    db = open_index(db_filename, caching=False)
     in_stack_table = db.table(in_table_name)
     mrc_stack_table = db.table("mrc_stacks")
     mrc_stack_table.purge()
@@ -189,7 +191,7 @@ def minus_ln_stacks_mrc(db_filename, table_name="mrc_stacks",
     print("--- Compute absorbance stacks by applying" +
           " the minus natural logarithm ---")
     start_time = time.time()
-    db = TinyDB(db_filename)
+    db = open_index(db_filename, caching=False)
     mrc_stack_table = db.table(table_name)
 
     stack_query = Query()
@@ -279,7 +281,7 @@ def norm2ali_stacks(db_filename, table_name="mrc_stacks",
     print("--- Aligning all the projections inside a stack,"
           + " for multiple stacks---")
     start_time = time.time()
-    db = TinyDB(db_filename)
+    db = open_index(db_filename, caching=False)
     mrc_stack_table = db.table(table_name)
 
     query = Query()
@@ -300,7 +302,7 @@ def norm2ali_stacks(db_filename, table_name="mrc_stacks",
 def get_stacks_to_recons(db_filename, table_name="mrc_stacks",
                          deconvolution=False, absorbance=False, align=False):
     """Get records of stacks in TinyDB that shall be reconstructed"""
-    db = TinyDB(db_filename)
+    db = open_index(db_filename, caching=False)
     mrc_stack_table = db.table(table_name)
     stack_query = Query()       
     if align:
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
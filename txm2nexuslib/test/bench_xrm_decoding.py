@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+"""Micro-benchmark of the xrm image decoding.
+
+Compares the former struct.unpack decoding with the np.frombuffer one
+used by XradiaFile, on synthetic xrm files:
+
+    python -m txm2nexuslib.test.bench_xrm_decoding --size 1024
+"""
+
+import argparse
+import os
+import shutil
+import struct
+import tempfile
+import timeit
+
+import numpy as np
+
+from txm2nexuslib.xrmnex import XradiaFile
+from txm2nexuslib.test.synthetic import write_xrm_file
+
+
+def struct_get_image_2D(xrm_file):
+    """Former decoding: one Python object per pixel"""
+    stream = xrm_file.file.openstream('ImageData1/Image1')
+    data = stream.read()
+    struct_fmt = "<{0:10}H".format(
+        xrm_file.image_height * xrm_file.image_width)
+    imgdata = struct.unpack(struct_fmt, data)
+    return np.flipud(np.reshape(imgdata, (xrm_file.image_height,
+                                          xrm_file.image_width), order='A'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="xrm image decoding micro-benchmark")
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Image height and width (default: 1024)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Decodings per measure (default: 10)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        xrm_fn = os.path.join(tmp_dir, "bench.xrm")
+        image = np.random.randint(0, 65535, (args.size, args.size))
+        write_xrm_file(xrm_fn, image.astype(np.uint16),
+                       sector_size=4096)
+        out = np.empty((args.size, args.size), dtype=np.uint16)
+        with XradiaFile(xrm_fn) as xrm_file:
+            assert (struct_get_image_2D(xrm_file) ==
+                    xrm_file.get_image_2D()).all()
+            paths = [
+                ("struct.unpack", lambda: struct_get_image_2D(xrm_file)),
+                ("np.frombuffer", lambda: xrm_file.get_image_2D()),
+                ("np.frombuffer (out)",
+                 lambda: xrm_file.get_image_2D(out=out)),
+            ]
+            print("Decoding a %ix%i uint16 image (%i times)" % (
+                args.size, args.size, args.repeat))
+            for name, func in paths:
+                elapsed = min(timeit.repeat(func, number=args.repeat,
+                                            repeat=3))
+                print("%-22s %8.2f ms/image" % (
+                    name, 1000 * elapsed / args.repeat))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+"""Writers of small synthetic OLE2 (xrm) files, used by the tests and
+benchmarks, which do not have access to real BL09 acquisitions."""
+
+import struct
+import numpy as np
+
+
+MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+FREESECT = 0xFFFFFFFF
+ENDOFCHAIN = 0xFFFFFFFE
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+MINI_SECTOR_SIZE = 64
+MINI_SECTOR_CUTOFF = 4096
+
+STGTY_STORAGE = 1
+STGTY_STREAM = 2
+STGTY_ROOT = 5
+
+
+def _chain(fat, positions):
+    """Link the sector positions in the given FAT, return first sector"""
+    if not positions:
+        return ENDOFCHAIN
+    for sect, next_sect in zip(positions[:-1], positions[1:]):
+        fat[sect] = next_sect
+    fat[positions[-1]] = ENDOFCHAIN
+    return positions[0]
+
+
+def _allocate(sectors, fat, blobs, sector_size, interleave=False):
+    """Store the blobs in sectors, return the first sector of each blob.
+
+    If interleave is True, the sectors of the different blobs are
+    allocated in round robin, producing fragmented streams.
+    """
+    chunks = [[blob[i:i + sector_size]
+               for i in range(0, len(blob), sector_size)] for blob in blobs]
+    order = []
+    if interleave:
+        for j in range(max([len(c) for c in chunks] + [0])):
+            order.extend([(i, j) for i in range(len(chunks))
+                          if j < len(chunks[i])])
+    else:
+        for i in range(len(chunks)):
+            order.extend([(i, j) for j in range(len(chunks[i]))])
+    positions = [[] for _ in blobs]
+    for i, j in order:
+        positions[i].append(len(sectors))
+        sectors.append(chunks[i][j].ljust(sector_size, b'\x00'))
+        fat.append(FREESECT)
+    return [_chain(fat, pos) for pos in positions]
+
+
+def _direntry(name, entry_type, left=NOSTREAM, right=NOSTREAM,
+              child=NOSTREAM, start=ENDOFCHAIN, size=0):
+    encoded_name = name.encode('utf-16-le')
+    return struct.pack('<64sHBBIII16sI8s8sIII',
+                       encoded_name, len(encoded_name) + 2, entry_type, 1,
+                       left, right, child, b'\x00' * 16, 0,
+                       b'\x00' * 8, b'\x00' * 8, start, size, 0)
+
+
+def write_ole_file(filename, streams, sector_size=512, fragmented=False):
+    """Write an OLE2 compound file.
+
+    :param streams: dictionary {'Storage/Stream': data}
+    :param sector_size: 512 (version 3) or 4096 (version 4) bytes
+    :param fragmented: interleave the sectors of the big streams
+    """
+    # Storage tree: every node is a dict, storages have 'kids'
+    root = {'name': 'Root Entry', 'type': STGTY_ROOT, 'kids': {}}
+    for path, data in streams.items():
+        parts = path.split('/')
+        node = root
+        for part in parts[:-1]:
+            node = node['kids'].setdefault(
+                part, {'name': part, 'type': STGTY_STORAGE, 'kids': {}})
+        node['kids'][parts[-1]] = {'name': parts[-1], 'type': STGTY_STREAM,
+                                   'data': data}
+    entries = [root]
+    queue = [root]
+    while queue:
+        node = queue.pop(0)
+        for name in sorted(node['kids']):
+            kid = node['kids'][name]
+            kid['sid'] = len(entries)
+            entries.append(kid)
+            if kid['type'] == STGTY_STORAGE:
+                queue.append(kid)
+
+    # Small streams go to the ministream, the others to the FAT
+    ministream = b''
+    minifat = []
+    big_streams = []
+    for entry in entries:
+        if entry['type'] != STGTY_STREAM:
+            continue
+        data = entry['data']
+        if len(data) == 0:
+            entry['start'] = ENDOFCHAIN
+        elif len(data) < MINI_SECTOR_CUTOFF:
+            first = len(minifat)
+            nb_mini = (len(data) + MINI_SECTOR_SIZE - 1) // MINI_SECTOR_SIZE
+            minifat.extend([FREESECT] * nb_mini)
+            entry['start'] = _chain(minifat,
+                                    list(range(first, first + nb_mini)))
+            ministream += data.ljust(nb_mini * MINI_SECTOR_SIZE, b'\x00')
+        else:
+            big_streams.append(entry)
+
+    sectors = []
+    fat = []
+    starts = _allocate(sectors, fat, [e['data'] for e in big_streams],
+                       sector_size, interleave=fragmented)
+    for entry, start in zip(big_streams, starts):
+        entry['start'] = start
+    root['start'] = _allocate(sectors, fat, [ministream], sector_size)[0]
+    root['size'] = len(ministream)
+    minifat_blob = b''.join([struct.pack('<I', s) for s in minifat])
+    nb_minifat_sectors = (len(minifat_blob) + sector_size - 1) // sector_size
+    minifat_blob = minifat_blob.ljust(nb_minifat_sectors * sector_size,
+                                      b'\xff')
+    minifat_start = _allocate(sectors, fat, [minifat_blob], sector_size)[0]
+
+    directory = []
+    for entry in entries:
+        kids = [entry['kids'][name] for name in sorted(entry.get('kids', {}))]
+        child = kids[0]['sid'] if kids else NOSTREAM
+        for kid, next_kid in zip(kids, kids[1:] + [None]):
+            kid['right'] = next_kid['sid'] if next_kid else NOSTREAM
+        if entry['type'] == STGTY_STREAM:
+            directory.append(_direntry(entry['name'], entry['type'],
+                                       right=entry['right'],
+                                       start=entry['start'],
+                                       size=len(entry['data'])))
+        else:
+            directory.append(_direntry(entry['name'], entry['type'],
+                                       right=entry.get('right', NOSTREAM),
+                                       child=child,
+                                       start=entry.get('start', ENDOFCHAIN),
+                                       size=entry.get('size', 0)))
+    entries_per_sector = sector_size // 128
+    while len(directory) % entries_per_sector:
+        directory.append(_direntry(u'', 0))
+    directory_blob = b''.join(directory)
+    dir_start = _allocate(sectors, fat, [directory_blob], sector_size)[0]
+    nb_dir_sectors = len(directory_blob) // sector_size
+
+    # FAT sectors are placed at the end of the file
+    entries_per_fat_sector = sector_size // 4
+    nb_fat_sectors = 1
+    while (len(sectors) + nb_fat_sectors >
+           nb_fat_sectors * entries_per_fat_sector):
+        nb_fat_sectors += 1
+    if nb_fat_sectors > 109:
+        raise ValueError("Synthetic OLE files without DIFAT are limited to "
+                         "109 FAT sectors: use a bigger sector_size")
+    fat_positions = range(len(sectors), len(sectors) + nb_fat_sectors)
+    fat.extend([FATSECT] * nb_fat_sectors)
+    fat.extend([FREESECT] * (nb_fat_sectors * entries_per_fat_sector -
+                             len(fat)))
+    fat_blob = b''.join([struct.pack('<I', s) for s in fat])
+    for i in range(nb_fat_sectors):
+        sectors.append(fat_blob[i * sector_size:(i + 1) * sector_size])
+
+    sector_shift = 9 if sector_size == 512 else 12
+    header = struct.pack('<8s16sHHHHHHLLLLLLLLLL', MAGIC, b'\x00' * 16,
+                         0x3E, 3 if sector_size == 512 else 4, 0xFFFE,
+                         sector_shift, 6, 0, 0,
+                         0 if sector_size == 512 else nb_dir_sectors,
+                         nb_fat_sectors, dir_start, 0, MINI_SECTOR_CUTOFF,
+                         minifat_start if minifat else ENDOFCHAIN,
+                         nb_minifat_sectors if minifat else 0,
+                         ENDOFCHAIN, 0)
+    difat = list(fat_positions) + [FREESECT] * (109 - nb_fat_sectors)
+    header += b''.join([struct.pack('<I', s) for s in difat])
+    header = header.ljust(sector_size, b'\x00')
+    with open(filename, 'wb') as f:
+        f.write(header)
+        for sector in sectors:
+            f.write(sector)
+
+
+def xrm_streams(image, angle=0.0, energy=700.0, exp_time=1.0,
+                current=250.0, date="10/18/26 12:00:00", pixel_size=0.01,
+                magnification=1300.0, sample_id="sample", x=0.0, y=0.0,
+                z=0.0):
+    """Streams of a single image xrm file having the given 2D image"""
+    image = np.asarray(image)
+    data_type = 5 if image.dtype == np.uint16 else 10
+    dtype = '<u2' if data_type == 5 else '<f4'
+    numrows, numcols = image.shape
+    axes_names = ["Axis%d" % i for i in range(31)]
+    axes_names[2] = "Sample Z"
+    axes_names[23] = "Detector Z"
+    axes_names[27] = "Energy"
+    axes_names[28] = "Current"
+    axes_names[30] = "Energyenc"
+    motor_positions = np.zeros(len(axes_names), dtype='<f4')
+    motor_positions[27] = energy
+    motor_positions[28] = current
+    motor_positions[30] = energy
+    return {
+        'ImageInfo/ImageWidth': struct.pack('<I', numcols),
+        'ImageInfo/ImageHeight': struct.pack('<I', numrows),
+        'ImageInfo/DataType': struct.pack('<I', data_type),
+        'ImageInfo/NoOfImages': struct.pack('<I', 1),
+        'ImageInfo/PixelSize': struct.pack('<f', pixel_size),
+        'ImageInfo/XrayMagnification': struct.pack('<f', magnification),
+        'ImageInfo/Angles': struct.pack('<f', angle),
+        'ImageInfo/ExpTimes': struct.pack('<f', exp_time),
+        'ImageInfo/Energy': struct.pack('<f', energy),
+        'ImageInfo/XPosition': struct.pack('<f', x),
+        'ImageInfo/YPosition': struct.pack('<f', y),
+        'ImageInfo/ZPosition': struct.pack('<f', z),
+        'ImageInfo/Date': struct.pack('<17s23x', date.encode('ascii')),
+        'PositionInfo/AxisNames': b''.join(
+            [name.encode('ascii') + b'\x00\x00' for name in axes_names]),
+        'PositionInfo/MotorPositions': motor_positions.tobytes(),
+        'SampleInfo/SampleID': struct.pack('<50s',
+                                           sample_id.encode('ascii')),
+        'ImageData1/Image1': np.ascontiguousarray(
+            np.flipud(image), dtype=dtype).tobytes(),
+    }
+
+
+def write_xrm_file(filename, image, sector_size=512, fragmented=False,
+                   **metadata):
+    """Write a single image xrm file; metadata as in xrm_streams"""
+    write_ole_file(filename, xrm_streams(image, **metadata),
+                   sector_size=sector_size, fragmented=fragmented)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+from tinydb import Query
+
+from txm2nexuslib.parser import create_db, get_db_path
+from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
+from txm2nexuslib.images.util import copy2proc_multiple
+from txm2nexuslib.images.multiplenormalization import (normalize_images,
+                                                        average_ff)
+from txm2nexuslib.images import ffcache
+from txm2nexuslib.test.synthetic import write_xrm_file
+
+
+FILENAMES = ["20191018_cell_%.1f.xrm" % angle for angle in (0.0, 10.0)]
+FF_FILENAMES = ["20191018_cell_FF_%d.xrm" % i for i in range(2)]
+
+
+class FFCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random = np.random.RandomState(2)
+        lines = ["moveto energy 520.0"]
+        for i, filename in enumerate(FILENAMES + FF_FILENAMES):
+            image = random.rand(32, 32) * 3000 + 200
+            write_xrm_file(os.path.join(self.tmp_dir, filename),
+                           image.astype(np.uint16), angle=10.0 * i,
+                           exp_time=1.0 + 0.1 * i, current=250.0 - i)
+            lines.append("collect " + filename)
+        script = os.path.join(self.tmp_dir, "script.txt")
+        with open(script, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        create_db(script)
+        self.db_filename = get_db_path(script)
+        multiple_xrm_2_hdf5(self.db_filename, cores=1)
+        copy2proc_multiple(self.db_filename, cores=1)
+
+    def tearDown(self):
+        ffcache._ff_caches.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def _proc_filename(self, filename):
+        return os.path.join(self.tmp_dir,
+                            os.path.splitext(filename)[0] + "_proc.hdf5")
+
+    def _read(self, filename):
+        with h5py.File(self._proc_filename(filename), "r") as f:
+            return f["data"][...], sorted(f.keys())
+
+    def _normalize(self, filename):
+        normalize_images(self.db_filename, cores=1,
+                         query=(Query().filename ==
+                                os.path.basename(
+                                    self._proc_filename(filename))))
+
+    def test_ff_computed_once(self):
+        self._normalize(FILENAMES[0])
+        ff_contents = [self._read(ff_filename)
+                       for ff_filename in FF_FILENAMES]
+        ff_cache = ffcache.get_ff_cache(self.db_filename)
+        self.assertEqual(len(ff_cache), 1)
+        self.assertTrue(os.path.exists(
+            ffcache.ff_cache_filename(self.db_filename)))
+
+        # A new process reads the averaged FF from the sidecar file
+        ff_cache.clear()
+        self._normalize(FILENAMES[1])
+        for ff_filename, (ff_image, names) in zip(FF_FILENAMES,
+                                                  ff_contents):
+            image, new_names = self._read(ff_filename)
+            self.assertEqual(new_names, names)
+            np.testing.assert_array_equal(image, ff_image)
+
+        first_image, _ = self._read(FILENAMES[0])
+        second_image, _ = self._read(FILENAMES[1])
+        with h5py.File(self._proc_filename(FILENAMES[1]), "r") as f:
+            constant = (f["metadata/exposure_time"][()] *
+                        f["metadata/machine_current"][()])
+            expected = (f["data_1"][...] / constant) / ff_contents[0][0]
+        np.testing.assert_array_equal(second_image, expected)
+        self.assertFalse(np.array_equal(first_image, second_image))
+
+    def test_average_ff_query(self):
+        # No FF matches the query: nothing is averaged
+        average_ff(self.db_filename, cores=1, query=(Query().energy == 525.0))
+        ff_cache = ffcache.get_ff_cache(self.db_filename)
+        self.assertEqual(len(ff_cache), 0)
+        average_ff(self.db_filename, cores=1, query=(Query().energy == 520.0))
+        self.assertEqual(len(ff_cache), 1)
+        # The normalization uses the averaged FF
+        self._normalize(FILENAMES[0])
+        ff_image, _ = self._read(FF_FILENAMES[0])
+        with h5py.File(self._proc_filename(FILENAMES[0]), "r") as f:
+            constant = (f["metadata/exposure_time"][()] *
+                        f["metadata/machine_current"][()])
+            expected = (f["data_1"][...] / constant) / ff_image
+            np.testing.assert_array_equal(f["data"][...], expected)
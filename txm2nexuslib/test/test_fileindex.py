@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+import os
+import shutil
+import multiprocessing
+import tempfile
+from unittest import TestCase
+
+from tinydb import TinyDB, Query
+
+from txm2nexuslib.fileindex import SQLiteIndex, open_index, migrate_index
+
+
+def _insert_records(filename, records):
+    sqlite_db = open_index(filename)
+    for record in records:
+        sqlite_db.insert(record)
+    sqlite_db.close()
+
+
+class SQLiteIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.records = []
+        for energy in (700.0, 705.5):
+            for angle in (-10.0, 0.0, 10.0):
+                for ff in (False, True):
+                    self.records.append({
+                        "date": 20191018, "sample": u"cell",
+                        "energy": energy, "angle": angle, "FF": ff,
+                        "filename": u"%s_%s_%s.xrm" % (energy, angle, ff),
+                        "extension": u".xrm"})
+        self.records[0]["processed"] = True
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _dbs(self):
+        json_db = TinyDB(os.path.join(self.tmp_dir, "index.json"))
+        sqlite_db = open_index(os.path.join(self.tmp_dir, "index.sqlite"))
+        for db in (json_db, sqlite_db):
+            db.insert_multiple(self.records)
+            db.table("hdf5_raw").insert_multiple(self.records[:3])
+        return json_db, sqlite_db
+
+    def test_same_results_as_tinydb(self):
+        json_db, sqlite_db = self._dbs()
+        self.assertIsInstance(sqlite_db, SQLiteIndex)
+        files = Query()
+        queries = [files.FF == False,
+                   (files.energy == 705.5) & (files.angle == 10.0),
+                   (files.energy == 700) | (files.FF == True),
+                   files.processed.exists(),
+                   (files.sample == u"cell") & ~(files.angle == 0.0),
+                   files.angle > 0]
+        for query in queries:
+            self.assertEqual(sqlite_db.search(query), json_db.search(query))
+        self.assertEqual(sqlite_db.all(), json_db.all())
+        self.assertEqual(sqlite_db.table("hdf5_raw").all(),
+                         json_db.table("hdf5_raw").all())
+        self.assertEqual(sqlite_db.tables(), json_db.tables())
+
+        for db in (json_db, sqlite_db):
+            db.update({"processed": False}, files.angle == 0.0)
+            db.remove(files.energy == 705.5)
+            db.table("hdf5_raw").purge()
+        self.assertEqual(sqlite_db.all(), json_db.all())
+        self.assertEqual(len(sqlite_db.table("hdf5_raw")), 0)
+        self.assertEqual([r.doc_id for r in sqlite_db.all()],
+                         [r.doc_id for r in json_db.all()])
+        json_db.close()
+        sqlite_db.close()
+
+    def test_group_by(self):
+        _, sqlite_db = self._dbs()
+        groups = sqlite_db.group_by(("energy", "angle"),
+                                    Query().FF == False)
+        self.assertEqual([values for values, _ in groups],
+                         [(700.0, -10.0), (700.0, 0.0), (700.0, 10.0),
+                          (705.5, -10.0), (705.5, 0.0), (705.5, 10.0)])
+        for (energy, angle), records in groups:
+            self.assertEqual(len(records), 1)
+            self.assertEqual(records[0]["energy"], energy)
+            self.assertEqual(records[0]["angle"], angle)
+        groups = sqlite_db.group_by(("extension", "processed"))
+        self.assertEqual([(values, len(records)) for values, records in groups],
+                         [((u".xrm", None), 11), ((u".xrm", True), 1)])
+        sqlite_db.close()
+
+    def test_concurrent_inserts(self):
+        filename = os.path.join(self.tmp_dir, "index.sqlite")
+        open_index(filename).close()
+        processes = [multiprocessing.Process(
+            target=_insert_records, args=(filename, self.records))
+            for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        sqlite_db = open_index(filename)
+        doc_ids = [record.doc_id for record in sqlite_db.all()]
+        self.assertEqual(doc_ids, range(1, 4 * len(self.records) + 1))
+        sqlite_db.close()
+
+    def test_migrate_index(self):
+        json_db, _ = self._dbs()
+        json_db.close()
+        sqlite_fn = migrate_index(os.path.join(self.tmp_dir, "index.json"),
+                                  os.path.join(self.tmp_dir, "copy.db"))
+        json_db = TinyDB(os.path.join(self.tmp_dir, "index.json"))
+        sqlite_db = open_index(sqlite_fn)
+        for table in ("_default", "hdf5_raw"):
+            json_records = json_db.table(table).all()
+            sqlite_records = sqlite_db.table(table).all()
+            self.assertEqual(sqlite_records, json_records)
+            self.assertEqual([r.doc_id for r in sqlite_records],
+                             [r.doc_id for r in json_records])
+        json_db.close()
+        sqlite_db.close()
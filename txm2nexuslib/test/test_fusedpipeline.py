@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from joblib import delayed
+
+from txm2nexuslib.util import Executor
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.parser import create_db, get_db_path
+from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
+from txm2nexuslib.images.util import copy2proc_multiple
+from txm2nexuslib.images.multiplecrop import crop_images
+from txm2nexuslib.images.multiplenormalization import normalize_images
+from txm2nexuslib.images.multiplealign import align_images
+from txm2nexuslib.images.multipleaverage import average_image_groups
+from txm2nexuslib.images.fusedpipeline import fused_preprocessing
+from txm2nexuslib.test.synthetic import write_xrm_file
+
+
+def _worker_pid():
+    time.sleep(0.1)
+    return os.getpid()
+
+
+class FusedPreprocessingTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _acquire(self, name):
+        """Multifocus tomo (3 angles x 3 zpz) and 2 FF, with their index"""
+        data_dir = os.path.join(self.tmp_dir, name)
+        os.mkdir(data_dir)
+        random = np.random.RandomState(1)
+        base = random.rand(128, 128) * 3000 + 200
+        lines = ["moveto energy 520.0"]
+        for angle in (-10.0, 0.0, 10.0):
+            lines.append("moveto T %.1f" % angle)
+            for i, zpz in enumerate((-1.0, 0.0, 1.0)):
+                lines.append("moveto ZPz %.1f" % zpz)
+                filename = "20191018_cell_%.1f_%.1f.xrm" % (angle, zpz)
+                image = (np.roll(np.roll(base, 2 * i, 0), -i, 1) +
+                         random.rand(128, 128) * 50)
+                write_xrm_file(os.path.join(data_dir, filename),
+                               image.astype(np.uint16), angle=angle,
+                               exp_time=1.0 + 0.1 * i, current=250.0 - i)
+                lines.append("collect " + filename)
+        for i in range(2):
+            filename = "20191018_cell_FF_%d.xrm" % i
+            image = random.rand(128, 128) * 1000 + 3000
+            write_xrm_file(os.path.join(data_dir, filename),
+                           image.astype(np.uint16), exp_time=2.0,
+                           current=249.0 + i)
+            lines.append("collect " + filename)
+        script = os.path.join(data_dir, "script.txt")
+        with open(script, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        create_db(script)
+        return get_db_path(script)
+
+    def _records(self, db_filename, table_name):
+        db = open_index(db_filename)
+        records = sorted([dict(record) for record in
+                          db.table(table_name).all()],
+                         key=lambda record: record["filename"])
+        db.close()
+        return records
+
+    def test_same_results_than_stages(self):
+        staged_db = self._acquire("staged")
+        multiple_xrm_2_hdf5(staged_db, cores=1)
+        copy2proc_multiple(staged_db, cores=1)
+        crop_images(staged_db, cores=1)
+        normalize_images(staged_db, cores=1)
+        align_images(staged_db, align_method='cv2.TM_SQDIFF_NORMED',
+                     cores=1)
+        average_image_groups(staged_db, cores=1)
+
+        fused_db = self._acquire("fused")
+        fused_preprocessing(fused_db, cores=1, checkpoint=True)
+
+        averages = self._records(staged_db, "hdf5_averages")
+        self.assertEqual(len(averages), 3)
+        self.assertEqual(averages, self._records(fused_db, "hdf5_averages"))
+        proc_records = self._records(staged_db, "hdf5_proc")
+        self.assertEqual(proc_records, self._records(fused_db, "hdf5_proc"))
+        for record, dataset in ([(record, "data") for record in averages] +
+                                [(record, "data_3")
+                                 for record in proc_records]):
+            staged_fn = os.path.join(self.tmp_dir, "staged",
+                                     record["filename"])
+            fused_fn = os.path.join(self.tmp_dir, "fused",
+                                    record["filename"])
+            with h5py.File(staged_fn, "r") as staged_f, \
+                    h5py.File(fused_fn, "r") as fused_f:
+                staged_data = staged_f[dataset][...]
+                fused_data = fused_f[dataset][...]
+                self.assertEqual(staged_data.dtype, fused_data.dtype)
+                np.testing.assert_array_equal(staged_data, fused_data)
+
+    def _stages(self, name, shared_memory=False, executor=None):
+        db_filename = self._acquire(name)
+        multiple_xrm_2_hdf5(db_filename, cores=1, executor=executor)
+        copy2proc_multiple(db_filename, cores=1, executor=executor)
+        crop_images(db_filename, cores=1, executor=executor)
+        normalize_images(db_filename, cores=2, shared_memory=shared_memory,
+                         executor=executor)
+        align_images(db_filename, align_method='cv2.TM_SQDIFF_NORMED',
+                     cores=2, shared_memory=shared_memory,
+                     executor=executor)
+        return db_filename
+
+    def _proc_data(self, db_filename):
+        data = {}
+        for record in self._records(db_filename, "hdf5_proc"):
+            filename = os.path.join(os.path.dirname(db_filename),
+                                    record["filename"])
+            with h5py.File(filename, "r") as f:
+                data[record["filename"]] = dict(
+                    [(name, f[name][...]) for name in f
+                     if name.startswith("data")])
+        return data
+
+    def _assert_same_proc_files(self, db_filename, other_db_filename):
+        data = self._proc_data(db_filename)
+        other_data = self._proc_data(other_db_filename)
+        self.assertEqual(sorted(data), sorted(other_data))
+        for filename in data:
+            self.assertEqual(sorted(data[filename]),
+                             sorted(other_data[filename]))
+            for name in data[filename]:
+                np.testing.assert_array_equal(data[filename][name],
+                                              other_data[filename][name])
+
+    def test_shared_memory_same_results(self):
+        staged_db = self._stages("staged")
+        shared_db = self._stages("shared", shared_memory=True)
+        self.assertEqual(self._records(staged_db, "hdf5_proc"),
+                         self._records(shared_db, "hdf5_proc"))
+        self._assert_same_proc_files(staged_db, shared_db)
+
+    def test_executor_reused_by_stages(self):
+        staged_db = self._stages("staged")
+        with Executor("processes", cores=2) as executor:
+            pids = set(executor.parallel(delayed(_worker_pid)()
+                                         for _ in range(4)))
+            executor_db = self._stages("executor", executor=executor)
+            # The stages have been run by the same workers
+            self.assertEqual(set(executor.parallel(
+                delayed(_worker_pid)() for _ in range(4))), pids)
+        self.assertEqual(self._records(staged_db, "hdf5_proc"),
+                         self._records(executor_db, "hdf5_proc"))
+        self._assert_same_proc_files(staged_db, executor_db)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.image.image_operate_lib import Image, crop_image
+
+
+class ImageTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "image.hdf5")
+        self.pixels = np.arange(60 * 40, dtype=np.uint16).reshape(60, 40)
+        with h5py.File(self.filename, "w") as f:
+            f.create_dataset("data_1", data=self.pixels)
+            f["data_1"].attrs["step"] = 1
+            f["data_1"].attrs["dataset"] = "data_1"
+            f["data"] = h5py.SoftLink("data_1")
+        self.roi = {"top": 3, "bottom": 2, "left": 0, "right": 5}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lazy_image(self):
+        image_obj = Image(h5_image_filename=self.filename)
+        self.assertIsNone(image_obj._image)
+        self.assertEqual(image_obj.shape, (60, 40))
+        self.assertEqual(image_obj.data_type, np.uint16)
+        self.assertEqual(image_obj.image_dataset, "data_1")
+        # The image read is the one linked when the file was opened
+        image_obj.store_image_in_h5(self.pixels * 2)
+        np.testing.assert_array_equal(image_obj.image, self.pixels)
+        image_obj.close_h5()
+
+    def test_read_region(self):
+        image_obj = Image(h5_image_filename=self.filename)
+        expected = crop_image(self.pixels, self.roi)
+        np.testing.assert_array_equal(image_obj.read_region(self.roi),
+                                      expected)
+        self.assertIsNone(image_obj._image)
+        image_cropped, _ = image_obj.crop(self.roi)
+        np.testing.assert_array_equal(image_cropped, expected)
+        image_obj.close_h5()
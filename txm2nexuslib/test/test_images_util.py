@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+from tinydb import Query
+
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.parser import create_db, get_db_path
+from txm2nexuslib.image.xrm2hdf5 import Xrm2H5Converter
+from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
+from txm2nexuslib.images.util import (group_records, copy2proc_multiple,
+                                      copy_2_proc)
+from txm2nexuslib.images.multiplecrop import crop_images
+from txm2nexuslib.images.multiplenormalization import normalize_images
+from txm2nexuslib.images.fusedpipeline import DEFAULT_ROI
+from txm2nexuslib.test.synthetic import write_xrm_file
+
+
+class GroupRecordsTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.records = []
+        for zpz in (-1.0, 1.0):
+            for angle in (10.0, -10.0, 0.0):
+                self.records.append({"date": 20191018, "sample": "cell",
+                                     "energy": 520.0, "zpz": zpz,
+                                     "angle": angle, "FF": False})
+        for zpz in (-1.0, 1.0):
+            self.records.append({"date": 20191018, "sample": "cell",
+                                 "energy": 520.0, "zpz": zpz,
+                                 "angle": 0.0, "FF": True})
+        self.records.append({"date": 20191018, "sample": "cell",
+                             "energy": 525.0, "zpz": 0.0, "angle": 0.0,
+                             "FF": False})
+        for i, record in enumerate(self.records):
+            record["filename"] = "image_%d.hdf5" % i
+            record["subfolder"] = "sub"
+        os.mkdir(os.path.join(self.tmp_dir, "sub"))
+        for record in self.records[:-1]:
+            open(os.path.join(self.tmp_dir, "sub", record["filename"]),
+                 "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_group_records(self):
+        groups = list(group_records(self.records,
+                                    ("date", "sample", "energy", "zpz"),
+                                    ff_keys=("date", "sample", "energy"),
+                                    root_path=self.tmp_dir))
+        self.assertEqual([group.key for group in groups],
+                         [(20191018, "cell", 520.0, -1.0),
+                          (20191018, "cell", 520.0, 1.0),
+                          (20191018, "cell", 525.0, 0.0)])
+        for group in groups[:2]:
+            self.assertEqual([record["angle"] for record in group.records],
+                             [-10.0, 0.0, 10.0])
+            self.assertEqual(
+                group.files,
+                [os.path.join(self.tmp_dir, "sub", record["filename"])
+                 for record in group.records])
+            self.assertEqual(group.ff_records, self.records[6:8])
+            self.assertEqual(len(group.ff_files), 2)
+        # Only the existing files are returned
+        self.assertEqual(groups[2].files, [])
+        self.assertEqual(groups[2].ff_records, [])
+
+    def test_group_records_query_and_order(self):
+        groups = list(group_records(self.records, ("zpz",), sort_by=None,
+                                    split_ff=False,
+                                    query=(Query().angle == 0.0)))
+        self.assertEqual([group.key for group in groups],
+                         [(-1.0,), (0.0,), (1.0,)])
+        self.assertEqual(groups[0].records,
+                         [self.records[2], self.records[6]])
+        self.assertIsNone(groups[0].files)
+        self.assertEqual(groups[0].ff_records, [])
+
+    def test_group_records_sqlite_table(self):
+        sqlite_db = open_index(os.path.join(self.tmp_dir, "index.sqlite"))
+        table = sqlite_db.table("hdf5_proc")
+        table.insert_multiple(self.records)
+        for kwargs in ({"ff_keys": ("date", "sample", "energy")},
+                       {"sort_by": None, "query": Query().angle == 0.0},
+                       {"sort_by": None, "split_ff": False,
+                        "query": Query().FF == True}):
+            keys = ("date", "sample", "energy", "zpz")
+            groups = list(group_records(self.records, keys,
+                                        root_path=self.tmp_dir, **kwargs))
+            table_groups = list(group_records(table, keys,
+                                              root_path=self.tmp_dir,
+                                              **kwargs))
+            self.assertEqual(table_groups, groups)
+        sqlite_db.close()
+
+
+class CopyFreeProcTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random = np.random.RandomState(1)
+        lines = ["moveto energy 520.0"]
+        for i, angle in enumerate((0.0, 10.0)):
+            lines.append("moveto T %.1f" % angle)
+            filename = "20191018_cell_%.1f.xrm" % angle
+            image = random.rand(64, 64) * 3000 + 200
+            write_xrm_file(os.path.join(self.tmp_dir, filename),
+                           image.astype(np.uint16), angle=angle,
+                           exp_time=1.0 + 0.1 * i, current=250.0 - i)
+            lines.append("collect " + filename)
+        image = random.rand(64, 64) * 1000 + 3000
+        write_xrm_file(os.path.join(self.tmp_dir, "20191018_cell_FF.xrm"),
+                       image.astype(np.uint16), exp_time=2.0, current=249.0)
+        lines.append("collect 20191018_cell_FF.xrm")
+        self.script = os.path.join(self.tmp_dir, "script.txt")
+        with open(self.script, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        create_db(self.script)
+        self.db_filename = get_db_path(self.script)
+        multiple_xrm_2_hdf5(self.db_filename, cores=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _process(self, copy_free):
+        copy2proc_multiple(self.db_filename, cores=1, purge=True,
+                           copy_free=copy_free)
+        crop_images(self.db_filename, cores=1)
+        normalize_images(self.db_filename, cores=1)
+        db = open_index(self.db_filename)
+        filenames = sorted([record["filename"] for record in
+                            db.table("hdf5_proc").all()])
+        db.close()
+        data = {}
+        for filename in filenames:
+            with h5py.File(os.path.join(self.tmp_dir, filename), "r") as f:
+                data[filename] = dict([(name, f[name][...])
+                                       for name in ("data_1", "data")])
+        return data
+
+    def test_incremental_conversion(self):
+        filename = "20191018_cell_20.0.xrm"
+        write_xrm_file(os.path.join(self.tmp_dir, filename),
+                       np.ones((64, 64), dtype=np.uint16), angle=20.0)
+        with open(self.script, "a") as f:
+            f.write("moveto T 20.0\ncollect %s\n" % filename)
+        create_db(self.script, incremental=True)
+        # Only the new file is converted, and added to hdf5_raw
+        first_raw = os.path.join(self.tmp_dir, "20191018_cell_0.0.hdf5")
+        os.remove(first_raw)
+        multiple_xrm_2_hdf5(self.db_filename, cores=1,
+                            query=Query().processed == False, purge=False)
+        self.assertFalse(os.path.exists(first_raw))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmp_dir, "20191018_cell_20.0.hdf5")))
+        db = open_index(self.db_filename)
+        self.assertEqual(
+            sorted([record["filename"] for record in
+                    db.table("hdf5_raw").all()]),
+            ["20191018_cell_0.0.hdf5", "20191018_cell_10.0.hdf5",
+             "20191018_cell_20.0.hdf5", "20191018_cell_FF.hdf5"])
+        self.assertEqual(db.count(Query().processed == False), 0)
+        db.close()
+
+    def test_incremental_conversion_of_late_files(self):
+        filename = "20191018_cell_20.0.xrm"
+        with open(self.script, "a") as f:
+            f.write("moveto T 20.0\ncollect %s\n" % filename)
+        create_db(self.script, incremental=True)
+        # The xrm file is not written yet: its record is not processed
+        multiple_xrm_2_hdf5(self.db_filename, cores=1,
+                            query=Query().processed == False, purge=False)
+        db = open_index(self.db_filename)
+        self.assertEqual(
+            [record["filename"] for record in
+             db.search(Query().processed == False)], [filename])
+        self.assertEqual(len(db.table("hdf5_raw").all()), 3)
+        db.close()
+
+        write_xrm_file(os.path.join(self.tmp_dir, filename),
+                       np.ones((64, 64), dtype=np.uint16), angle=20.0)
+        multiple_xrm_2_hdf5(self.db_filename, cores=1,
+                            query=Query().processed == False, purge=False)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmp_dir, "20191018_cell_20.0.hdf5")))
+        db = open_index(self.db_filename)
+        self.assertEqual(db.count(Query().processed == False), 0)
+        self.assertEqual(len(db.table("hdf5_raw").all()), 4)
+        db.close()
+
+    def test_copy_free_same_results(self):
+        raw_filenames = [os.path.join(self.tmp_dir, filename)
+                         for filename in os.listdir(self.tmp_dir)
+                         if filename.endswith(".hdf5")]
+        raw_contents = dict([(filename, open(filename, "rb").read())
+                             for filename in raw_filenames])
+        copied = self._process(copy_free=False)
+        linked = self._process(copy_free=True)
+        self.assertEqual(sorted(copied.keys()), sorted(linked.keys()))
+        for filename in copied:
+            for name in ("data_1", "data"):
+                np.testing.assert_array_equal(copied[filename][name],
+                                              linked[filename][name])
+            proc_filename = os.path.join(self.tmp_dir, filename)
+            with h5py.File(proc_filename, "r") as f:
+                self.assertTrue(f["data_1"].is_virtual)
+                # The processed images are stored locally
+                self.assertNotEqual(f.get("data", getlink=True).path,
+                                    "data_1")
+        for filename in raw_filenames:
+            self.assertEqual(open(filename, "rb").read(),
+                             raw_contents[filename])
+
+    def test_copy_free_read_only_raw(self):
+        raw_filename = os.path.join(self.tmp_dir, "20191018_cell_0.0.hdf5")
+        with h5py.File(raw_filename, "r") as f:
+            raw_image = f["data_1"][...]
+        os.chmod(raw_filename, 0o444)
+        copy_2_proc(raw_filename, "_proc", copy_free=True)
+        proc_filename = os.path.join(self.tmp_dir,
+                                     "20191018_cell_0.0_proc.hdf5")
+        # The image is read when the processed file is opened for writing:
+        # a raw file which cannot be opened for writing is copied
+        with h5py.File(proc_filename, "r+") as f:
+            self.assertEqual(f["data_1"].is_virtual,
+                             os.access(raw_filename, os.W_OK))
+            np.testing.assert_array_equal(f["data"][...], raw_image)
+
+    def test_crop_while_decoding(self):
+        copy2proc_multiple(self.db_filename, cores=1, purge=True)
+        crop_images(self.db_filename, cores=1)
+        xrm_filename = os.path.join(self.tmp_dir, "20191018_cell_0.0.xrm")
+        cropped_filename = os.path.join(self.tmp_dir, "cropped.hdf5")
+        Xrm2H5Converter(xrm_filename, cropped_filename,
+                        roi=DEFAULT_ROI).convert_xrm_to_h5_file()
+        proc_filename = os.path.join(self.tmp_dir,
+                                     "20191018_cell_0.0_proc.hdf5")
+        with h5py.File(proc_filename, "r") as f:
+            expected = f["data"][...]
+        with h5py.File(cropped_filename, "r") as f:
+            self.assertEqual(f["data"].dtype, np.uint16)
+            np.testing.assert_array_equal(f["data"][...], expected)
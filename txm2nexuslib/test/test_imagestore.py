@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.parser import create_db, get_db_path
+from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
+from txm2nexuslib.images.util import copy2proc_multiple
+from txm2nexuslib.images.multiplecrop import crop_images
+from txm2nexuslib.images.multiplenormalization import normalize_images
+from txm2nexuslib.images.multiplealign import align_images
+from txm2nexuslib.images.multipleaverage import average_image_groups
+from txm2nexuslib.images.imagestostack import many_images_to_h5_stack
+from txm2nexuslib.images.imagestore import (
+    ImageStore, STORE_TABLE, STORE_AVERAGES_TABLE, xrm_to_store, crop_store,
+    normalize_store, align_store, average_store, store_to_stack)
+from txm2nexuslib.test.synthetic import write_xrm_file
+
+
+class ImageStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _acquire(self, name):
+        """Multifocus tomo (3 angles x 2 zpz) and 2 FF, with their index"""
+        data_dir = os.path.join(self.tmp_dir, name)
+        os.mkdir(data_dir)
+        random = np.random.RandomState(1)
+        base = random.rand(96, 96) * 3000 + 200
+        lines = ["moveto energy 520.0"]
+        for angle in (-10.0, 0.0, 10.0):
+            lines.append("moveto T %.1f" % angle)
+            for i, zpz in enumerate((-1.0, 1.0)):
+                lines.append("moveto ZPz %.1f" % zpz)
+                filename = "20191018_cell_%.1f_%.1f.xrm" % (angle, zpz)
+                image = (np.roll(np.roll(base, 2 * i, 0), -i, 1) +
+                         random.rand(96, 96) * 50)
+                write_xrm_file(os.path.join(data_dir, filename),
+                               image.astype(np.uint16), angle=angle,
+                               exp_time=1.0 + 0.1 * i, current=250.0 - i)
+                lines.append("collect " + filename)
+        for i in range(2):
+            filename = "20191018_cell_FF_%d.xrm" % i
+            image = random.rand(96, 96) * 1000 + 3000
+            write_xrm_file(os.path.join(data_dir, filename),
+                           image.astype(np.uint16), exp_time=2.0,
+                           current=249.0 + i)
+            lines.append("collect " + filename)
+        script = os.path.join(data_dir, "script.txt")
+        with open(script, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        create_db(script)
+        return get_db_path(script)
+
+    def _stacks(self, db_filename):
+        db = open_index(db_filename)
+        filenames = sorted([record["filename"] for record in
+                            db.table("hdf5_stacks").all()])
+        db.close()
+        return filenames
+
+    def _assert_same_stacks(self, filenames):
+        for filename in filenames:
+            with h5py.File(os.path.join(self.tmp_dir, "files", filename),
+                           "r") as files_f, \
+                    h5py.File(os.path.join(self.tmp_dir, "store", filename),
+                              "r") as store_f:
+                files_grp = files_f["TomoNormalized"]
+                store_grp = store_f["TomoNormalized"]
+                self.assertEqual(sorted(files_grp.keys()),
+                                 sorted(store_grp.keys()))
+                for name in files_grp:
+                    np.testing.assert_array_equal(files_grp[name][...],
+                                                  store_grp[name][...])
+
+    def test_same_results_than_single_image_files(self):
+        files_db = self._acquire("files")
+        multiple_xrm_2_hdf5(files_db, cores=1)
+        copy2proc_multiple(files_db, cores=1)
+        crop_images(files_db, cores=1)
+        normalize_images(files_db, cores=1)
+        many_images_to_h5_stack(files_db, table_name="hdf5_proc",
+                                type_struct="normalized", cores=1)
+        normalized_stacks = self._stacks(files_db)
+        align_images(files_db, align_method='cv2.TM_SQDIFF_NORMED',
+                     cores=1)
+        average_image_groups(files_db, cores=1)
+        many_images_to_h5_stack(files_db, table_name="hdf5_averages",
+                                type_struct="normalized_multifocus",
+                                suffix="_FS", cores=1)
+        multifocus_stacks = self._stacks(files_db)
+
+        store_db = self._acquire("store")
+        xrm_to_store(store_db, cores=1)
+        crop_store(store_db)
+        normalize_store(store_db)
+        store_to_stack(store_db, type_struct="normalized")
+        self.assertEqual(self._stacks(store_db), normalized_stacks)
+        self.assertEqual(len(normalized_stacks), 2)
+        align_store(store_db, align_method='cv2.TM_SQDIFF_NORMED', cores=1)
+        average_store(store_db)
+        store_to_stack(store_db, table_name=STORE_AVERAGES_TABLE,
+                       type_struct="normalized_multifocus", suffix="_FS")
+        self.assertEqual(self._stacks(store_db), multifocus_stacks)
+
+        self._assert_same_stacks(normalized_stacks + multifocus_stacks)
+
+        # A single store for the date and sample, with a row per image
+        db = open_index(store_db)
+        records = db.table(STORE_TABLE).all()
+        db.close()
+        self.assertEqual(set([record["store"] for record in records]),
+                         set(["20191018_cell_store.hdf5"]))
+        self.assertEqual(sorted([record["row"] for record in records]),
+                         range(8))
+        with ImageStore(os.path.join(self.tmp_dir, "store",
+                                     "20191018_cell_store.hdf5"),
+                        "r") as store:
+            self.assertEqual(store.data.shape, (8, 46, 56))
+            self.assertEqual(store.data.attrs["step"], 4)
+
+    def test_rerun_and_append_after_processing(self):
+        store_db = self._acquire("store")
+        filename = os.path.join(self.tmp_dir, "store",
+                                "20191018_cell_store.hdf5")
+        xrm_to_store(store_db, cores=1)
+        crop_store(store_db)
+        normalize_store(store_db)
+        with ImageStore(filename, "r") as store:
+            normalized = store.data[...]
+
+        # Running the stages again rewrites their steps
+        create_db(os.path.join(self.tmp_dir, "store", "script.txt"))
+        xrm_to_store(store_db, cores=1)
+        crop_store(store_db)
+        normalize_store(store_db)
+        with ImageStore(filename, "r") as store:
+            self.assertEqual([dataset.name for dataset in store.steps()],
+                             ["/data_1", "/data_2", "/data_3"])
+            self.assertEqual(store.data.attrs["step"], 3)
+            np.testing.assert_array_equal(store.data[...], normalized)
+
+        # Images arriving after the processing are added to all the steps
+        with ImageStore(filename) as store:
+            rows = store.append(store.read([0], dataset="data_1"),
+                                store.metadata([0]))
+            self.assertEqual(rows, [8])
+            self.assertEqual([dataset.shape for dataset in store.steps()],
+                             [(9, 96, 96), (9, 46, 56), (9, 46, 56)])
+        crop_store(store_db)
+        with ImageStore(filename, "r") as store:
+            # The normalization is removed, as computed from the old crop
+            self.assertEqual(store.data.attrs["dataset"], "data_2")
+            self.assertEqual(store.data.attrs["operation"], "crop")
+            np.testing.assert_array_equal(store.data[8], store.data[0])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.util import Executor
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.images.imagestostack import (many_images_to_h5_stack,
+                                               materialize_stack)
+
+
+class VirtualStackTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_filename = os.path.join(self.tmp_dir, "index.json")
+        random = np.random.RandomState(1)
+        records = []
+        for angle in (10.0, -10.0, 0.0):
+            records.append({"filename": "cell_%.1f_proc.hdf5" % angle,
+                            "angle": angle, "FF": False})
+        for i in range(2):
+            records.append({"filename": "cell_FF_%d_proc.hdf5" % i,
+                            "angle": 0.0, "FF": True})
+        for i, record in enumerate(records):
+            record.update({"date": 20191018, "sample": "cell",
+                           "energy": 520.0, "zpz": 0.0})
+            with h5py.File(os.path.join(self.tmp_dir, record["filename"]),
+                           "w") as f:
+                f.create_dataset("data_1", data=random.rand(8, 6))
+                f["data"] = h5py.SoftLink("data_1")
+                metadata = f.create_group("metadata")
+                for name, value in (("angle", record["angle"]),
+                                    ("energy", 520.0),
+                                    ("exposure_time", 1.0 + i),
+                                    ("machine_current", 250.0 - i),
+                                    ("pixel_size", 0.01)):
+                    metadata.create_dataset(name, data=value)
+        db = open_index(self.db_filename)
+        db.table("hdf5_proc").insert_multiple(records)
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_stack(self, name, virtual=False, cores=1, executor=None):
+        many_images_to_h5_stack(self.db_filename, table_name="hdf5_proc",
+                                type_struct="normalized", cores=cores,
+                                virtual=virtual, executor=executor)
+        stack_filename = os.path.join(self.tmp_dir,
+                                      "20191018_cell_520.0_0.0_stack.hdf5")
+        copy_filename = os.path.join(self.tmp_dir, name + ".hdf5")
+        os.rename(stack_filename, copy_filename)
+        return copy_filename
+
+    def _assert_same_stacks(self, filename_1, filename_2):
+        with h5py.File(filename_1, "r") as f_1, \
+                h5py.File(filename_2, "r") as f_2:
+            grp_1 = f_1["TomoNormalized"]
+            grp_2 = f_2["TomoNormalized"]
+            self.assertEqual(sorted(grp_1.keys()), sorted(grp_2.keys()))
+            for name in grp_1:
+                np.testing.assert_array_equal(grp_1[name][...],
+                                              grp_2[name][...])
+                self.assertEqual(grp_1[name].dtype, grp_2[name].dtype)
+
+    def test_virtual_stack(self):
+        copy_filename = self._make_stack("copy")
+        virtual_filename = self._make_stack("virtual", virtual=True)
+        self._assert_same_stacks(copy_filename, virtual_filename)
+        with h5py.File(virtual_filename, "r") as f:
+            self.assertTrue(f["TomoNormalized/TomoNormalized"].is_virtual)
+            self.assertEqual(
+                f["TomoNormalized/TomoNormalized"].attrs["Number of Frames"],
+                3)
+
+        self.assertEqual(sorted(materialize_stack(virtual_filename)),
+                         ["TomoNormalized/FFNormalizedWithCurrent",
+                          "TomoNormalized/TomoNormalized"])
+        for filename in os.listdir(self.tmp_dir):
+            if filename.endswith("_proc.hdf5"):
+                os.remove(os.path.join(self.tmp_dir, filename))
+        # The materialized stack does not need the single image files
+        with h5py.File(virtual_filename, "r") as f:
+            self.assertFalse(f["TomoNormalized/TomoNormalized"].is_virtual)
+        self._assert_same_stacks(copy_filename, virtual_filename)
+
+    def test_read_ahead_stack(self):
+        # A single stack: its images are read by a pool of 3 processes
+        copy_filename = self._make_stack("copy")
+        read_ahead_filename = self._make_stack("read_ahead", cores=3)
+        self._assert_same_stacks(copy_filename, read_ahead_filename)
+        # With a threads executor, they are read by a pool of threads
+        with Executor("threads", cores=3) as executor:
+            threads_filename = self._make_stack("threads", executor=executor)
+        self._assert_same_stacks(copy_filename, threads_filename)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib import mosaicnex
+from txm2nexuslib.test.synthetic import write_xrm_file
+
+
+class MosaicNexTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.block_bytes = mosaicnex.BLOCK_BYTES
+
+    def tearDown(self):
+        mosaicnex.BLOCK_BYTES = self.block_bytes
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rows_per_block(self):
+        mosaicnex.BLOCK_BYTES = 1000 * 200
+        self.assertEqual(mosaicnex._rows_per_block(200), 768)
+        self.assertEqual(mosaicnex._rows_per_block(2000), 256)
+
+    def test_convert_mosaic_by_blocks(self):
+        # Blocks of 256 rows of a mosaic of 700 rows: the last block is
+        # partial and its height is not a multiple of the pyramid factors
+        mosaicnex.BLOCK_BYTES = 300 * 2 * 100
+        random = np.random.RandomState(0)
+        image = (random.rand(700, 100) * 3000 + 200).astype(np.uint16)
+        filename = os.path.join(self.tmp_dir, "mosaic.xrm")
+        write_xrm_file(filename, image)
+
+        nexusmosaic = mosaicnex.MosaicNex([filename], 's', pyramid=True)
+        nexusmosaic.NXmosaic_structure()
+        nexusmosaic.convert_metadata()
+        nexusmosaic.convert_mosaic()
+        nexusmosaic.mosaichdf.close()
+
+        # The xrm images are stored upside down
+        expected = np.flipud(image)
+        with h5py.File(os.path.join(self.tmp_dir, "mosaic.hdf5"), "r") as f:
+            sample_grp = f["NXmosaic/instrument/sample"]
+            np.testing.assert_array_equal(sample_grp["data"][...], expected)
+            for factor in mosaicnex.PYRAMID_FACTORS:
+                level = sample_grp["pyramid/%dx" % factor]
+                self.assertEqual(level.attrs["Downsampling"], factor)
+                np.testing.assert_allclose(
+                    level[...], mosaicnex._downsample(expected, factor),
+                    rtol=1e-6)
+            self.assertEqual(sample_grp["pyramid/8x"].shape, (87, 12))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.tomonorm import TomoNormalize
+from txm2nexuslib.mosaicnorm import MosaicNormalize
+
+
+def write_nxmosaic(filename, ff_shape=(100, 64), tiles=(3, 3), seed=0):
+    """Write a synthetic mosaic in the NXmosaic layout of mosaic2nexus"""
+    random = np.random.RandomState(seed)
+    mosaic_shape = (ff_shape[0] * tiles[0], ff_shape[1] * tiles[1])
+    with h5py.File(filename, "w") as f:
+        nxmosaic = f.create_group("NXmosaic")
+        nxmosaic.create_dataset("sample/rotation_angle", data=[0.0])
+        instrument = nxmosaic.create_group("instrument")
+        instrument.create_dataset("source/energy", data=[520.0])
+        instrument["sample/data"] = (random.rand(*mosaic_shape) * 3000 +
+                                     200).astype(np.uint16)
+        instrument["bright_field/data"] = (random.rand(*ff_shape) * 1000 +
+                                           4000).astype(np.uint16)
+
+
+class MosaicNormalizeTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_normalize_by_blocks(self):
+        # 300 rows: a block of 256 rows within the budget of 1 MB, and a
+        # last block of 44 rows starting in the middle of a FF image
+        filename = os.path.join(self.tmp_dir, "mosaic.hdf5")
+        write_nxmosaic(filename)
+        normalizer = MosaicNormalize(filename, ratio=1.5, memory=1)
+        normalizer.normalizeMosaic()
+
+        # Normalization of the whole image at once
+        with h5py.File(filename, "r") as f:
+            mosaic = f["NXmosaic/instrument/sample/data"][...]
+            ff_image = f["NXmosaic/instrument/bright_field/data"][...]
+        collage_ff = np.tile(ff_image, (3, 3)).astype(float)
+        expected = np.array(mosaic.astype(float) / (collage_ff * 1.5),
+                            dtype=np.float32)
+
+        output = os.path.join(self.tmp_dir, "mosaic_mosaicnorm.hdf5")
+        with h5py.File(output, "r") as f:
+            normalized = f["MosaicNormalized/mosaic_normalized"]
+            self.assertEqual(normalized.chunks, (256, 192))
+            np.testing.assert_allclose(normalized[...], expected,
+                                       rtol=1e-6)
+        self.assertEqual(normalizer._rows_per_block(256), 256)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from txm2nexuslib.OleFileIO_PL import (OleFileIO, _index_cache,
+                                       set_index_cache_size)
+from txm2nexuslib.test.synthetic import write_ole_file
+
+
+class OleFileIOMmapTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ole_fn = os.path.join(self.tmp_dir, "container.ole")
+        random = np.random.RandomState(0)
+        self.streams = {
+            "Info/Small": random.bytes(100),
+            "Info/Empty": b"",
+            "Data/Big1": random.bytes(10000),
+            "Data/Big2": random.bytes(7001),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _check_streams(self, fragmented):
+        write_ole_file(self.ole_fn, self.streams, fragmented=fragmented)
+        ole = OleFileIO(self.ole_fn, use_mmap=True)
+        ole_ref = OleFileIO(self.ole_fn)
+        try:
+            for name, data in self.streams.items():
+                stream = ole.openstream(name)
+                self.assertEqual(stream.size, len(data))
+                self.assertEqual(bytes(stream.getbuffer()), data)
+                self.assertEqual(stream.read(10), data[:10])
+                self.assertEqual(stream.read(), data[10:])
+                self.assertEqual(ole_ref.openstream(name).read(), data)
+        finally:
+            ole.close()
+            ole_ref.close()
+
+    def test_contiguous_streams(self):
+        self._check_streams(fragmented=False)
+
+    def test_fragmented_streams(self):
+        self._check_streams(fragmented=True)
+
+    def test_zero_copy_view_outlives_close(self):
+        write_ole_file(self.ole_fn, self.streams)
+        ole = OleFileIO(self.ole_fn, use_mmap=True)
+        buf = ole.openstream("Data/Big1").getbuffer()
+        self.assertNotIsInstance(buf, bytes)
+        view = np.frombuffer(buf, dtype=np.uint8)
+        ole.close()
+        expected = np.frombuffer(self.streams["Data/Big1"], dtype=np.uint8)
+        np.testing.assert_array_equal(view, expected)
+
+
+class OleIndexCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ole_fn = os.path.join(self.tmp_dir, "container.ole")
+        write_ole_file(self.ole_fn, {"Info/Small": b"small",
+                                     "Data/Big": b"x" * 5000})
+        self.max_bytes = _index_cache.max_bytes
+        _index_cache.clear()
+
+    def tearDown(self):
+        set_index_cache_size(self.max_bytes)
+        _index_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reopen_reuses_index(self):
+        ole = OleFileIO(self.ole_fn)
+        self.assertEqual(ole.openstream("Info/Small").read(), b"small")
+        ole.close()
+        ole2 = OleFileIO(self.ole_fn, use_mmap=True)
+        self.assertIs(ole2.root, ole.root)
+        self.assertIs(ole2.minifat, ole.minifat)
+        self.assertEqual(ole2.openstream("Info/Small").read(), b"small")
+        self.assertEqual(ole2.openstream("Data/Big").read(), b"x" * 5000)
+        ole2.close()
+
+    def test_modified_file_is_parsed_again(self):
+        ole = OleFileIO(self.ole_fn)
+        ole.close()
+        write_ole_file(self.ole_fn, {"Info/Small": b"other",
+                                     "Data/Big": b"y" * 9000})
+        ole2 = OleFileIO(self.ole_fn)
+        self.assertIsNot(ole2.root, ole.root)
+        self.assertEqual(ole2.openstream("Data/Big").read(), b"y" * 9000)
+        ole2.close()
+
+    def test_memory_cap(self):
+        set_index_cache_size(0)
+        OleFileIO(self.ole_fn).close()
+        self.assertEqual(len(_index_cache), 0)
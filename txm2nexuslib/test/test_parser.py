@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from txm2nexuslib.parser import (FilesPathsIndex, get_file_paths, get_db,
+                                 PARSER_TABLE)
+
+
+class FilesPathsIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.root_path = tempfile.mkdtemp()
+        for subfolder in ("a", os.path.join("a", "b"), "c"):
+            os.mkdir(os.path.join(self.root_path, subfolder))
+        self.files = [os.path.join(self.root_path, "a", "image_1.xrm"),
+                      os.path.join(self.root_path, "a", "b", "image_2.xrm"),
+                      os.path.join(self.root_path, "c", "image_2.xrm")]
+        for filename in self.files:
+            open(filename, "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_path)
+
+    def test_find(self):
+        paths_index = FilesPathsIndex(self.root_path)
+        paths_index.refresh()
+        self.assertEqual(paths_index.find("image_1.xrm"), self.files[:1])
+        self.assertEqual(paths_index.find("image_2.xrm"), self.files[1:])
+        self.assertEqual(paths_index.find("image_*.xrm"), self.files)
+        self.assertEqual(paths_index.find("image_3.xrm"), [])
+        self.assertTrue(os.path.isfile(paths_index.index_file))
+
+        # The stored index is used, and the modified folders listed again
+        new_file = os.path.join(self.root_path, "c", "image_3.xrm")
+        open(new_file, "w").close()
+        paths_index = FilesPathsIndex(self.root_path)
+        self.assertEqual(paths_index.find("image_1.xrm"), self.files[:1])
+        paths_index.refresh()
+        self.assertEqual(paths_index.find("image_3.xrm"), [new_file])
+        shutil.rmtree(os.path.join(self.root_path, "a", "b"))
+        paths_index.refresh()
+        self.assertEqual(paths_index.find("image_2.xrm"), self.files[2:])
+
+    def test_index_file_not_writable(self):
+        index_file = os.path.join(self.root_path, "missing", "paths.json")
+        paths_index = FilesPathsIndex(self.root_path, index_file=index_file)
+        paths_index.refresh()
+        self.assertEqual(paths_index.find("image_1.xrm"), self.files[:1])
+        self.assertFalse(os.path.exists(index_file))
+
+    def test_get_file_paths(self):
+        records = [{"filename": "image_1.xrm", "subfolder": "a"},
+                   {"filename": "image_2.xrm", "subfolder": "a"},
+                   {"filename": "image_2.xrm", "subfolder": "c"}]
+        self.assertEqual(get_file_paths(records, self.root_path),
+                         [self.files[0], self.files[2]])
+        self.assertEqual(len(get_file_paths(records, self.root_path,
+                                            only_existing_files=False)), 3)
+        records = [{"filename": "image_2.xrm"}]
+        self.assertEqual(get_file_paths(records, self.root_path),
+                         self.files[1:])
+
+
+SCRIPT = """moveto energy 520.0
+moveto T -10.0
+collect 20191018_cell_-10.0.xrm
+collect 20191018_cell_-10.0_1.xrm
+moveto T 0.0
+collect 20191018_cell_0.0.xrm
+"""
+
+APPENDED = """collect 20191018_cell_0.0_1.xrm
+moveto energy 525.0
+collect 20191018_cell_0.0_2.xrm
+"""
+
+
+class IncrementalParsingTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmp_dir, "script.txt")
+        with open(self.script, "w") as f:
+            f.write(SCRIPT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _append(self, text):
+        with open(self.script, "a") as f:
+            f.write(text)
+
+    def _records(self, incremental):
+        db = get_db(self.script, incremental=incremental)
+        records = [(record["filename"], record["angle"], record["energy"],
+                    record["repetition"], record["processed"])
+                   for record in db.all()]
+        db.close()
+        return records
+
+    def test_incremental(self):
+        self.assertEqual(len(self._records(incremental=True)), 3)
+        db = get_db(self.script, use_existing_db=True)
+        db.update({"processed": True}, doc_ids=[1])
+        db.table("hdf5_raw").insert({"filename": "20191018_cell_-10.0.h5"})
+        db.close()
+
+        # The last line of the script is not completely written yet
+        self._append(APPENDED[:20])
+        self._records(incremental=True)
+        self._append(APPENDED[20:])
+        records = self._records(incremental=True)
+        self.assertEqual(records[0][-1], True)
+        self.assertEqual(records[1:], self._records(incremental=False)[1:])
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records[3], ("20191018_cell_0.0_1.xrm", 0.0, 520.0,
+                                      1, False))
+        self.assertEqual(records[4][2:4], (525.0, 0))
+
+        db = get_db(self.script, use_existing_db=True)
+        self.assertEqual(len(db.table("hdf5_raw")), 1)
+        self.assertEqual(len(db.table(PARSER_TABLE)), 1)
+        db.close()
+
+        # A modified script is parsed again completely
+        with open(self.script, "w") as f:
+            f.write(SCRIPT.replace("-10.0", "-20.0"))
+        records = self._records(incremental=True)
+        self.assertEqual([record[1] for record in records],
+                         [-20.0, -20.0, 0.0])
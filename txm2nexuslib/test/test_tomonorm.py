@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.tomonorm import TomoNormalize
+
+
+# Frames of 200x256 pixels: with a budget of 1 MB the images are
+# normalized one by one and the FF are reduced by tiles of 64 rows
+SHAPE = (200, 256)
+
+
+def write_nxtomo(filename, nframes=5, nff=4, ndf=0, outliers=0, seed=0):
+    """Write a synthetic tomography in the NXtomo layout of txrm2nexus.
+    outliers FF pixels are set to random values far from the others."""
+    random = np.random.RandomState(seed)
+    with h5py.File(filename, "w") as f:
+        nxtomo = f.create_group("NXtomo")
+        nxtomo.create_dataset("sample/rotation_angle",
+                              data=np.linspace(-60, 60, nframes))
+        instrument = nxtomo.create_group("instrument")
+        instrument.create_dataset("source/energy",
+                                  data=np.full(nframes, 520.0))
+        sample = instrument.create_group("sample")
+        sample["data"] = (random.rand(nframes, *SHAPE) * 3000 +
+                          200).astype(np.uint16)
+        sample["current"] = 250.0 - random.rand(nframes)
+        sample["ExpTimes"] = 1.0 + 0.1 * random.rand(nframes)
+        sample["x_pixel_size"] = 0.01
+        sample["y_pixel_size"] = 0.01
+        bright_field = instrument.create_group("bright_field")
+        ff_data = random.rand(nff, *SHAPE) * 1000 + 4000
+        ff_data.flat[random.randint(0, ff_data.size, outliers)] = \
+            random.rand(outliers) * 60000
+        bright_field["data"] = ff_data.astype(np.uint16)
+        bright_field["current"] = 250.0 - random.rand(nff)
+        bright_field["ExpTimes"] = 1.0 + 0.1 * random.rand(nff)
+        if ndf:
+            dark_field = instrument.create_group("dark_field")
+            dark_field["data"] = (random.rand(ndf, *SHAPE) *
+                                  100).astype(np.uint16)
+            dark_field["ExpTimes"] = 1.0 + 0.1 * random.rand(ndf)
+
+
+def sigma_clipped_mean(values, sigma, iterations):
+    """Reference sigma-clipped mean of a 1D array: the values further
+    than sigma standard deviations from the mean of the kept values are
+    discarded, until none is discarded or the iterations are exhausted."""
+    kept = np.asarray(values, dtype=np.float64)
+    for _ in range(iterations):
+        inside = np.abs(kept - kept.mean()) <= sigma * kept.std()
+        if inside.all():
+            break
+        kept = kept[inside]
+    return kept.mean()
+
+
+class TomoNormalizeTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _normalize(self, name, memory, ndf=0, ff_reduction='mean', **kw):
+        filename = os.path.join(self.tmp_dir, name + ".hdf5")
+        write_nxtomo(filename, ndf=ndf, **kw)
+        normalizer = TomoNormalize(filename, 0, 1, 0, 1, 0, memory=memory,
+                                   ff_reduction=ff_reduction)
+        normalizer.normalize_tomo()
+        with h5py.File(normalizer.outputfilehdf5, "r") as f:
+            return dict((name, dataset[...]) for name, dataset in
+                        f["TomoNormalized"].items())
+
+    def _check_blocks(self, ndf=0, ff_reduction='mean'):
+        blocks = self._normalize("blocks", 1, ndf=ndf,
+                                 ff_reduction=ff_reduction)
+        whole = self._normalize("whole", 1024, ndf=ndf,
+                                ff_reduction=ff_reduction)
+        self.assertEqual(sorted(blocks), sorted(whole))
+        for name in whole:
+            np.testing.assert_allclose(blocks[name], whole[name],
+                                       rtol=1e-6, err_msg=name)
+
+    def test_frames_per_block(self):
+        filename = os.path.join(self.tmp_dir, "tomo.hdf5")
+        write_nxtomo(filename)
+        normalizer = TomoNormalize(filename, 0, 1, 0, 1, 0, memory=1)
+        data = normalizer.input_nexusfile["NXtomo/instrument/sample/data"]
+        ff = normalizer.input_nexusfile[
+            "NXtomo/instrument/bright_field/data"]
+        self.assertEqual(normalizer._frames_per_block(data), 1)
+        self.assertEqual(normalizer._rows_per_tile(ff), 64)
+        normalizer.memory = 1024
+        self.assertEqual(normalizer._frames_per_block(data), 5)
+        normalizer.input_nexusfile.close()
+        normalizer.tomonorm.close()
+
+    def test_normalize_by_blocks(self):
+        self._check_blocks()
+
+    def test_normalize_by_blocks_darkfield(self):
+        self._check_blocks(ndf=3)
+
+    def test_median_ff(self):
+        output = self._normalize("median", 1, nff=9, outliers=2000,
+                                 ff_reduction='median')
+        np.testing.assert_allclose(
+            output["AverageFF"], np.median(output["FFNormalized"], axis=0),
+            rtol=1e-6)
+
+    def test_sigmaclip_ff(self):
+        output = self._normalize("sigmaclip", 1, nff=20, outliers=4000,
+                                 ff_reduction='sigmaclip')
+        ff_frames = output["FFNormalized"].reshape(20, -1)
+        expected = [sigma_clipped_mean(ff_frames[:, i],
+                                       TomoNormalize.sigma_clip,
+                                       TomoNormalize.sigma_clip_iterations)
+                    for i in range(ff_frames.shape[1])]
+        np.testing.assert_allclose(output["AverageFF"].ravel(), expected,
+                                   rtol=1e-5)
+
+    def test_sigmaclip_rejection_is_cumulative(self):
+        filename = os.path.join(self.tmp_dir, "tomo.hdf5")
+        write_nxtomo(filename)
+        normalizer = TomoNormalize(filename, 0, 1, 0, 1, 0,
+                                   ff_reduction='sigmaclip')
+        normalizer.input_nexusfile.close()
+        normalizer.tomonorm.close()
+        normalizer.sigma_clip = 1.0
+        # Some of the values discarded in the first iterations would come
+        # back in the following ones if they were not remembered
+        values = np.array([-16.2, -1.8, -1.6, -1.5, -1.3, -1.0, -0.7, -0.6,
+                           -0.6, -0.5, -0.5, 0.6, 0.7, 0.7, 0.7, 1.0, 1.1,
+                           1.3, 1.5, 1.6, 1.9, 1.9, 6.5, 9.1],
+                          dtype=np.float32)
+        tile = values[:, np.newaxis, np.newaxis]
+        self.assertAlmostEqual(
+            normalizer._reduce_tile(tile)[0, 0],
+            sigma_clipped_mean(values, 1.0,
+                               normalizer.sigma_clip_iterations), 5)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.test.synthetic import write_xrm_file
+from txm2nexuslib.workflows.watch import AcquisitionWatcher
+
+
+class AcquisitionWatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmp_dir, "script.txt")
+        self.random = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _acquire(self, lines, filename=None, angle=0.0):
+        with open(self.script, "a") as f:
+            f.write(lines)
+        if filename is not None:
+            image = (self.random.rand(64, 64) * 1000 + 100).astype(np.uint16)
+            write_xrm_file(os.path.join(self.tmp_dir, filename), image,
+                           angle=angle, energy=520.0)
+
+    def test_watch(self):
+        self._acquire("moveto energy 520.0\n")
+        for angle in (-10.0, 0.0, 10.0):
+            filename = "20191018_cell_%.1f.xrm" % angle
+            self._acquire("moveto T %.1f\ncollect %s\n" % (angle, filename),
+                          filename, angle)
+        watcher = AcquisitionWatcher(self.script, settle_time=0.0, cores=1)
+        # The files are complete once they are unchanged between two polls
+        self.assertFalse(watcher.poll())
+        self.assertTrue(watcher.poll())
+        self.assertEqual(len(watcher.converted), 3)
+
+        # The FF are not complete while they are the last images acquired
+        self._acquire("collect 20191018_cell_FF.xrm\n",
+                      "20191018_cell_FF.xrm")
+        watcher.poll()
+        watcher.poll()
+        self.assertEqual(len(watcher.converted), 4)
+        self.assertEqual(watcher.normalized, set())
+        # The files converted in the previous polls are kept in the index
+        db = open_index(watcher.db_filename)
+        for table, suffix in (("hdf5_raw", ""), ("hdf5_proc", "_proc")):
+            self.assertEqual(
+                sorted([record["filename"]
+                        for record in db.table(table).all()]),
+                ["20191018_cell_%s%s.hdf5" % (name, suffix)
+                 for name in ("-10.0", "0.0", "10.0", "FF")])
+        db.close()
+
+        # The angle series is closed when the acquisition moves on
+        self._acquire("moveto energy 525.0\n"
+                      "collect 20191018_cell_0.0_525.xrm\n")
+        self.assertTrue(watcher.poll())
+        self.assertEqual(len(watcher.normalized), 3)
+        self.assertEqual(watcher.stacked, set([(20191018, "cell", 520.0)]))
+        stack_file = os.path.join(self.tmp_dir,
+                                  "20191018_cell_520.0_None_stack.hdf5")
+        # Images cropped with the default roi
+        with h5py.File(stack_file, "r") as f:
+            self.assertEqual(f["TomoNormalized/TomoNormalized"].shape,
+                             (3, 14, 24))
+
+        # The progress is kept by a new watcher
+        watcher = AcquisitionWatcher(self.script, settle_time=0.0, cores=1)
+        self.assertFalse(watcher.poll())
+        self.assertEqual(len(watcher.normalized), 3)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+# This file is part of bl09-imaging (formerly txrm2nexus)
+##
+# Copyright 2019 CELLS / ALBA Synchrotron, Bellaterra, Spain
+##
+# bl09-imaging is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# bl09-imaging is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+##
+# You should have received a copy of the GNU Lesser General Public License
+# along with Taurus.  If not, see <http://www.gnu.org/licenses/>.
+##
+#############################################################################
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import h5py
+import numpy as np
+
+from txm2nexuslib.xrmnex import XradiaFile, xrmNXtomo, xrmReader
+from txm2nexuslib.test.synthetic import (write_xrm_file, write_ole_file,
+                                         xrm_streams)
+
+
+class XradiaFileImageTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xrm_fn = os.path.join(self.tmp_dir, "image.xrm")
+        self.image = np.arange(64 * 48, dtype=np.uint16).reshape(64, 48)
+        write_xrm_file(self.xrm_fn, self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_image_2D(self):
+        with XradiaFile(self.xrm_fn) as xrm_file:
+            image = xrm_file.get_image_2D()
+        self.assertEqual(image.dtype, np.uint16)
+        np.testing.assert_array_equal(image, self.image)
+
+    def test_get_image(self):
+        with XradiaFile(self.xrm_fn) as xrm_file:
+            image = xrm_file.get_image()
+        self.assertEqual(image.shape, (1, 64, 48))
+        np.testing.assert_array_equal(image[0], self.image)
+
+    def test_get_image_out(self):
+        stack = np.zeros((3, 64, 48), dtype=np.float32)
+        with XradiaFile(self.xrm_fn) as xrm_file:
+            returned = xrm_file.get_image_2D(out=stack[1])
+        self.assertIs(returned.base, stack)
+        np.testing.assert_array_equal(stack[1], self.image)
+        self.assertFalse(stack[0].any() or stack[2].any())
+
+    def test_get_image_float(self):
+        image = np.random.rand(16, 20).astype(np.float32)
+        write_xrm_file(self.xrm_fn, image)
+        with XradiaFile(self.xrm_fn) as xrm_file:
+            self.assertEqual(xrm_file.data_type, 'float')
+            np.testing.assert_array_equal(xrm_file.get_image_2D(), image)
+
+
+class xrmNXtomoTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.angles = [-10.0, 0.0, 10.0]
+        self.images = np.random.randint(
+            0, 4000, (len(self.angles), 32, 24)).astype(np.uint16)
+        self.sample_files = []
+        for i, angle in enumerate(self.angles):
+            fn = os.path.join(self.tmp_dir,
+                              "20191018_tomo01_520.0_%.1f.xrm" % angle)
+            write_xrm_file(fn, self.images[i], angle=angle,
+                           energy=520.0, current=200.0 + i,
+                           date="10/18/19 10:00:%02d" % i)
+            self.sample_files.append(fn)
+        self.ff_files = []
+        for i in range(2):
+            fn = os.path.join(self.tmp_dir,
+                              "20191018_tomo01_520.0_FF_%i.xrm" % i)
+            write_xrm_file(fn, np.full((32, 24), 3000 + i, np.uint16),
+                           exp_time=2.0, energy=520.0)
+            self.ff_files.append(fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_harvest_metadata(self):
+        metadata = xrmReader(self.sample_files).harvest_metadata()
+        self.assertIsInstance(metadata["angles"], np.ndarray)
+        np.testing.assert_array_equal(metadata["angles"], self.angles)
+        np.testing.assert_array_equal(metadata["machine_currents"],
+                                      [200.0, 201.0, 202.0])
+        self.assertEqual(list(metadata["dates"]),
+                         ["2019-10-18T10:00:0%i" % i for i in range(3)])
+        self.assertEqual(list(metadata["image_height"]), [32] * 3)
+
+    def test_harvest_metadata_errors_by_file(self):
+        # The pixel size and the angle cannot be read in the last file
+        streams = xrm_streams(self.images[-1], angle=20.0, energy=520.0)
+        del streams['ImageInfo/PixelSize']
+        del streams['ImageInfo/Angles']
+        fn = os.path.join(self.tmp_dir, "20191018_tomo01_520.0_20.0.xrm")
+        write_ole_file(fn, streams)
+        reader = xrmReader(self.sample_files + [fn])
+        metadata = reader.harvest_metadata()
+        np.testing.assert_array_equal(metadata["angles"].mask,
+                                      [False] * 3 + [True])
+        np.testing.assert_array_equal(metadata["angles"][:3], self.angles)
+        np.testing.assert_array_equal(metadata["pixel_size"].mask,
+                                      [False] * 3 + [True])
+        np.testing.assert_array_equal(metadata["energies"], [520.0] * 4)
+        # The values of the first file are still available
+        self.assertAlmostEqual(reader.get_pixel_size(), 0.01)
+        self.assertIsInstance(reader.get_machine_currents(), list)
+        self.assertRaises(RuntimeError, reader.get_angles)
+
+    def test_convert_tomography(self, workers=1):
+        reader = xrmReader(self.sample_files)
+        converter = xrmNXtomo(reader, xrmReader(self.ff_files), "sb",
+                              "xrm2nexus", hdf5_output_path=self.tmp_dir,
+                              workers=workers)
+        converter.convert_metadata()
+        converter.convert_tomography()
+        with h5py.File(converter.hdf5_file_name, "r") as f:
+            np.testing.assert_array_equal(
+                f["NXtomo/instrument/sample/data"][...], self.images)
+            np.testing.assert_array_equal(
+                f["NXtomo/sample/rotation_angle"][...], self.angles)
+            self.assertEqual(f["NXtomo/instrument/bright_field/data"].shape,
+                             (2, 32, 24))
+            self.assertEqual(f["NXtomo/start_time"][()],
+                             "2019-10-18T10:00:00")
+            self.assertEqual(f["NXtomo/end_time"][()],
+                             "2019-10-18T10:00:02")
+
+    def test_convert_tomography_parallel(self):
+        self.test_convert_tomography(workers=2)
@@ -25,8 +25,16 @@ import h5py
 
 class TomoNormalize:
 
+    # Reductions of the FF stack to the FF image used for normalization
+    FF_REDUCTIONS = ('mean', 'median', 'sigmaclip')
+    # Number of standard deviations and maximum number of iterations of
+    # the sigma-clipped mean
+    sigma_clip = 3.0
+    sigma_clip_iterations = 5
+
     def __init__(self, inputfile, darkfield, avgtomnorm,
-                 gaussianblur, avgff, diffraction):
+                 gaussianblur, avgff, diffraction, memory=1024,
+                 ff_reduction='mean'):
 
         self.filename_nexus = inputfile
         self.input_nexusfile = h5py.File(self.filename_nexus, 'r')
@@ -85,8 +93,150 @@ class TomoNormalize:
         self.avgff = avgff
         self.gaussianblur = gaussianblur
         self.diffraction = diffraction
+        # Memory budget (MB) of the blocks of frames processed at once
+        self.memory = memory
+        if ff_reduction not in self.FF_REDUCTIONS:
+            raise ValueError("Unknown FF reduction %s: use one of %s" %
+                             (ff_reduction, ", ".join(self.FF_REDUCTIONS)))
+        self.ff_reduction = ff_reduction
         return
 
+    def _frames_per_block(self, dataset):
+        """Number of frames of dataset which can be processed at once
+        within the memory budget: the blocks are read as float32, and a
+        few single images (averages, accumulators) are kept along."""
+        pixels = dataset.shape[1] * dataset.shape[2]
+        budget = self.memory * 1024 * 1024 - 24 * pixels
+        return int(max(1, min(dataset.shape[0], budget // (4 * pixels))))
+
+    def _read_block(self, dataset, start, stop, block):
+        """Read frames [start, stop) of dataset as float32 in block"""
+        data = block[:stop - start]
+        dataset.read_direct(data, np.s_[start:stop])
+        return data
+
+    def _normalize_stack(self, dataset, scales, output_name=None,
+                         average=True):
+        """Divide each frame of dataset by its scale, streaming blocks of
+        frames. The normalized frames are written in the output_name
+        dataset (if given); the average normalized frame is returned if
+        average is True."""
+        nframes, numrows, numcols = dataset.shape
+        scales = np.asarray(scales, dtype=np.float32)
+        if output_name is not None:
+            output = self.norm_grp.create_dataset(
+                output_name,
+                shape=(nframes, numrows, numcols),
+                chunks=(1, numrows, numcols),
+                dtype='float32')
+            output.attrs['Number of Frames'] = nframes
+        sum_frames = np.zeros((numrows, numcols), dtype=np.float64)
+        frames_per_block = self._frames_per_block(dataset)
+        block = np.empty((frames_per_block, numrows, numcols),
+                         dtype=np.float32)
+        for start in range(0, nframes, frames_per_block):
+            stop = min(start + frames_per_block, nframes)
+            data = self._read_block(dataset, start, stop, block)
+            data /= scales[start:stop, np.newaxis, np.newaxis]
+            if output_name is not None:
+                output[start:stop] = data
+            if average:
+                sum_frames += data.sum(axis=0, dtype=np.float64)
+        if average:
+            return np.array(sum_frames / nframes, dtype=np.float32)
+
+    def _rows_per_tile(self, dataset):
+        """Number of rows of all the frames of dataset which can be
+        reduced at once within the memory budget: the sigma-clipped mean
+        keeps a few temporaries of the size of the tile."""
+        row_bytes = 4 * 4 * dataset.shape[0] * dataset.shape[2]
+        budget = self.memory * 1024 * 1024
+        return int(max(1, min(dataset.shape[1], budget // row_bytes)))
+
+    def _reduce_tile(self, tile):
+        """Reduce a tile of frames (frames, rows, cols) along the frames.
+        The values rejected by the sigma clipping stay rejected in the
+        following iterations."""
+        if self.ff_reduction == 'median':
+            return np.median(tile, axis=0)
+        mask = np.ones(tile.shape, dtype=bool)
+        for _ in range(self.sigma_clip_iterations):
+            counts = np.maximum(mask.sum(axis=0), 1)
+            mean = np.where(mask, tile, 0).sum(axis=0,
+                                               dtype=np.float64) / counts
+            deviations = np.abs(tile - mean.astype(np.float32))
+            std = np.sqrt((np.where(mask, deviations, 0) ** 2).sum(
+                axis=0, dtype=np.float64) / counts)
+            new_mask = mask & (deviations <= self.sigma_clip * std)
+            if np.array_equal(new_mask, mask):
+                break
+            mask = new_mask
+        counts = np.maximum(mask.sum(axis=0), 1)
+        return np.where(mask, tile, 0).sum(axis=0, dtype=np.float64) / counts
+
+    def _reduce_stack(self, dataset, scales):
+        """Median or sigma-clipped mean of the frames of dataset, each one
+        divided by its scale. The statistics need all the frames of a
+        pixel: the stack is read by tiles of rows of all the frames."""
+        nframes, numrows, numcols = dataset.shape
+        scales = np.asarray(scales, dtype=np.float32)
+        reduced = np.empty((numrows, numcols), dtype=np.float32)
+        rows_per_tile = self._rows_per_tile(dataset)
+        tile = np.empty((nframes, rows_per_tile, numcols), dtype=np.float32)
+        for start in range(0, numrows, rows_per_tile):
+            stop = min(start + rows_per_tile, numrows)
+            data = tile[:, :stop - start]
+            if stop - start == rows_per_tile:
+                dataset.read_direct(data, np.s_[:, start:stop])
+            else:
+                data = dataset[:, start:stop].astype(np.float32)
+            data /= scales[:, np.newaxis, np.newaxis]
+            reduced[start:stop] = self._reduce_tile(data)
+        return reduced
+
+    def _average_ff(self, dataset, scales, output_name=None):
+        """Normalize the FF frames by their scales (written in output_name
+        if given) and reduce them to a single FF image, using the selected
+        FF reduction mode."""
+        if self.ff_reduction == 'mean':
+            return self._normalize_stack(dataset, scales,
+                                         output_name=output_name)
+        if output_name is not None:
+            self._normalize_stack(dataset, scales, output_name=output_name,
+                                  average=False)
+        print('Reducing the FF images with the %s' % self.ff_reduction)
+        return self._reduce_stack(dataset, scales)
+
+    def _normalize_tomo_images(self, sample_image_data, scales,
+                               averageff, averagedf=None):
+        """Normalize the sample images, streaming blocks of frames:
+        norm[i] = img[i]/scale[i] / FF, or if a DF is given,
+        norm[i] = (img[i]/scale[i] - DF) / (FF - DF).
+        Returns the sum of the normalized images."""
+        scales = np.asarray(scales, dtype=np.float32)
+        averageff = np.asarray(averageff, dtype=np.float32)
+        if averagedf is not None:
+            averagedf = np.asarray(averagedf, dtype=np.float32)
+            denominator = averageff - averagedf
+        else:
+            denominator = averageff
+        sum_normalized = np.zeros((self.numrows, self.numcols),
+                                  dtype=np.float64)
+        frames_per_block = self._frames_per_block(sample_image_data)
+        block = np.empty((frames_per_block, self.numrows, self.numcols),
+                         dtype=np.float32)
+        for start in range(0, self.nFramesSample, frames_per_block):
+            stop = min(start + frames_per_block, self.nFramesSample)
+            data = self._read_block(sample_image_data, start, stop, block)
+            data /= scales[start:stop, np.newaxis, np.newaxis]
+            if averagedf is not None:
+                data -= averagedf
+            data /= denominator
+            self.norm_grp['TomoNormalized'][start:stop] = data
+            sum_normalized += data.sum(axis=0, dtype=np.float64)
+            print('Images %d to %d have been normalized' % (start, stop - 1))
+        return sum_normalized
+
     def normalize_tomo(self):
 
         nxtomo_grp = self.input_nexusfile["NXtomo"]
@@ -155,7 +305,6 @@ class TomoNormalize:
         #############################
         self.exposuretimes_tomo = instrument_grp["sample"]["ExpTimes"].value
         self.norm_grp['ExpTimesTomo'] = self.exposuretimes_tomo
-        num_exptimes_tomo = len(self.exposuretimes_tomo)
 
         # Main Data
         sample_image_data = instrument_grp["sample"]["data"]
@@ -167,18 +316,15 @@ class TomoNormalize:
         self.numrows = infoshape[1]
         self.numcols = infoshape[2]
 
-        # FF Data (FlatField/BrightField data)
-        self.data_flatfield = FF_grp["data"].value
+        # FF Data (FlatField/BrightField data): the images are read by
+        # blocks when they are normalized
+        self.data_flatfield = FF_grp["data"]
         self.exptimes_FF = FF_grp["ExpTimes"].value
         self.norm_grp['ExpTimesFF'] = self.exptimes_FF
-        dimensions_singleimage_flatfield = self.data_flatfield[0].shape
-
-        self.ratios_exptimes = [None] * num_exptimes_tomo
+        dimensions_singleimage_flatfield = self.data_flatfield.shape[1:]
 
         # Average of the FF exposure times.
-        for i in range(len(self.exptimes_FF)):
-            self.avg_ff_exptime += self.exptimes_FF[i]
-        self.avg_ff_exptime /= len(self.exptimes_FF)
+        self.avg_ff_exptime = np.mean(self.exptimes_FF)
         print('\nFlatField Exposure Time is {0}\n'.format(
             self.avg_ff_exptime))
 
@@ -189,10 +335,10 @@ class TomoNormalize:
         # DF Data (DarkField data)
         if self.darkfield:
             DF_grp = instrument_grp["dark_field"]
-            self.data_darkfield = DF_grp["data"].value
+            self.data_darkfield = DF_grp["data"]
             self.exptimes_DF = DF_grp["ExpTimes"].value
             self.norm_grp['ExpTimesDF'] = self.exptimes_DF
-            dimensions_singleimage_darkfield = self.data_darkfield[0].shape
+            dimensions_singleimage_darkfield = self.data_darkfield.shape[1:]
 
             if dimensions_singleimage_tomo != \
                     dimensions_singleimage_darkfield:
@@ -202,9 +348,7 @@ class TomoNormalize:
                 raise msg
 
             # Average of the DF exposure times.
-            for i in range(len(self.exptimes_DF)):
-                self.avg_df_exptime += self.exptimes_DF[i]
-            self.avg_df_exptime /= len(self.exptimes_DF)
+            self.avg_df_exptime = np.mean(self.exptimes_DF)
             print('DarkField Exposure Time is {0}\n'.format(
                 self.avg_df_exptime))
 
@@ -224,69 +368,40 @@ class TomoNormalize:
             self.norm_grp['TomoNormalized'].attrs['Number of Frames'] = \
                 self.nFramesSample
 
-            avgnormalizedtomo = np.zeros(
-                (self.numrows, self.numcols), dtype=np.float)
-
-            self.averageff = np.zeros((self.numrowsFF, self.numcolsFF),
-                                      dtype=np.float)
-
             if self.boolean_current_exists and not self.darkfield:
                 print('\nInformation about currents is present in hdf5 file')
                 print('Tomography will be normalized taking into account '
                       'the ExposureTimes and the MachineCurrents\n')
 
-                num_currents_tomo = len(self.currents_tomo)
-                self.ratios_currents_tomo = [None]*num_currents_tomo
-
-                num_currents_flatfield = len(self.currents_flatfield)
-                self.ratios_currents_flatfield = [None]*num_currents_flatfield
-
                 if self.avgff == 1:
                     self.norm_grp['Avg_FF_ExpTime'] = self.avg_ff_exptime
 
                 # Getting the Ratios
-                for i in range(num_exptimes_tomo):
-                    self.ratios_exptimes[i] = self.exposuretimes_tomo[i] / \
-                                              self.avg_ff_exptime
-
-                for i in range(num_currents_tomo):
-                    self.ratios_currents_tomo[i] = self.currents_tomo[i] / \
-                                                   self.currents_tomo[0]
-
-                for i in range(num_currents_flatfield):
-                    self.ratios_currents_flatfield[i] = \
-                        self.currents_flatfield[i] / self.currents_tomo[0]
+                self.ratios_exptimes = (self.exposuretimes_tomo /
+                                        self.avg_ff_exptime)
+                self.ratios_currents_tomo = (self.currents_tomo /
+                                             self.currents_tomo[0])
+                self.ratios_currents_flatfield = (
+                    self.currents_flatfield[...] / self.currents_tomo[0])
 
                 # FlatField (FF) images normalized with current,
                 # and Average of FlatField Normalized with current
-                self.norm_grp.create_dataset(
-                    "FFNormalized",
-                    shape=(self.nFramesFF, self.numrowsFF, self.numcolsFF),
-                    chunks=(1, self.numrowsFF, self.numcolsFF),
-                    dtype='float32')
-
-                self.norm_grp["FFNormalized"].attrs[
-                    'Number of Frames'] = self.nFramesFF
-
-                for numimgFF in range(self.nFramesFF):
-                    image_FF_normalized_with_current = np.array(
-                        self.data_flatfield[numimgFF] /
-                        self.ratios_currents_flatfield[numimgFF],
-                        dtype=np.float)
-                    self.norm_grp['FFNormalized'][numimgFF] = \
-                        image_FF_normalized_with_current
-
-                    if self.avgff == 1:
-                        self.averageff += image_FF_normalized_with_current
-
-                    print('FF Image %d has been normalized using the '
-                          'machine_currents' % numimgFF)
+                if self.avgff == 1:
+                    self.averageff = self._average_ff(
+                        self.data_flatfield, self.ratios_currents_flatfield,
+                        output_name="FFNormalized")
+                else:
+                    self._normalize_stack(
+                        self.data_flatfield, self.ratios_currents_flatfield,
+                        output_name="FFNormalized", average=False)
+                print('%d FF images have been normalized using the '
+                      'machine_currents' % self.nFramesFF)
 
                 if self.avgff == 0:
                     self.averageff = np.array(
                         self.data_flatfield[0] /
                         self.ratios_currents_flatfield[0],
-                        dtype=np.float)
+                        dtype=np.float32)
                     print('\nFFs have been calculated '
                           'using the machine_currents\n')
 
@@ -295,11 +410,10 @@ class TomoNormalize:
                           'with diffraction pattern\n')
                     input_avgFF_diffract = h5py.File("saveFFonly.hdf5", 'r')
                     external_FF_grp = input_avgFF_diffract["FF"]
-                    self.averageff = external_FF_grp["FF_moved"]
+                    self.averageff = external_FF_grp["FF_moved"][...]
                     input_avgFF_diffract.close()
 
                 if self.avgff == 1:
-                    self.averageff = self.averageff/self.nFramesFF
                     if self.gaussianblur != 0:
                         from scipy import ndimage
                         self.averageff = ndimage.gaussian_filter(
@@ -308,19 +422,9 @@ class TomoNormalize:
                     print('\nAverageFF has been calculated '
                           'using the machine_currents\n')
 
-                for numimg in range(self.nFramesSample):
-                    individual_image = sample_image_data[numimg]
-                    normalizedtomo_singleimage = np.array(
-                        ((individual_image /
-                          self.ratios_currents_tomo[numimg]) /
-                         (self.averageff*self.ratios_exptimes[numimg])),
-                        dtype=np.float32)
-                    self.norm_grp['TomoNormalized'][numimg] = \
-                        normalizedtomo_singleimage
-                    if self.avgtomnorm == 1:
-                        avgnormalizedtomo += normalizedtomo_singleimage
-                    if numimg%10 == 0:
-                        print('Image %d has been normalized' % numimg)
+                scales = self.ratios_currents_tomo * self.ratios_exptimes
+                sum_normalized = self._normalize_tomo_images(
+                    sample_image_data, scales, self.averageff)
 
             elif self.boolean_current_exists and self.darkfield:
                 print('\nInformation about currents is present in hdf5 file')
@@ -333,26 +437,10 @@ class TomoNormalize:
 
                 # FlatField (FF) images normalized with its relative
                 # currents and exposure times:
-                self.norm_grp.create_dataset(
-                    "FFNormalized",
-                    shape=(self.nFramesFF, self.numrowsFF, self.numcolsFF),
-                    chunks=(1, self.numrowsFF, self.numcolsFF),
-                    dtype='float32')
-
-                self.norm_grp["FFNormalized"].attrs[
-                    'Number of Frames'] = self.nFramesFF
-
-                for numimgFF in range(self.nFramesFF):
-                    denominator = (self.currents_flatfield[numimgFF]
-                                   * self.exptimes_FF[numimgFF])
-                    image_FF_normalized = np.array(
-                        self.data_flatfield[numimgFF] / denominator,
-                        dtype=np.float)
-                    self.norm_grp['FFNormalized'][
-                        numimgFF] = image_FF_normalized
-                    self.averageff += image_FF_normalized
-
-                self.averageff = self.averageff/self.nFramesFF
+                self.averageff = self._average_ff(
+                    self.data_flatfield,
+                    self.currents_flatfield[...] * self.exptimes_FF,
+                    output_name="FFNormalized")
                 if self.gaussianblur != 0:
                     from scipy import ndimage
                     self.averageff = ndimage.gaussian_filter(
@@ -363,24 +451,9 @@ class TomoNormalize:
 
                 # DarkField (DF) images normalized with its relative
                 # exposure times:
-                self.norm_grp.create_dataset(
-                    "DFNormalized",
-                    shape=(self.nFramesDF, self.numrowsDF, self.numcolsDF),
-                    chunks=(1, self.numrowsDF, self.numcolsDF),
-                    dtype='float32')
-
-                self.norm_grp["DFNormalized"].attrs[
-                    'Number of Frames'] = self.nFramesDF
-
-                for numimgDF in range(self.nFramesDF):
-                    image_DF_normalized = np.array(
-                        self.data_darkfield[numimgDF]
-                        / self.exptimes_DF[numimgDF], dtype=np.float)
-                    self.norm_grp['DFNormalized'][
-                        numimgDF] = image_DF_normalized
-                    self.averagedf += image_DF_normalized
-
-                self.averagedf = self.averagedf/self.nFramesDF
+                self.averagedf = self._normalize_stack(
+                    self.data_darkfield, self.exptimes_DF,
+                    output_name="DFNormalized")
                 self.norm_grp['NormalizedDF'] = self.averagedf
                 print('\nNormalizedDF has been normalized'
                       ' using DF exposure times\n')
@@ -388,19 +461,10 @@ class TomoNormalize:
                 # Normalize images by applying:
                 # norm[i] =  [  ( img[i]/(eti*mci) - DF/etdf ) /
                 #               ( FF/(etff*mcff) - DF/etdf )     ]
-                for numimg in range(self.nFramesSample):
-                    individual_image = sample_image_data[numimg]
-                    den_img = (self.exposuretimes_tomo[numimg]
-                           * self.currents_tomo[numimg])
-                    numerator = individual_image / den_img - self.averagedf
-                    denominator = self.averageff - self.averagedf
-                    normalizedtomo_singleimage = np.array(
-                        (numerator / denominator), dtype=np.float32)
-                    self.norm_grp['TomoNormalized'][numimg] = \
-                        normalizedtomo_singleimage
-                    avgnormalizedtomo += normalizedtomo_singleimage
-                    if numimg%10 == 0:
-                        print('Image %d has been normalized' % numimg)
+                scales = self.exposuretimes_tomo * self.currents_tomo
+                sum_normalized = self._normalize_tomo_images(
+                    sample_image_data, scales, self.averageff,
+                    averagedf=self.averagedf)
 
             elif not self.boolean_current_exists:
                 print('\nInformation about currents is NOT present '
@@ -413,14 +477,12 @@ class TomoNormalize:
                           'with diffraction pattern\n')
                     input_avgFF_diffract = h5py.File("saveFFonly.hdf5", 'r')
                     external_FF_grp = input_avgFF_diffract["FF"]
-                    self.averageff = external_FF_grp["FF_moved"]
+                    self.averageff = external_FF_grp["FF_moved"][...]
                     input_avgFF_diffract.close()
 
                 if self.avgff == 1:
-                    for numimgFF in range (self.nFramesFF):
-                        self.averageff += \
-                            np.array(self.data_flatfield[numimgFF])
-                    self.averageff = self.averageff/self.nFramesFF
+                    self.averageff = self._average_ff(
+                        self.data_flatfield, np.ones(self.nFramesFF))
                     if self.gaussianblur != 0:
                         from scipy import ndimage
                         self.averageff = ndimage.gaussian_filter(
@@ -429,25 +491,14 @@ class TomoNormalize:
                     self.norm_grp['AverageFF'] = self.averageff
 
                 # Getting the Ratios of Exposure Times
-                for i in range(num_exptimes_tomo):
-                    self.ratios_exptimes[i] = self.exposuretimes_tomo[i] / \
-                                              self.avg_ff_exptime
-
-                for numimg in range(self.nFramesSample):
-                    individual_image = sample_image_data[numimg]
-                    normalizedtomo_singleimage = np.array(
-                        (individual_image /
-                         (self.averageff*self.ratios_exptimes[numimg])),
-                        dtype=np.float32)
-                    self.norm_grp['TomoNormalized'][numimg] = \
-                        normalizedtomo_singleimage
-                    if self.avgtomnorm == 1:
-                        avgnormalizedtomo += normalizedtomo_singleimage
-                    if numimg%10 == 0:
-                        print('Image %d has been normalized' % numimg)
+                self.ratios_exptimes = (self.exposuretimes_tomo /
+                                        self.avg_ff_exptime)
+
+                sum_normalized = self._normalize_tomo_images(
+                    sample_image_data, self.ratios_exptimes, self.averageff)
 
             if self.avgtomnorm == 1:
-                avgnormalizedtomo /= self.nFramesSample
+                avgnormalizedtomo = sum_normalized / self.nFramesSample
                 self.norm_grp['AverageTomo'] = avgnormalizedtomo
                 print('\nAverage of the normalized tomo images '
                       'has been calculated')
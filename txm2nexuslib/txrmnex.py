@@ -29,6 +29,12 @@ import numpy as np
 import argparse
 import h5py
 
+from txm2nexuslib.util import decode_image, XRADIA_DTYPES
+
+
+# Maximum size of the blocks of frames decoded and written at once
+BLOCK_BYTES = 64 * 1024 * 1024
+
 
 class txrmNXtomo:
 
@@ -643,99 +649,78 @@ class txrmNXtomo:
             imgdata_zerodeg = 0
         return imgdata_zerodeg
 
-    # Read single image. Function that will be used inside
-    # convert_image_stack() for converting the full image stack
-    # thanks to multiple chunks.
-    def extract_single_image(self, ole, numimage): 
-
-        # Read the images - They are stored in the txrm as ImageData1,
-        # ImageData2...
-        # Each folder contains 100 images 1-100, 101-200...
-        img_string = "ImageData%i/Image%i" % (np.ceil(numimage/100.0),
-                                              numimage)
-        stream = ole.openstream(img_string)
-        data = stream.read()
-    
-        if self.datatype == 'uint16':
-            struct_fmt = "<{0:10}H".format(self.numrows*self.numcols)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.datatype == 'float':                   
-            struct_fmt = "<{0:10}f".format(self.numrows*self.numcols)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:                            
-            print "Wrong data type"
-            return
-            
-        singleimage = np.flipud(np.reshape(imgdata,
-                                           (self.numrows, self.numcols),
-                                           order='A'))
-        singleimage = np.reshape(singleimage,
-                                 (1, self.numrows, self.numcols),
-                                 order='A')
-        return singleimage
-
-    # Read single image. Function that will be used inside
-    # convert_image_stack()
-    def extract_single_image_bright(self, ole, numimage): 
-
-        # Read the images - They are stored in the txrm as ImageData1,
-        # ImageData2...
-        # Each folder contains 100 images 1-100, 101-200...
-        img_string = "ImageData%i/Image%i" % (np.ceil(numimage/100.0),
-                                              numimage)
-        stream = ole.openstream(img_string)
-        data = stream.read()
-    
-        if self.datatype_bright == 'uint16':
-            struct_fmt = "<{0:10}H".format(self.numrows_bright *
-                                           self.numcols_bright)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.datatype_bright == 'float':                   
-            struct_fmt = "<{0:10}f".format(self.numrows_bright *
-                                           self.numcols_bright)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:                            
-            print "Wrong data type"
-            return
-            
-        singleimage = np.flipud(np.reshape(imgdata,
-                                           (self.numrows_bright,
-                                            self.numcols_bright),
-                                           order='A'))
-        singleimage = np.reshape(singleimage,
-                                 (1, self.numrows_bright, self.numcols_bright),
-                                 order='A')
-        return singleimage
-
-    # Read single image. Function that will only be used inside
-    # convert_image_stack().
-    def extract_single_image_dark(self, ole, numimage): 
-
-        # Read the images - They are stored in the txrm as ImageData1,
-        # ImageData2...
-        # Each folder contains 100 images 1-100, 101-200...
+    # Read single image of any of the image stacks (sample, bright or
+    # dark): the images are stored in the txrm as ImageData1/Image1,
+    # ImageData1/Image2... Each folder contains 100 images 1-100, 101-200...
+    def extract_frame(self, ole, numimage, numrows, numcols, datatype,
+                      out=None):
         img_string = "ImageData%i/Image%i" % (np.ceil(numimage/100.0),
                                               numimage)
         stream = ole.openstream(img_string)
-        data = stream.read()
-    
-        if self.datatype_dark == 'uint16':
-            struct_fmt = "<{0:10}H".format(self.numrows_dark*self.numcols_dark)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.datatype_dark == 'float':                   
-            struct_fmt = "<{0:10}f".format(self.numrows_dark*self.numcols_dark)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:                            
+        data = stream.getbuffer()
+        return decode_image(data, numrows, numcols, datatype, out=out)
+
+    # Read nframes consecutive images, starting at image number
+    # first_image, into a (nframes, numrows, numcols) array.
+    def extract_frames(self, ole, first_image, nframes, numrows, numcols,
+                       datatype, out=None):
+        if datatype not in XRADIA_DTYPES:
             print "Wrong data type"
             return
-             
-        singleimage = np.flipud(np.reshape(imgdata, (self.numrows_dark,
-                                                     self.numcols_dark),
-                                           order='A'))
-        singleimage = np.reshape(singleimage,
-                                 (1, self.numrows_dark, self.numcols_dark),
-                                 order='A')
-        return singleimage
+        if out is None:
+            out = np.empty((nframes, numrows, numcols),
+                           dtype=XRADIA_DTYPES[datatype])
+        for i in range(nframes):
+            self.extract_frame(ole, first_image + i, numrows, numcols,
+                               datatype, out=out[i])
+        return out
+
+    # Read single image. Function kept for the users of the former API.
+    def extract_single_image(self, ole, numimage):
+        singleimage = self.extract_frame(ole, numimage, self.numrows,
+                                         self.numcols, self.datatype)
+        if singleimage is not None:
+            return singleimage[np.newaxis]
+
+    def extract_single_image_bright(self, ole, numimage):
+        singleimage = self.extract_frame(ole, numimage, self.numrows_bright,
+                                         self.numcols_bright,
+                                         self.datatype_bright)
+        if singleimage is not None:
+            return singleimage[np.newaxis]
+
+    def extract_single_image_dark(self, ole, numimage):
+        singleimage = self.extract_frame(ole, numimage, self.numrows_dark,
+                                         self.numcols_dark,
+                                         self.datatype_dark)
+        if singleimage is not None:
+            return singleimage[np.newaxis]
+
+    # Convert the nframes images of a txrm file to the HDF5 dataset,
+    # starting at the dataset frame first_frame. Blocks of consecutive
+    # frames are decoded in a single buffer and written at once.
+    # Resizable datasets (bright and dark fields, which can come from
+    # several txrm files) are extended to hold the new frames.
+    def convert_frames(self, ole, dataset, first_frame, nframes, numrows,
+                       numcols, datatype, sequence, verbose=False):
+        if dataset.shape[0] < first_frame + nframes:
+            dataset.resize(first_frame + nframes, axis=0)
+        frame_bytes = numrows * numcols * XRADIA_DTYPES[datatype].itemsize
+        block_frames = max(1, min(nframes, BLOCK_BYTES // frame_bytes))
+        block = np.empty((block_frames, numrows, numcols),
+                         dtype=XRADIA_DTYPES[datatype])
+        for numimage in range(0, nframes, block_frames):
+            nblock = min(block_frames, nframes - numimage)
+            frames = self.extract_frames(ole, numimage + 1, nblock, numrows,
+                                         numcols, datatype,
+                                         out=block[:nblock])
+            dataset[first_frame + numimage:
+                    first_frame + numimage + nblock] = frames
+            for _ in range(nblock):
+                self.count_num_sequence = self.count_num_sequence + 1
+                sequence.append(self.count_num_sequence)
+            if verbose:
+                print('Image %i converted' % (numimage + nblock - 1))
 
     # Function used to convert all the images (main data),
     # from .txrm to NeXus .hdf5.
@@ -788,7 +773,7 @@ class txrmNXtomo:
             print(self.orderlist)
             for i in range(len(self.orderlist)):
 
-                ole = OleFileIO(self.files[i])
+                ole = OleFileIO(self.files[i], use_mmap=True)
 
                 # Data Images
                 if self.orderlist[i] == 's':
@@ -816,16 +801,11 @@ class txrmNXtomo:
 
                     print('Image pixels are {0}rows * {1}columns \n'.format(
                         self.numrows, self.numcols))
-                    for numimage in range(self.nSampleFrames):
-                        self.count_num_sequence = self.count_num_sequence+1
-                        tomoimagesingle = self.extract_single_image(ole,
-                                                                    numimage+1)
-                        self.num_sample_sequence.append(
-                            self.count_num_sequence)
-                        self.nxdetectorsample['data'][numimage] = \
-                            tomoimagesingle
-                        if numimage % 10 == 0:
-                            print('Image %i converted' % numimage)
+                    self.convert_frames(ole, self.nxdetectorsample['data'],
+                                        0, self.nSampleFrames, self.numrows,
+                                        self.numcols, self.datatype,
+                                        self.num_sample_sequence,
+                                        verbose=True)
 
                     # h5py NeXus link
                     source_addr = '/NXtomo/instrument/sample/data'
@@ -902,6 +882,9 @@ class txrmNXtomo:
                             shape=(nBrightFrames,
                                    self.numrows_bright,
                                    self.numcols_bright),
+                            maxshape=(None,
+                                      self.numrows_bright,
+                                      self.numcols_bright),
                             chunks=(1,
                                     self.numrows_bright,
                                     self.numcols_bright),
@@ -916,18 +899,15 @@ class txrmNXtomo:
                     print('BrightField pixels are {0}rows * '
                           '{1}columns'.format(self.numrows_bright,
                                               self.numcols_bright))
-                    for numimage in range(nBrightFrames):
-                        if numimage + 1 == nBrightFrames:
-                            print ('%i Bright-Field images '
-                                   'converted\n' % nBrightFrames)
-                        self.count_num_sequence = self.count_num_sequence + 1
-                        tomoimagebright = self.extract_single_image_bright(
-                            ole, numimage+1)
-                        self.num_bright_sequence.append(
-                            self.count_num_sequence)
-                        self.nxbright['data'][counter_bright_frames] = \
-                            tomoimagebright
-                        counter_bright_frames = counter_bright_frames+1
+                    self.convert_frames(ole, self.nxbright['data'],
+                                        counter_bright_frames, nBrightFrames,
+                                        self.numrows_bright,
+                                        self.numcols_bright,
+                                        self.datatype_bright,
+                                        self.num_bright_sequence)
+                    counter_bright_frames += nBrightFrames
+                    print ('%i Bright-Field images '
+                           'converted\n' % nBrightFrames)
 
                     # machine_current name of FF images #
                     if ole.exists('PositionInfo/AxisNames'):   
@@ -1063,6 +1043,9 @@ class txrmNXtomo:
                             shape=(nDarkFrames,
                                    self.numrows_dark,
                                    self.numcols_dark),
+                            maxshape=(None,
+                                      self.numrows_dark,
+                                      self.numcols_dark),
                             chunks=(1,
                                     self.numrows_dark,
                                     self.numcols_dark),
@@ -1078,16 +1061,14 @@ class txrmNXtomo:
                     print('DarkField pixels are {0}rows * '
                           '{1}columns'.format(self.numrows_dark,
                                               self.numcols_dark))
-                    for numimage in range(nDarkFrames):
-                        if numimage + 1 == nDarkFrames:
-                            print ('%i Dark-Field images '
-                                   'converted\n' % nDarkFrames)
-                        self.count_num_sequence = self.count_num_sequence+1
-                        tomoimagedark = self.extract_single_image_dark(
-                            ole, numimage+1)
-                        self.num_dark_sequence.append(self.count_num_sequence)
-                        self.nxdark['data'][counter_dark_frames] = \
-                            tomoimagedark
+                    self.convert_frames(ole, self.nxdark['data'],
+                                        counter_dark_frames, nDarkFrames,
+                                        self.numrows_dark, self.numcols_dark,
+                                        self.datatype_dark,
+                                        self.num_dark_sequence)
+                    counter_dark_frames += nDarkFrames
+                    print ('%i Dark-Field images '
+                           'converted\n' % nDarkFrames)
 
                     # machine_current name of DF images #
                     if ole.exists('PositionInfo/AxisNames'):   
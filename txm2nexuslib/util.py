@@ -18,6 +18,19 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import multiprocessing.pool
+from collections import deque
+from contextlib import contextmanager
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import numpy as np
+from joblib import Parallel
 from stat import S_ISREG, ST_CTIME, ST_MODE
 
 def sort_files_by_date(files):
@@ -31,4 +44,263 @@ def sort_files_by_date(files):
     #NOTE: use `ST_MTIME` to sort by a modification date
     sorted_files = []
     for cdate, path in sorted(entries):
-        sorted_files.append(path)
\ No newline at end of file
+        sorted_files.append(path)
+
+# Little-endian numpy dtypes of the image data types found in the
+# Xradia (xrm, txrm) files: DataType 5 is uint16, DataType 10 is float.
+XRADIA_DTYPES = {'uint16': np.dtype('<u2'),
+                 'float': np.dtype('<f4'),
+                 'float32': np.dtype('<f4')}
+
+
+def decode_image(data, numrows, numcols, data_type, out=None):
+    """Decode a raw Xradia image stream into a 2D image.
+
+    The bytes are interpreted in place with np.frombuffer (no per pixel
+    Python objects are created) and the image is returned upside-down
+    flipped, as a view. The view is read-only when data is an immutable
+    buffer (str or mmap).
+    If out is given, the image is copied into it and out is returned;
+    out must be broadcastable from (numrows, numcols), so (1, numrows,
+    numcols) buffers or rows of a bigger stack can be filled directly.
+    """
+    dtype = XRADIA_DTYPES.get(data_type)
+    if dtype is None:
+        print("Wrong data type")
+        return
+    image = np.frombuffer(data, dtype=dtype, count=numrows * numcols)
+    image = image.reshape((numrows, numcols))[::-1]
+    if out is None:
+        return image
+    out[...] = image
+    return out
+
+
+def _ordered_imap(pool, func, iterable, max_pending):
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _ordered_imap_own_pool(pool, func, iterable, max_pending):
+    with _closing_pool(pool):
+        for result in _ordered_imap(pool, func, iterable, max_pending):
+            yield result
+
+
+@contextmanager
+def _closing_pool(pool):
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def worker_pool(workers, kind="processes"):
+    """Pool of workers to be given to ordered_imap, reused by several
+    calls, and closed (or terminated on error) when leaving the with
+    block. The pool is of threads for the threads executors, of processes
+    otherwise"""
+    if kind == "threads":
+        return _closing_pool(multiprocessing.pool.ThreadPool(workers))
+    return _closing_pool(multiprocessing.Pool(workers))
+
+
+def ordered_imap(func, iterable, workers, max_pending=None, pool=None):
+    """Apply func to the items of iterable in a pool of worker processes.
+
+    The results are yielded in the order of the items. At most
+    max_pending (default: twice the workers) items are processed or
+    waiting to be consumed at any time, which bounds the memory used by
+    the results. The pool is created before returning, so no thread
+    started afterwards is duplicated in the workers. If a pool is given
+    (see worker_pool), it is used instead, and kept open.
+    """
+    if max_pending is None:
+        max_pending = 2 * workers
+    if pool is not None:
+        return _ordered_imap(pool, func, iterable, max(1, max_pending))
+    pool = multiprocessing.Pool(workers)
+    return _ordered_imap_own_pool(pool, func, iterable, max(1, max_pending))
+
+
+class FrameWriter(threading.Thread):
+    """Single thread writing frames, in order, in consecutive positions of
+    a HDF5 dataset. The frames are given through a bounded queue, so the
+    producer blocks when the writer is late; all the h5py accesses are
+    done from this thread while it is running.
+    """
+
+    def __init__(self, dataset, first_frame=0, queue_size=8):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dataset = dataset
+        self.frame_index = first_frame
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    def run(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            # after an error, keep consuming to not block the producer
+            if self.error is None:
+                try:
+                    self.dataset[self.frame_index] = frame
+                except Exception as e:
+                    self.error = e
+            self.frame_index += 1
+
+    def put(self, frame):
+        if self.error is not None:
+            raise self.error
+        self._queue.put(frame)
+
+    def close(self):
+        """Wait until all the frames are written"""
+        self._queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+# Directory of the shared memory blocks (a memory backed file system)
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+class SharedArray(object):
+    """Array stored in a shared memory block (a file of SharedArrays).
+    It is pickled as its filename, shape and data type only, so it can be
+    given to worker processes without serializing the data; the block is
+    memory mapped on first access of array."""
+
+    def __init__(self, filename, shape, dtype):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.memmap(self.filename, dtype=self.dtype,
+                                    mode="r", shape=self.shape)
+        return self._array
+
+    def __getstate__(self):
+        return (self.filename, self.shape, self.dtype)
+
+    def __setstate__(self, state):
+        self.filename, self.shape, self.dtype = state
+        self._array = None
+
+
+class SharedArrays(object):
+    """Shared memory blocks, as np.memmap files in /dev/shm (or in the
+    temporary directory if there is no /dev/shm), for handing arrays to
+    worker processes. The blocks are removed when closed:
+
+        with SharedArrays() as shared:
+            reference = shared.share(image)
+            Parallel(...)(delayed(func)(reference, ...) for ...)
+    """
+
+    def __init__(self, directory=None):
+        if directory is None and os.path.isdir(SHARED_MEMORY_DIR):
+            directory = SHARED_MEMORY_DIR
+        self.directory = tempfile.mkdtemp(prefix="txm2nexus_",
+                                          dir=directory)
+        self._num_blocks = 0
+
+    def _new_block(self, shape, dtype):
+        """New shared block, as a memory mapped array"""
+        self._num_blocks += 1
+        filename = os.path.join(self.directory,
+                                "block_%d.dat" % self._num_blocks)
+        return np.memmap(filename, dtype=dtype, mode="w+", shape=shape)
+
+    def share(self, array):
+        """Copy the array in a new (read-only) shared block"""
+        array = np.asarray(array)
+        block = self._new_block(array.shape, array.dtype)
+        block[...] = array
+        block.flush()
+        return SharedArray(block.filename, array.shape, array.dtype)
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# joblib backends of the kinds of executor
+EXECUTOR_BACKENDS = {"serial": "sequential",
+                     "threads": "threading",
+                     "processes": "multiprocessing",
+                     "loky": "loky"}
+
+
+class Executor(object):
+    """Workers of a workflow, created once and reused by all its stages,
+    instead of starting a new pool of workers in each stage. The kind of
+    executor can be serial, threads, processes or loky. The workers (and
+    their caches, as the OLE headers of the xrm files) are kept until the
+    executor is closed:
+
+        with Executor("processes", cores=-2) as executor:
+            multiple_xrm_2_hdf5(db_filename, executor=executor)
+            crop_images(db_filename, executor=executor)
+    """
+
+    def __init__(self, kind="processes", cores=-2):
+        if kind not in EXECUTOR_BACKENDS:
+            raise ValueError("Unknown executor %s (choose among %s)" %
+                             (kind, ", ".join(sorted(EXECUTOR_BACKENDS))))
+        self.kind = kind
+        self.cores = 1 if kind == "serial" else cores
+        self._parallel = None
+
+    @property
+    def parallel(self):
+        """joblib Parallel of the executor; its workers are started on
+        first use"""
+        if self._parallel is None:
+            self._parallel = Parallel(n_jobs=self.cores,
+                                      backend=EXECUTOR_BACKENDS[self.kind])
+            self._parallel.__enter__()
+        return self._parallel
+
+    def close(self):
+        if self._parallel is not None:
+            self._parallel.__exit__(None, None, None)
+            self._parallel = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_parallel(executor=None, cores=-2):
+    """joblib Parallel running the tasks of a stage: the one of the
+    executor if given, otherwise a new pool of processes (cores)"""
+    if executor is not None:
+        return executor.parallel
+    return Parallel(n_jobs=cores, backend="multiprocessing")
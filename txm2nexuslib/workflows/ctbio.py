@@ -29,15 +29,20 @@ from argparse import RawTextHelpFormatter
 from tinydb import TinyDB, Query
 from tinydb.middlewares import CachingMiddleware
 
+from txm2nexuslib.util import Executor, EXECUTOR_BACKENDS
 from txm2nexuslib.parser import create_db, get_db_path
 from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
 from txm2nexuslib.images.util import (
     copy2proc_multiple, check_if_multiple_zps, query_command_for_same_sample)
-from txm2nexuslib.images.multiplecrop import crop_images
 from txm2nexuslib.images.multiplenormalization import normalize_images
 from txm2nexuslib.images.multiplealign import align_images
 from txm2nexuslib.images.multipleaverage import average_image_groups
 from txm2nexuslib.images.imagestostack import many_images_to_h5_stack
+from txm2nexuslib.images.fusedpipeline import (fused_preprocessing,
+                                               DEFAULT_ROI)
+from txm2nexuslib.images.imagestore import (
+    STORE_TABLE, STORE_AVERAGES_TABLE, xrm_to_store, crop_store,
+    normalize_store, align_store, average_store, store_to_stack)
 from txm2nexuslib.stack.stack_operate import (
     hdf5_2_mrc_stacks, deconvolve_stacks, minus_ln_stacks_mrc,
     norm2ali_stacks, get_stacks_to_recons, recons_mrc_stacks)
@@ -45,7 +50,8 @@ from txm2nexuslib.stack.stack_operate import (
 
 def main():
     """
-    - Convert from xrm to hdf5 individual image hdf5 files
+    - Convert from xrm to hdf5 individual image hdf5 files (or to image
+      stores, one per date and sample)
     - Copy raw hdf5 to new files for processing
     - Crop borders of single hdf5 image files
     - Normalize single hdf5 image files
@@ -143,6 +149,48 @@ def main():
                         help='Iterations for tomo3d \n'
                              '(default=30)')
 
+    parser.add_argument('--db_backend', type=str, default='json',
+                        choices=['json', 'sqlite'],
+                        help="Backend of the files index DataBase:\n"
+                             "index.json (json) or index.sqlite (sqlite)\n"
+                             "(default: json)")
+
+    parser.add_argument('--fused', action='store_true',
+                        help="Fused pre-processing: crop, normalize, align\n"
+                             "and average each group of xrm images in\n"
+                             "memory, storing only the averaged images\n"
+                             "(and the normalized images if needed for\n"
+                             "the stacks)")
+
+    parser.add_argument('--copy_free', action='store_true',
+                        help="Do not copy the raw hdf5 files to the files\n"
+                             "for processing: these map the raw images")
+
+    parser.add_argument('--virtual', action='store_true',
+                        help="Build the stacks of single image files as\n"
+                             "virtual datasets mapping their images")
+
+    parser.add_argument('--store', action='store_true',
+                        help="Keep the images of each date and sample in a\n"
+                             "single hdf5 image store, instead of one hdf5\n"
+                             "file per image")
+
+    parser.add_argument('--shared_memory', action='store_true',
+                        help="Hand the averaged FF and the reference\n"
+                             "images for the alignment to the worker\n"
+                             "processes in shared memory blocks")
+
+    parser.add_argument('--executor', type=str, default='processes',
+                        choices=sorted(EXECUTOR_BACKENDS),
+                        help="Workers of the pre-processing stages, created\n"
+                             "once and reused by all the stages\n"
+                             "(default: processes)")
+
+    parser.add_argument('-c', '--cores', type=int,
+                        default=-2,
+                        help='Number of cores used for the pre-processing\n'
+                             '(default: all cores but one)')
+
     args = parser.parse_args()
 
     print("\nPre-Processing for BL09 Tomographies:\n" +
@@ -155,43 +203,94 @@ def main():
           " reorientate the volumes with trim")
 
     start_time = time.time()
-
-    db_filename = get_db_path(args.txm_txt_script)
-    create_db(args.txm_txt_script)
-    # Multiple xrm 2 hdf5 files: working with many single images files
-    multiple_xrm_2_hdf5(db_filename)
-
-    # Copy of multiple hdf5 raw data files to files for processing
-    copy2proc_multiple(db_filename)
-
-    # Multiple files hdf5 images crop: working with single images files
-    if args.crop:
-        crop_images(db_filename)
-
-    # Normalize multiple hdf5 files: working with many single images files
-    normalize_images(db_filename)
-
-    tomo_projections_query = query_command_for_same_sample(db_filename)
-    single_zp_bool = check_if_multiple_zps(db_filename,
-                                           query=tomo_projections_query)
-
-    # Compute single stacks or intermediate stacks (each one for a ZPz)
-    if single_zp_bool or args.stacks_zp:
-        many_images_to_h5_stack(db_filename, table_name="hdf5_proc",
-                                type_struct="normalized", suffix="_stack")
-
-    # If many ZPz positions are used:
-    if not single_zp_bool:
-        # Align multiple hdf5 files: working with many single images files
-        align_images(db_filename, align_method='cv2.TM_SQDIFF_NORMED')
-
-        # Average multiple hdf5 files: working with many single images files
-        average_image_groups(db_filename)
-
-        # Build up hdf5 stacks from individual images
-        many_images_to_h5_stack(db_filename, table_name="hdf5_proc",
-                                type_struct="normalized_multifocus",
-                                suffix="_FS")
+    with Executor(args.executor, cores=args.cores) as executor:
+        db_filename = get_db_path(args.txm_txt_script,
+                                  backend=args.db_backend)
+        create_db(args.txm_txt_script, backend=args.db_backend)
+        if args.fused:
+            tomo_projections_query = query_command_for_same_sample(
+                db_filename, table_name="_default")
+            single_zp_bool = check_if_multiple_zps(
+                db_filename, query=tomo_projections_query)
+            # Crop, normalize, align and average in a single pass
+            fused_preprocessing(db_filename, crop=args.crop,
+                                align_method='cv2.TM_SQDIFF_NORMED',
+                                average=not single_zp_bool,
+                                checkpoint=single_zp_bool or args.stacks_zp,
+                                executor=executor)
+        elif args.store:
+            # Store the xrm images in image stores (one per date and sample)
+            xrm_to_store(db_filename, executor=executor)
+
+            # Crop and normalize the stored images
+            if args.crop:
+                crop_store(db_filename)
+            normalize_store(db_filename)
+
+            tomo_projections_query = query_command_for_same_sample(
+                db_filename, table_name=STORE_TABLE)
+            single_zp_bool = check_if_multiple_zps(
+                db_filename, query=tomo_projections_query)
+        else:
+            # Multiple xrm 2 hdf5 files: working with many single images files
+            # (cropped while they are decoded, if crop)
+            multiple_xrm_2_hdf5(db_filename,
+                                roi=DEFAULT_ROI if args.crop else None,
+                                executor=executor)
+
+            # Copy of multiple hdf5 raw data files to files for processing
+            copy2proc_multiple(db_filename, copy_free=args.copy_free,
+                               executor=executor)
+
+            # Normalize multiple hdf5 files: working with many single images
+            # files
+            normalize_images(db_filename, shared_memory=args.shared_memory,
+                             executor=executor)
+
+            tomo_projections_query = query_command_for_same_sample(db_filename)
+            single_zp_bool = check_if_multiple_zps(
+                db_filename, query=tomo_projections_query)
+
+        # Compute single stacks or intermediate stacks (each one for a ZPz)
+        if (single_zp_bool or args.stacks_zp) and args.store:
+            store_to_stack(db_filename, type_struct="normalized",
+                           suffix="_stack")
+        elif single_zp_bool or args.stacks_zp:
+            many_images_to_h5_stack(db_filename, table_name="hdf5_proc",
+                                    type_struct="normalized", suffix="_stack",
+                                    virtual=args.virtual, executor=executor)
+
+        # If many ZPz positions are used:
+        if not single_zp_bool and args.store and not args.fused:
+            # Align and average the stored images, and build up the hdf5
+            # stacks from the stored average images
+            align_store(db_filename, align_method='cv2.TM_SQDIFF_NORMED',
+                        executor=executor)
+            average_store(db_filename)
+            store_to_stack(db_filename, table_name=STORE_AVERAGES_TABLE,
+                           type_struct="normalized_multifocus", suffix="_FS")
+        elif not single_zp_bool and not args.fused:
+            # Align multiple hdf5 files: working with many single images files
+            align_images(db_filename, align_method='cv2.TM_SQDIFF_NORMED',
+                         shared_memory=args.shared_memory,
+                         executor=executor)
+
+            # Average multiple hdf5 files: working with many single images
+            # files
+            average_image_groups(db_filename, executor=executor)
+
+            # Build up hdf5 stacks from individual images
+            many_images_to_h5_stack(db_filename, table_name="hdf5_proc",
+                                    type_struct="normalized_multifocus",
+                                    suffix="_FS", virtual=args.virtual,
+                                    executor=executor)
+        elif not single_zp_bool:
+            # Build up hdf5 stacks from the fused average images
+            many_images_to_h5_stack(db_filename,
+                                    table_name=args.table_for_stack,
+                                    type_struct="normalized_multifocus",
+                                    suffix="_FS", virtual=args.virtual,
+                                    executor=executor)
 
     if args.hdf_to_mrc or args.deconvolution:
 
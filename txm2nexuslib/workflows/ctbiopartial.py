@@ -33,7 +33,7 @@ from tinydb.middlewares import CachingMiddleware
 
 from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
 from txm2nexuslib.images.util import copy2proc_multiple, check_if_multiple_zps
-from txm2nexuslib.images.multiplecrop import crop_images
+from txm2nexuslib.images.fusedpipeline import DEFAULT_ROI
 from txm2nexuslib.images.multiplenormalization import normalize_images
 from txm2nexuslib.images.multiplealign import align_images
 from txm2nexuslib.images.multipleaverage import average_image_groups
@@ -46,12 +46,11 @@ def partial_preprocesing(db_filename, crop, query=None,
                          stacks_zp=False, table_name="hdf5_proc"):
 
     # Multiple xrm 2 hdf5 files: working with many single images files
-    multiple_xrm_2_hdf5(db_filename, query=query)
+    # (cropped while they are decoded, if crop)
+    multiple_xrm_2_hdf5(db_filename, query=query,
+                        roi=DEFAULT_ROI if crop else None)
     # Copy of multiple hdf5 raw data files to files for processing
     copy2proc_multiple(db_filename, query=query, purge=True)
-    # Multiple files hdf5 images crop: working with single images files
-    if crop:
-        crop_images(db_filename, query=query)
     # Normalize multiple hdf5 files: working with many single images files
     normalize_images(db_filename,
                      date=date, sample=sample, energy=energy,
@@ -129,6 +128,12 @@ def main():
     parser.add_argument('--id', type=float,
                         help='- ID of the record in DB\n')
 
+    parser.add_argument('--db_backend', type=str, default='json',
+                        choices=['json', 'sqlite'],
+                        help="Backend of the files index DataBase:\n"
+                             "index.json (json) or index.sqlite (sqlite)\n"
+                             "(default: json)")
+
     args = parser.parse_args()
 
     print("\nWorkflow with Extended Depth of Field:\n" +
@@ -141,14 +146,16 @@ def main():
     # Align and average by repetition
     # variable = "sample"
 
-    db_filename = get_db_path(args.txm_txt_script)
+    db_filename = get_db_path(args.txm_txt_script,
+                              backend=args.db_backend)
     query = Query()
 
     if args.db:
-        create_db(args.txm_txt_script)
+        create_db(args.txm_txt_script, backend=args.db_backend)
 
     if args.id:
-        db = get_db(args.txm_txt_script, use_existing_db=True)
+        db = get_db(args.txm_txt_script, use_existing_db=True,
+                    backend=args.db_backend)
         dbsample = db.get(doc_id=args.id)
         date = dbsample['date']
         energy = dbsample['energy']
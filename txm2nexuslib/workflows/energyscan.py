@@ -27,9 +27,10 @@ import argparse
 from argparse import RawTextHelpFormatter
 from tinydb import Query
 
+from txm2nexuslib.util import Executor, EXECUTOR_BACKENDS
 from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
 from txm2nexuslib.images.util import copy2proc_multiple
-from txm2nexuslib.images.multiplecrop import crop_images
+from txm2nexuslib.images.fusedpipeline import DEFAULT_ROI
 from txm2nexuslib.images.multiplenormalization import (normalize_images,
                                                        average_ff)
 from txm2nexuslib.images.multiplealign import align_images
@@ -39,20 +40,21 @@ from txm2nexuslib.images.imagestostack import many_images_to_h5_stack
 from txm2nexuslib.parser import create_db, get_db_path
 
 
-def partial_preprocesing_escan(db_filename, variable, crop=False, query=None):
+def partial_preprocesing_escan(db_filename, variable, crop=False, query=None,
+                               executor=None):
     # Multiple xrm 2 hdf5 files: working with many single images files
-
-    multiple_xrm_2_hdf5(db_filename, query=query)
+    # (cropped while they are decoded, if crop)
+    multiple_xrm_2_hdf5(db_filename, query=query,
+                        roi=DEFAULT_ROI if crop else None, executor=executor)
     # Copy of multiple hdf5 raw data files to files for processing
-    copy2proc_multiple(db_filename, query=query, purge=True)
-    # Multiple files hdf5 images crop: working with single images files
-    if crop:
-        crop_images(db_filename, query=query)
+    copy2proc_multiple(db_filename, query=query, purge=True,
+                       executor=executor)
     # Normalize multiple hdf5 files: working with many single images files
-    normalize_images(db_filename, query=query)
+    normalize_images(db_filename, query=query, executor=executor)
 
     # Align multiple hdf5 files: working with many single images files
-    align_images(db_filename, variable=variable, query=query, jj=False)
+    align_images(db_filename, variable=variable, query=query, jj=False,
+                 executor=executor)
 
     return db_filename
 
@@ -111,6 +113,18 @@ def main():
                              '- If False: Do not calculate stack\n'
                              '(default: True)')
 
+    parser.add_argument('--db_backend', type=str, default='json',
+                        choices=['json', 'sqlite'],
+                        help="Backend of the files index DataBase:\n"
+                             "index.json (json) or index.sqlite (sqlite)\n"
+                             "(default: json)")
+
+    parser.add_argument('--executor', type=str, default='processes',
+                        choices=sorted(EXECUTOR_BACKENDS),
+                        help="Workers of the pre-processing stages, created\n"
+                             "once and reused by all the stages\n"
+                             "(default: processes)")
+
     args = parser.parse_args()
 
     print("\nWorkflow for energyscan experiments:\n" +
@@ -119,38 +133,42 @@ def main():
           " average all images with same energy ->"
           " make normalized stacks")
     start_time = time.time()
-
-    # Align and average by repetition
-    variable = "repetition"
-
-    db_filename = get_db_path(args.txm_txt_script)
-    query = Query()
-
-    if args.db:
-        create_db(args.txm_txt_script)
-
-    if args.e is not None:
-        if len(args.e) == 0:
-            partial_preprocesing_escan(db_filename, variable,
-                                       crop=args.crop)
-            # Average multiple hdf5 files:
-            # working with many single images files
-            average_image_groups(db_filename, variable=variable, jj=False)
-        else:
-            query_impl = (query.energy==args.e[0])
-            partial_preprocesing_escan(db_filename, variable, crop=args.crop,
-                                       query=query_impl)
-            # Average multiple hdf5 files:
-            # working with many single images files
-            average_image_group_by_energy(db_filename, variable=variable,
-                                          energy=args.e[0])
-
-    if args.stack:
-        # Build up hdf5 stacks from individual images.
-        # Stacks of variable energy: spectrocopy stacks (energyscan)
-        many_images_to_h5_stack(db_filename, table_name=args.table_for_stack,
-                                type_struct="normalized_spectroscopy",
-                                suffix="_specnorm")
+    with Executor(args.executor) as executor:
+        # Align and average by repetition
+        variable = "repetition"
+
+        db_filename = get_db_path(args.txm_txt_script,
+                                  backend=args.db_backend)
+        query = Query()
+
+        if args.db:
+            create_db(args.txm_txt_script, backend=args.db_backend)
+
+        if args.e is not None:
+            if len(args.e) == 0:
+                partial_preprocesing_escan(db_filename, variable,
+                                           crop=args.crop, executor=executor)
+                # Average multiple hdf5 files:
+                # working with many single images files
+                average_image_groups(db_filename, variable=variable, jj=False,
+                                     executor=executor)
+            else:
+                query_impl = (query.energy==args.e[0])
+                partial_preprocesing_escan(db_filename, variable,
+                                           crop=args.crop, query=query_impl,
+                                           executor=executor)
+                # Average multiple hdf5 files:
+                # working with many single images files
+                average_image_group_by_energy(db_filename, variable=variable,
+                                              energy=args.e[0])
+
+        if args.stack:
+            # Build up hdf5 stacks from individual images.
+            # Stacks of variable energy: spectrocopy stacks (energyscan)
+            many_images_to_h5_stack(db_filename,
+                                    table_name=args.table_for_stack,
+                                    type_struct="normalized_spectroscopy",
+                                    suffix="_specnorm", executor=executor)
 
     print("spectrocopy preprocessing took %d seconds\n" %
           (time.time() - start_time))
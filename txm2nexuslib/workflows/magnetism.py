@@ -28,9 +28,10 @@ import argparse
 from argparse import RawTextHelpFormatter
 from tinydb import Query
 
+from txm2nexuslib.util import Executor, EXECUTOR_BACKENDS
 from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
 from txm2nexuslib.images.util import copy2proc_multiple
-from txm2nexuslib.images.multiplecrop import crop_images
+from txm2nexuslib.images.fusedpipeline import DEFAULT_ROI
 from txm2nexuslib.images.multiplenormalization import (normalize_images,
                                                        average_ff)
 from txm2nexuslib.images.multiplealign import align_images
@@ -40,10 +41,12 @@ from txm2nexuslib.images.imagestostack import many_images_to_h5_stack
 from txm2nexuslib.parser import create_db, get_db_path
 
 
-def partial_preprocesing(db_filename, variable, crop, query=None, is_ff=False):
+def partial_preprocesing(db_filename, variable, crop, query=None, is_ff=False,
+                         executor=None):
     # Multiple xrm 2 hdf5 files: working with many single images files
-    
-    multiple_xrm_2_hdf5(db_filename, query=query)
+    # (cropped while they are decoded, if crop)
+    multiple_xrm_2_hdf5(db_filename, query=query,
+                        roi=DEFAULT_ROI if crop else None, executor=executor)
     # Copy of multiple hdf5 raw data files to files for processing
 
     if is_ff:
@@ -51,17 +54,16 @@ def partial_preprocesing(db_filename, variable, crop, query=None, is_ff=False):
     else:
         purge = False
     copy2proc_multiple(db_filename, query=query, purge=purge,
-                       magnetism_partial=True)
-    # Multiple files hdf5 images crop: working with single images files
-    if crop:
-        crop_images(db_filename, query=query)
+                       magnetism_partial=True, executor=executor)
     # Normalize multiple hdf5 files: working with many single images files
     if not is_ff:
-        normalize_images(db_filename, query=query, jj=True, read_norm_ff=True)
+        normalize_images(db_filename, query=query, jj=True, read_norm_ff=True,
+                         executor=executor)
     else:
-        average_ff(db_filename, query=query, jj=True)
+        average_ff(db_filename, query=query, jj=True, executor=executor)
     # Align multiple hdf5 files: working with many single images files
-    align_images(db_filename, variable=variable, query=query)
+    align_images(db_filename, variable=variable, query=query,
+                 executor=executor)
 
     return db_filename
 
@@ -126,6 +128,17 @@ def main():
                              '- If False: Do not calculate stack\n'
                              '(default: False)')
 
+    parser.add_argument('--db_backend', type=str, default='json',
+                        choices=['json', 'sqlite'],
+                        help="Backend of the files index DataBase:\n"
+                             "index.json (json) or index.sqlite (sqlite)\n"
+                             "(default: json)")
+
+    parser.add_argument('--executor', type=str, default='processes',
+                        choices=sorted(EXECUTOR_BACKENDS),
+                        help="Workers of the pre-processing stages, created\n"
+                             "once and reused by all the stages\n"
+                             "(default: processes)")
 
     args = parser.parse_args()
 
@@ -135,49 +148,52 @@ def main():
           " average all images with same angle and"
           " same jj position ->" + " make normalized stacks")
     start_time = time.time()
+    with Executor(args.executor) as executor:
+        # Align and average by repetition
+        variable = "repetition"
 
-    # Align and average by repetition
-    variable = "repetition"
-
-    db_filename = get_db_path(args.txm_txt_script)
-    query = Query()
+        db_filename = get_db_path(args.txm_txt_script,
+                                  backend=args.db_backend)
+        query = Query()
 
-    if args.db:
-        create_db(args.txm_txt_script)
+        if args.db:
+            create_db(args.txm_txt_script, backend=args.db_backend)
 
-    if args.ff:
-        partial_preprocesing(db_filename, variable, args.crop,
-                             query.FF==True,
-                             is_ff=True)
-    if args.th is not None: 
-        if len(args.th) == 0:
-            partial_preprocesing(db_filename, variable, args.crop,
-                                 query.FF==False)
-            # Average multiple hdf5 files:
-            # working with many single images files
-            average_image_groups(db_filename, variable=variable)
-        else:
+        if args.ff:
             partial_preprocesing(db_filename, variable, args.crop,
-                                 query.angle==args.th[0])
-            # Average multiple hdf5 files:
-            # working with many single images files
-            average_image_group_by_angle(db_filename, variable=variable,
-                                         angle=args.th[0])
-
-    if args.stack:
-
-        # Build up hdf5 stacks from individual images
-        # Stack of variable angle. Each of the images has been done by
-        # averaging many repetitions of the image at the same energy, jj,
-        # angle... The number of repetitions by each of the images in this
-        # stack files could be variable.
-        many_images_to_h5_stack(
-            db_filename, table_name=args.table_for_stack,
-            type_struct="normalized_magnetism_many_repetitions",
-            suffix="_FS")
-
-        print("magnetism preprocessing took %d seconds\n" %
-              (time.time() - start_time))
+                                 query.FF==True,
+                                 is_ff=True, executor=executor)
+        if args.th is not None: 
+            if len(args.th) == 0:
+                partial_preprocesing(db_filename, variable, args.crop,
+                                     query.FF==False, executor=executor)
+                # Average multiple hdf5 files:
+                # working with many single images files
+                average_image_groups(db_filename, variable=variable,
+                                     executor=executor)
+            else:
+                partial_preprocesing(db_filename, variable, args.crop,
+                                     query.angle==args.th[0],
+                                     executor=executor)
+                # Average multiple hdf5 files:
+                # working with many single images files
+                average_image_group_by_angle(db_filename, variable=variable,
+                                             angle=args.th[0])
+
+        if args.stack:
+
+            # Build up hdf5 stacks from individual images
+            # Stack of variable angle. Each of the images has been done by
+            # averaging many repetitions of the image at the same energy, jj,
+            # angle... The number of repetitions by each of the images in this
+            # stack files could be variable.
+            many_images_to_h5_stack(
+                db_filename, table_name=args.table_for_stack,
+                type_struct="normalized_magnetism_many_repetitions",
+                suffix="_FS", executor=executor)
+
+            print("magnetism preprocessing took %d seconds\n" %
+                  (time.time() - start_time))
 
     """
     from tinydb import TinyDB
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+"""
+(C) Copyright 2019 ALBA-CELLS - CTGENSOFT
+The program is distributed under the terms of the
+GNU General Public License (or the Lesser GPL).
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import argparse
+from argparse import RawTextHelpFormatter
+
+from tinydb import Query
+
+from txm2nexuslib.fileindex import open_index
+from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
+from txm2nexuslib.images.util import copy2proc_multiple, group_records
+from txm2nexuslib.images.fusedpipeline import DEFAULT_ROI
+from txm2nexuslib.images.multiplenormalization import normalize_images
+from txm2nexuslib.images.imagestostack import many_images_to_h5_stack
+from txm2nexuslib.parser import get_db, get_db_path, get_file_paths
+
+
+# Table of the files index DataBase storing the progress of the watcher
+WATCH_TABLE = "watch"
+# Images are grouped by sample (and normalized with the FF of the group)
+GROUP_KEYS = ("date", "sample", "energy")
+
+
+def _proc_filename(filename, suffix="_proc"):
+    """Filename of the hdf5 file for processing of a raw (xrm) file"""
+    return os.path.splitext(filename)[0] + suffix + ".hdf5"
+
+
+class AcquisitionWatcher(object):
+    """Follow a TXM script while it is acquired, and process each image as
+    soon as it is complete, instead of waiting for the end of the
+    acquisition:
+    xrm -> hdf5 raw -> hdf5 for processing -> crop -> normalize ->
+    -> normalized stacks.
+
+    The script is parsed incrementally, and the data files are polled (no
+    external service is needed). An image is complete when its file has
+    not changed during settle_time seconds. The images of a sample group
+    (date, sample, energy) are normalized once the FF of the group are
+    complete, that is, once the script has collected an image after them.
+    The stacks of a group are built once the script has moved to another
+    group (the angle series is closed), or when the acquisition finishes.
+    The progress is stored in the files index, so a watcher can be
+    stopped and started again.
+    """
+
+    def __init__(self, txm_txt_script, crop=True, stacks=True,
+                 settle_time=5.0, subfolders=False, cores=-2,
+                 backend='json'):
+        self.txm_txt_script = txm_txt_script
+        self.crop = crop
+        self.stacks = stacks
+        self.settle_time = settle_time
+        self.subfolders = subfolders
+        self.cores = cores
+        self.backend = backend
+        self.db_filename = get_db_path(txm_txt_script, backend=backend)
+        self.root_path = os.path.dirname(os.path.abspath(txm_txt_script))
+        self.converted = None
+        self.normalized = None
+        self.stacked = None
+        # (size, modification time) of the data files in the last poll
+        self._file_states = {}
+
+    def _load_progress(self, db):
+        records = db.table(WATCH_TABLE).all()
+        progress = records[-1] if records else {}
+        self.converted = set(progress.get('converted', []))
+        self.normalized = set(progress.get('normalized', []))
+        self.stacked = set([tuple(key) for key in
+                            progress.get('stacked', [])])
+
+    def _store_progress(self):
+        db = open_index(self.db_filename)
+        table = db.table(WATCH_TABLE)
+        table.purge()
+        table.insert({'converted': sorted(self.converted),
+                      'normalized': sorted(self.normalized),
+                      'stacked': [list(key) for key in sorted(self.stacked)]})
+        db.close()
+
+    def _is_complete(self, path, finish=False):
+        """Check if the data file is completely written: its size and
+        modification time have not changed since the previous poll, and
+        not during the last settle_time seconds"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        state = (stat.st_size, stat.st_mtime)
+        previous_state = self._file_states.get(path)
+        self._file_states[path] = state
+        if finish:
+            return True
+        return (state == previous_state and
+                time.time() - stat.st_mtime >= self.settle_time)
+
+    def _complete_files(self, records, finish=False):
+        """Raw filenames of the records not converted yet whose data
+        files are complete"""
+        pending = [record for record in records
+                   if record['filename'] not in self.converted]
+        paths = get_file_paths(pending, self.root_path,
+                               use_subfolders=self.subfolders)
+        paths = dict([(os.path.basename(path), path) for path in paths])
+        return [record['filename'] for record in pending
+                if record['filename'] in paths and
+                self._is_complete(paths[record['filename']], finish)]
+
+    def _convert(self, filenames):
+        """xrm -> hdf5 raw (cropped while decoded) -> hdf5 for
+        processing"""
+        multiple_xrm_2_hdf5(self.db_filename, subfolders=self.subfolders,
+                            cores=self.cores,
+                            query=Query().filename.one_of(filenames),
+                            roi=DEFAULT_ROI if self.crop else None,
+                            purge=False)
+        raw_filenames = [os.path.splitext(filename)[0] + ".hdf5"
+                         for filename in filenames]
+        copy2proc_multiple(self.db_filename, cores=self.cores,
+                           query=Query().filename.one_of(raw_filenames))
+        self.converted.update(filenames)
+
+    def _closed_groups(self, records, finish=False):
+        """Groups of records whose FF are complete, and flag indicating if
+        the acquisition of the group is finished"""
+        last_key = tuple(records[-1].get(key) for key in GROUP_KEYS)
+        for group in group_records(records, GROUP_KEYS, sort_by=None,
+                                   split_ff=False):
+            ff_records = [record for record in group.records
+                          if record.get("FF") is True]
+            if not ff_records:
+                continue
+            # FF are complete when the script has collected an image after
+            # them, and when all of them have been converted
+            ff_closed = (finish or group.key != last_key or
+                         ff_records[-1] is not records[-1])
+            ff_converted = all([record['filename'] in self.converted
+                                for record in ff_records])
+            if ff_closed and ff_converted:
+                yield group, finish or group.key != last_key
+
+    def poll(self, finish=False):
+        """Process the images completed since the previous poll. If finish
+        is True, the acquisition is considered finished: all the groups of
+        images are closed. Return True if some image has been processed"""
+        db = get_db(self.txm_txt_script, backend=self.backend,
+                    incremental=True)
+        if self.converted is None:
+            self._load_progress(db)
+        records = db.all()
+        db.close()
+        if not records:
+            return False
+
+        filenames = self._complete_files(records, finish)
+        if filenames:
+            self._convert(filenames)
+
+        to_normalize = []
+        to_stack = []
+        for group, closed in self._closed_groups(records, finish):
+            data_filenames = [record['filename'] for record in group.records
+                              if record.get("FF") is not True]
+            to_normalize.extend(
+                [filename for filename in data_filenames
+                 if filename in self.converted and
+                 filename not in self.normalized])
+            if (closed and self.stacks and group.key not in self.stacked and
+                    all([filename in self.converted
+                         for filename in data_filenames])):
+                to_stack.append(group.key)
+
+        if to_normalize:
+            proc_filenames = [_proc_filename(filename)
+                              for filename in to_normalize]
+            normalize_images(self.db_filename, cores=self.cores,
+                             query=Query().filename.one_of(proc_filenames))
+            self.normalized.update(to_normalize)
+
+        for date, sample, energy in to_stack:
+            many_images_to_h5_stack(self.db_filename, table_name="hdf5_proc",
+                                    type_struct="normalized",
+                                    suffix="_stack", date=date,
+                                    sample=sample, energy=energy,
+                                    cores=self.cores)
+            self.stacked.add((date, sample, energy))
+
+        processed = bool(filenames or to_normalize or to_stack)
+        if processed:
+            self._store_progress()
+        return processed
+
+    def run(self, poll_interval=10.0, idle_timeout=600.0):
+        """Poll the acquisition until neither the script nor the data
+        files have changed during idle_timeout seconds; then consider the
+        acquisition finished and process the remaining images."""
+        last_activity = time.time()
+        last_script_state = None
+        while True:
+            stat = os.stat(self.txm_txt_script)
+            script_state = (stat.st_size, stat.st_mtime)
+            file_states = dict(self._file_states)
+            if self.poll():
+                last_activity = time.time()
+            elif (script_state != last_script_state or
+                    file_states != self._file_states):
+                last_activity = time.time()
+            last_script_state = script_state
+            if time.time() - last_activity > idle_timeout:
+                break
+            time.sleep(poll_interval)
+        print("\nNo activity during %d seconds: finishing acquisition\n" %
+              idle_timeout)
+        self.poll(finish=True)
+
+
+def main():
+    """
+    Follow a TXM script being acquired, and process its images as soon
+    as they are complete:
+    - Convert from xrm to hdf5 individual image hdf5 files
+    - Copy raw hdf5 to new files for processing
+    - Crop borders
+    - Normalize (once the FF of the images are complete)
+    - Create normalized stacks by date, sample, energy and zpz (once the
+      angle series is complete)
+    """
+    def str2bool(v):
+        return v.lower() in ("yes", "true", "t", "1")
+
+    description = ("Process the images of an acquisition while it is "
+                   "being acquired")
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=RawTextHelpFormatter)
+    parser.register('type', 'bool', str2bool)
+
+    parser.add_argument('txm_txt_script', type=str,
+                        help=('TXM txt script containing the commands used '
+                              'to perform\nthe image acquisition by the '
+                              'BL09 TXM microscope'))
+
+    parser.add_argument('--crop', type='bool',
+                        default='True',
+                        help='- If True: Crop images\n'
+                             '- If False: Do not crop images\n'
+                             '(default: True)')
+
+    parser.add_argument('--stacks', type='bool',
+                        default='True',
+                        help='- If True: Build the normalized stacks\n'
+                             '- If False: Do not build the stacks\n'
+                             '(default: True)')
+
+    parser.add_argument('-s', '--subfolders', type='bool',
+                        default='False',
+                        help='- If True: Use subfolders for indexing\n'
+                             '- If False: Use general folder for indexing\n'
+                             '(default: False)')
+
+    parser.add_argument('-c', '--cores', type=int,
+                        default=-2,
+                        help='Number of cores used for the processing\n'
+                             '(default: all cores but one)')
+
+    parser.add_argument('-p', '--poll', type=float,
+                        default=10.0,
+                        help='Seconds between two polls of the acquisition\n'
+                             '(default: 10)')
+
+    parser.add_argument('--settle', type=float,
+                        default=5.0,
+                        help='Seconds without changes after which a data\n'
+                             'file is considered complete (default: 5)')
+
+    parser.add_argument('-t', '--timeout', type=float,
+                        default=600.0,
+                        help='Seconds without activity after which the\n'
+                             'acquisition is considered finished\n'
+                             '(default: 600)')
+
+    parser.add_argument('--db_backend', type=str, default='json',
+                        choices=['json', 'sqlite'],
+                        help="Backend of the files index DataBase:\n"
+                             "index.json (json) or index.sqlite (sqlite)\n"
+                             "(default: json)")
+
+    args = parser.parse_args()
+
+    print("\nWatching acquisition:\n" +
+          "xrm -> hdf5 -> crop -> normalize -> make normalized stacks\n")
+    start_time = time.time()
+
+    watcher = AcquisitionWatcher(args.txm_txt_script, crop=args.crop,
+                                 stacks=args.stacks,
+                                 settle_time=args.settle,
+                                 subfolders=args.subfolders,
+                                 cores=args.cores, backend=args.db_backend)
+    watcher.run(poll_interval=args.poll, idle_timeout=args.timeout)
+
+    print("Watching took %d seconds\n" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
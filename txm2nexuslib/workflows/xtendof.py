@@ -29,13 +29,15 @@ import subprocess
 import argparse
 from argparse import RawTextHelpFormatter
 
+from txm2nexuslib.util import Executor, EXECUTOR_BACKENDS
 from txm2nexuslib.images.multiplexrm2h5 import multiple_xrm_2_hdf5
 from txm2nexuslib.images.util import copy2proc_multiple
-from txm2nexuslib.images.multiplecrop import crop_images
 from txm2nexuslib.images.multiplenormalization import normalize_images
 from txm2nexuslib.images.multiplealign import align_images
 from txm2nexuslib.images.multipleaverage import average_image_groups
 from txm2nexuslib.images.imagestostack import many_images_to_h5_stack
+from txm2nexuslib.images.fusedpipeline import (fused_preprocessing,
+                                               DEFAULT_ROI)
 from txm2nexuslib.parser import create_db, get_db_path
 
 
@@ -80,6 +82,29 @@ def main():
                         help="Create individual ZP stacks\n"
                              "(default: True)")
 
+    parser.add_argument('--db_backend', type=str, default='json',
+                        choices=['json', 'sqlite'],
+                        help="Backend of the files index DataBase:\n"
+                             "index.json (json) or index.sqlite (sqlite)\n"
+                             "(default: json)")
+
+    parser.add_argument('--fused', action='store_true',
+                        help="Fused pre-processing: crop, normalize, align\n"
+                             "and average each group of xrm images in\n"
+                             "memory, storing only the averaged images\n"
+                             "(and the normalized images if needed for\n"
+                             "the stacks)")
+
+    parser.add_argument('--copy_free', action='store_true',
+                        help="Do not copy the raw hdf5 files to the files\n"
+                             "for processing: these map the raw images")
+
+    parser.add_argument('--executor', type=str, default='processes',
+                        choices=sorted(EXECUTOR_BACKENDS),
+                        help="Workers of the pre-processing stages, created\n"
+                             "once and reused by all the stages\n"
+                             "(default: processes)")
+
     args = parser.parse_args()
 
     print("\nWorkflow with Extended Depth of Field:\n" +
@@ -87,36 +112,52 @@ def main():
           " variable zpz -> average all images with same angle ->" +
           " make normalized stacks")
     start_time = time.time()
-
-    db_filename = get_db_path(args.txm_txt_script)
-    create_db(args.txm_txt_script)
-    # Multiple xrm 2 hdf5 files: working with many single images files
-    multiple_xrm_2_hdf5(db_filename)
-
-    # Copy of multiple hdf5 raw data files to files for processing
-    copy2proc_multiple(db_filename)
-
-    # Multiple files hdf5 images crop: working with single images files
-    if args.crop:
-        crop_images(db_filename)
-
-    # Normalize multiple hdf5 files: working with many single images files
-    normalize_images(db_filename)
-
-    if args.stacks_zp:
-        many_images_to_h5_stack(db_filename, table_name="hdf5_proc",
-                                type_struct="normalized", suffix="_stack")
-
-    # Align multiple hdf5 files: working with many single images files
-    align_images(db_filename, align_method='cv2.TM_SQDIFF_NORMED')
-
-    # Average multiple hdf5 files: working with many single images files
-    average_image_groups(db_filename)
-
-    # Build up hdf5 stacks from individual images
-    many_images_to_h5_stack(db_filename, table_name=args.table_for_stack,
-                            type_struct="normalized_multifocus",
-                            suffix="_FS")
+    with Executor(args.executor) as executor:
+        db_filename = get_db_path(args.txm_txt_script,
+                                  backend=args.db_backend)
+        create_db(args.txm_txt_script, backend=args.db_backend)
+        if args.fused:
+            # Crop, normalize, align and average in a single pass
+            fused_preprocessing(db_filename, crop=args.crop,
+                                align_method='cv2.TM_SQDIFF_NORMED',
+                                checkpoint=args.stacks_zp,
+                                executor=executor)
+            if args.stacks_zp:
+                many_images_to_h5_stack(db_filename, table_name="hdf5_proc",
+                                        type_struct="normalized",
+                                        suffix="_stack", executor=executor)
+        else:
+            # Multiple xrm 2 hdf5 files: working with many single images files
+            # (cropped while they are decoded, if crop)
+            multiple_xrm_2_hdf5(db_filename,
+                                roi=DEFAULT_ROI if args.crop else None,
+                                executor=executor)
+
+            # Copy of multiple hdf5 raw data files to files for processing
+            copy2proc_multiple(db_filename, copy_free=args.copy_free,
+                               executor=executor)
+
+            # Normalize multiple hdf5 files: working with many single images
+            # files
+            normalize_images(db_filename, executor=executor)
+
+            if args.stacks_zp:
+                many_images_to_h5_stack(db_filename, table_name="hdf5_proc",
+                                        type_struct="normalized",
+                                        suffix="_stack", executor=executor)
+
+            # Align multiple hdf5 files: working with many single images files
+            align_images(db_filename, align_method='cv2.TM_SQDIFF_NORMED',
+                         executor=executor)
+
+            # Average multiple hdf5 files: working with many single images
+            # files
+            average_image_groups(db_filename, executor=executor)
+
+        # Build up hdf5 stacks from individual images
+        many_images_to_h5_stack(db_filename, table_name=args.table_for_stack,
+                                type_struct="normalized_multifocus",
+                                suffix="_FS", executor=executor)
 
     print("xtendof took %d seconds\n" % (time.time() - start_time))
 
@@ -30,9 +30,9 @@ import re
 import pkg_resources
 #import pprint
 
-from tinydb import Query
-from operator import itemgetter
-from txm2nexuslib.parser import get_db, get_file_paths
+from txm2nexuslib.parser import get_db
+from txm2nexuslib.images.util import group_records
+from txm2nexuslib.util import decode_image, ordered_imap, FrameWriter
 
 
 SAMPLEENC = 2
@@ -63,107 +63,69 @@ class FilesOrganization(object):
         all_file_records = db.all()
         #prettyprinter.pprint(all_file_records)
 
-        dates_samples_energies = []
-        for record in all_file_records:
-            dates_samples_energies.append((record["date"],
-                                           record["sample"],
-                                           record["energy"]))
-        dates_samples_energies = list(set(dates_samples_energies))
-
+        # Files of the tomos of each date, sample and energy by zpz
+        # (or by repetition), sorted by angle; and FF files of each date,
+        # sample and energy
+        if not organize_by_repetitions:
+            tomo_key = "zpz"
+        else:
+            tomo_key = "repetition"
         samples = {}
-        files_query = Query()
-
-        for date_sample_energie in dates_samples_energies:
-            files_raw_data = {}
-            files_for_sample_subdict = {}
-
-            date = date_sample_energie[0]
-            sample = date_sample_energie[1]
-            energy = date_sample_energie[2]
-
-            query_impl = ((files_query.date == date) &
-                          (files_query.sample == sample) &
-                          (files_query.energy == energy) &
-                          (files_query.FF == False))
-
-            records_by_sample_and_energy = db.search(query_impl)
-
-            if not organize_by_repetitions:
-                zps_by_sample_and_e = [record["zpz"] for record in
-                                       records_by_sample_and_energy]
-                zpz_positions_by_sample_e = sorted(set(zps_by_sample_and_e))
-
-                for zpz in zpz_positions_by_sample_e:
-                    query_impl = ((files_query.date == date) &
-                                  (files_query.sample == sample) &
-                                  (files_query.energy == energy) &
-                                  (files_query.zpz == zpz) &
-                                  (files_query.FF == False))
-                    fn_by_zpz_query = db.search(query_impl)
-                    sorted_fn_by_zpz_query = sorted(fn_by_zpz_query,
-                                                    key=itemgetter('angle'))
-
-                    files = get_file_paths(sorted_fn_by_zpz_query, root_path,
-                                           use_subfolders=use_subfolders)
-                    files_raw_data[zpz] = files
-            else:
-                repetitions_by_sample_and_e = [record["repetition"] for record
-                                               in records_by_sample_and_energy]
-
-                repetitions_by_sample_and_e = sorted(set(
-                    repetitions_by_sample_and_e))
-
-                for repetition in repetitions_by_sample_and_e:
-                    query_impl = ((files_query.date == date) &
-                                  (files_query.sample == sample) &
-                                  (files_query.energy == energy) &
-                                  (files_query.repetition == repetition) &
-                                  (files_query.FF == False))
-                    fn_by_repetition_query = db.search(query_impl)
-                    sorted_fn_by_repetition_query = sorted(
-                        fn_by_repetition_query, key=itemgetter('angle'))
-                    files = get_file_paths(sorted_fn_by_repetition_query,
-                                           root_path,
-                                           use_subfolders=use_subfolders)
-                    files_raw_data[repetition] = files
-
-            # Get FF image records
-            fn_ff_query_by_energy = ((files_query.date == date) &
-                                     (files_query.sample == sample) &
-                                     (files_query.energy == energy) &
-                                     (files_query.FF == True))
-            query_output = db.search(fn_ff_query_by_energy)
-            files_FF = get_file_paths(query_output, root_path,
-                                      use_subfolders=use_subfolders)
-
-            files_for_sample_subdict['tomos'] = files_raw_data
-            files_for_sample_subdict['ff'] = files_FF
-            samples[date_sample_energie] = files_for_sample_subdict
+        for group in group_records(all_file_records,
+                                   ("date", "sample", "energy", tomo_key),
+                                   ff_keys=("date", "sample", "energy"),
+                                   root_path=root_path,
+                                   use_subfolders=use_subfolders):
+            date_sample_energie = group.key[:3]
+            if date_sample_energie not in samples:
+                samples[date_sample_energie] = {'tomos': {},
+                                                'ff': group.ff_files}
+            samples[date_sample_energie]['tomos'][group.key[3]] = group.files
 
         #prettyprinter.pprint(samples)
         return samples
 
 
+def _date_to_iso(date):
+    """Convert a date of the xrm files (mm/dd/yy hh:mm:ss) to ISO format"""
+    [day, hour] = date.split(" ")
+    [month, day, year] = day.split("/")
+    [hour, minute, second] = hour.split(":")
+
+    year = '20' + year
+    year = int(year)
+    month = int(month)
+    day = int(day)
+    hour = int(hour)
+    minute = int(minute)
+    second = int(second)
+
+    raw_time = datetime.datetime(year, month, day,
+                                 hour, minute, second)
+    return raw_time.isoformat()
+
+
 class validate_getter(object):
     def __init__(self, required_fields):
         self.required_fields = required_fields
 
     def __call__(self, method):
-        def wrapped_method(xradia_file):
+        def wrapped_method(xradia_file, *args, **kwargs):
             if not xradia_file.is_opened():
                 raise RuntimeError("XradiaFile is not opened")
             for field in self.required_fields:
                 if not xradia_file.exists(field):
                     raise RuntimeError(
                         "%s does not exist in XradiaFile" % field)
-            return method(xradia_file)
+            return method(xradia_file, *args, **kwargs)
 
         return wrapped_method
 
 
 class XradiaFile(object):
-    def __init__(self, file_name):
+    def __init__(self, file_name, use_mmap=True):
         self.file_name = file_name
+        self.use_mmap = use_mmap
         self.file = None
         self._axes_names = None
         self._no_of_images = None
@@ -188,7 +150,7 @@ class XradiaFile(object):
         return self.file is not None
 
     def open(self):
-        self.file = OleFileIO(self.file_name)
+        self.file = OleFileIO(self.file_name, use_mmap=self.use_mmap)
 
     def close(self):
         self.file.close()
@@ -264,48 +226,31 @@ class XradiaFile(object):
         return distance
 
     @validate_getter(["ImageData1/Image1"])
-    def get_image(self):
+    def _decode_image(self, out=None):
         stream = self.file.openstream('ImageData1/Image1')
-        data = stream.read()
+        data = stream.getbuffer()
+        return decode_image(data, self.image_height, self.image_width,
+                            self.data_type, out=out)
 
-        if self.data_type == 'uint16':
-            struct_fmt = "<{0:10}H".format(
-                self.image_height * self.image_width)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.data_type == 'float':
-            struct_fmt = "<{0:10}f".format(
-                self.image_height * self.image_width)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:
-            print "Wrong data type"
-            return
-
-        image = np.flipud(np.reshape(imgdata, (self.image_height,
-                                               self.image_width), order='A'))
-        image = np.reshape(image, (1, self.image_height, self.image_width),
-                           order='A')
-        return image
+    def get_image(self, out=None):
+        """Image as a (1, height, width) array.
 
-    @validate_getter(["ImageData1/Image1"])
-    def get_image_2D(self):
-        stream = self.file.openstream('ImageData1/Image1')
-        data = stream.read()
+        :param out: optional preallocated array in which the image
+                    is decoded (e.g. a frame of a bigger stack)
+        """
+        image = self._decode_image(out=out)
+        if image is None or out is not None:
+            return image
+        return image.reshape((1, self.image_height, self.image_width))
 
-        if self.data_type == 'uint16':
-            struct_fmt = "<{0:10}H".format(
-                self.image_height * self.image_width)
-            imgdata = struct.unpack(struct_fmt, data)
-        elif self.data_type == 'float':
-            struct_fmt = "<{0:10}f".format(
-                self.image_height * self.image_width)
-            imgdata = struct.unpack(struct_fmt, data)
-        else:
-            print "Wrong data type"
-            return
+    def get_image_2D(self, out=None):
+        """Image as a (height, width) array.
 
-        image = np.flipud(np.reshape(imgdata, (self.image_height,
-                                               self.image_width), order='A'))
-        return image
+        Without out, a read-only flipped view on the raw stream data
+        is returned, avoiding any copy of the image (with use_mmap, the
+        view is directly on the memory mapped file).
+        """
+        return self._decode_image(out=out)
 
     @validate_getter(["PositionInfo/AxisNames"])
     def get_axes_names(self):
@@ -564,43 +509,14 @@ class XradiaFile(object):
     dates = property(get_dates)
 
     def get_start_date(self):
-
-        startdate = self.dates[0]
-        [day, hour] = startdate.split(" ")
-        [month, day, year] = day.split("/")
-        [hour, minute, second] = hour.split(":")
-
-        year = '20' + year
-        year = int(year)
-        month = int(month)
-        day = int(day)
-        hour = int(hour)
-        minute = int(minute)
-        second = int(second)
-
-        starttime = datetime.datetime(year, month, day,
-                                      hour, minute, second)
-        starttimeiso = starttime.isoformat()
-        return starttimeiso
+        return _date_to_iso(self.dates[0])
 
     def get_end_date(self):
-        enddate = self.dates[self.no_of_images - 1]
-        [endday, endhour] = enddate.split(" ")
-        [endmonth, endday, endyear] = endday.split("/")
-        [endhour, endminute, endsecond] = endhour.split(":")
-
-        endyear = '20' + endyear
-        endyear = int(endyear)
-        endmonth = int(endmonth)
-        endday = int(endday)
-        endhour = int(endhour)
-        endminute = int(endminute)
-        endsecond = int(endsecond)
-
-        endtime = datetime.datetime(endyear, endmonth, endday,
-                                    endhour, endminute, endsecond)
-        endtimeiso = endtime.isoformat()
-        return endtimeiso
+        return _date_to_iso(self.dates[self.no_of_images - 1])
+
+    def get_iso_dates(self):
+        return [_date_to_iso(date) for date in
+                self.dates[:self.no_of_images]]
 
     def get_det_zero(self):
         where_detzero = ("ConfigureBackup/ConfigCamera/" +
@@ -622,6 +538,12 @@ class XradiaFile(object):
     det_zero = property(get_det_zero)
 
 
+def _read_xrm_image(file_name):
+    """Decode the image of a xrm file (function run by worker processes)"""
+    with XradiaFile(file_name) as xrm_file:
+        return xrm_file.get_image_2D()
+
+
 class xrmNXtomo(object):
 
     definition = 'NXtomo'
@@ -634,7 +556,7 @@ class xrmNXtomo(object):
                  zero_deg_in=None, zero_deg_final=None, sourcename='ALBA',
                  sourcetype='Synchrotron X-ray Source',
                  sourceprobe='x-ray', instrument='BL09 @ ALBA',
-                 sample='Unknown'):
+                 sample='Unknown', workers=1):
 
         self.reader = reader
         self.ff_reader = ffreader
@@ -694,6 +616,9 @@ class xrmNXtomo(object):
         self.nFramesBright = 0
         self.datatype_bright = 'uint16'
 
+        # Number of processes decoding the images (1: serial conversion)
+        self.workers = workers
+
     def convert_metadata(self):
 
         self.nxentry = self.txrmhdf.create_group(self.definition)
@@ -799,6 +724,31 @@ class xrmNXtomo(object):
         self.nxsample['z_translation'] = zpositions
         self.nxsample['z_translation'].attrs['units'] = 'um'
 
+    def _convert_images(self, reader, dataset):
+        """Write the images of the reader files in the dataset.
+
+        Yields the number of each image once it is queued for writing
+        (parallel mode) or written (serial mode). With several workers,
+        a pool of processes decodes the xrm files while a single thread
+        writes the images in order in the dataset.
+        """
+        nframes = reader.get_images_number()
+        if self.workers <= 1 or nframes < 2:
+            for numimage in range(nframes):
+                dataset[numimage] = reader.get_image(numimage)
+                yield numimage
+            return
+        images = ordered_imap(_read_xrm_image, reader.file_names,
+                              self.workers)
+        writer = FrameWriter(dataset, queue_size=2 * self.workers)
+        writer.start()
+        try:
+            for numimage, image in enumerate(images):
+                writer.put(image)
+                yield numimage
+        finally:
+            writer.close()
+
     def _convert_samples(self):
         self.numrows, self.numcols = self.reader.get_image_size()
         data_type = self.reader.get_data_type()
@@ -828,12 +778,11 @@ class xrmNXtomo(object):
         self.nxdetectorsample['data'].attrs[
             'Image Width'] = self.numcols
 
-        for numimage in range(self.nSampleFrames):
+        for numimage in self._convert_images(
+                self.reader, self.nxdetectorsample['data']):
             self.count_num_sequence = self.count_num_sequence + 1
-            tomoimagesingle = self.reader.get_image(numimage)
             self.num_sample_sequence.append(
                 self.count_num_sequence)
-            self.nxdetectorsample['data'][numimage] = tomoimagesingle
             if numimage % 20 == 0:
                 print('Image %i converted' % numimage)
             if numimage + 1 == self.nSampleFrames:
@@ -871,14 +820,13 @@ class xrmNXtomo(object):
         self.nxbright['data'].attrs['Image Width'] = \
             self.numcols_bright
 
-        for numimage in range(self.nFramesBright):
+        for numimage in self._convert_images(self.ff_reader,
+                                             self.nxbright['data']):
             if numimage + 1 == self.nFramesBright:
                 print ('%i Bright-Field images '
                        'converted\n' % self.nFramesBright)
             self.count_num_sequence = self.count_num_sequence + 1
-            tomoimagesingle = self.ff_reader.get_image(numimage)
             self.num_bright_sequence.append(self.count_num_sequence)
-            self.nxbright['data'][numimage] = tomoimagesingle
 
         # Accelerator current for each image of FF (machine current)
         ff_currents = self.ff_reader.get_machine_currents()
@@ -1026,114 +974,186 @@ class xrmNXtomo(object):
 
 
 class xrmReader(object):
+
+    # Metadata having a value per image: (field, XradiaFile getter)
+    IMAGE_FIELDS = (('angles', 'get_angles'),
+                    ('energies', 'get_energies'),
+                    ('exp_times', 'get_exp_times'),
+                    ('machine_currents', 'get_machine_currents'),
+                    ('x_positions', 'get_x_positions'),
+                    ('y_positions', 'get_y_positions'),
+                    ('z_positions', 'get_z_positions'),
+                    ('dates', 'get_iso_dates'))
+    # Metadata having a value per file: (field, XradiaFile getter)
+    FILE_FIELDS = (('pixel_size', 'get_pixel_size'),
+                   ('xray_magnification', 'get_xray_magnification'),
+                   ('distance', 'get_distance'),
+                   ('sample_id', 'get_sample_id'),
+                   ('data_type', 'get_data_type'),
+                   ('image_height', 'get_image_height'),
+                   ('image_width', 'get_image_width'))
+
     def __init__(self, file_names):
         self.file_names = file_names
+        self._metadata = None
+        # Rows (start, stop) of each file in the columns of each field
+        self._file_rows = {}
+        # Errors of each field by file index
+        self._metadata_errors = {}
 
     def get_images_number(self):
         return len(self.file_names)
 
+    def harvest_metadata(self):
+        """Read the metadata of all the files, opening each file once.
+
+        :return: dictionary of NumPy arrays (columns), indexed by field
+                 name. The IMAGE_FIELDS columns have a value per image (of
+                 all the files), the FILE_FIELDS columns have a value per
+                 file. The values of a field which could not be read in
+                 some file are masked (numeric columns) or None (object
+                 columns); the getters only raise the original error if
+                 they need the value of that file.
+        """
+        if self._metadata is not None:
+            return self._metadata
+        fields = self.IMAGE_FIELDS + self.FILE_FIELDS
+        file_values = dict([(field, []) for field, _ in fields])
+        errors = dict([(field, {}) for field, _ in fields])
+        for index, file_name in enumerate(self.file_names):
+            try:
+                xrm_file = XradiaFile(file_name)
+                xrm_file.open()
+            except Exception as e:
+                for field, _ in fields:
+                    errors[field][index] = e
+                    file_values[field].append(None)
+                continue
+            try:
+                for field, getter in fields:
+                    try:
+                        value = getattr(xrm_file, getter)()
+                    except Exception as e:
+                        errors[field][index] = e
+                        value = None
+                    file_values[field].append(value)
+            finally:
+                xrm_file.close()
+        # Number of images of each file (one if it could not be read)
+        images_number = []
+        for index in range(len(self.file_names)):
+            lengths = [len(file_values[field][index])
+                       for field, _ in self.IMAGE_FIELDS
+                       if index not in errors[field]]
+            images_number.append(lengths[0] if lengths else 1)
+
+        metadata = {}
+        file_rows = {}
+        for field, _ in fields:
+            image_field = field in dict(self.IMAGE_FIELDS)
+            values = []
+            mask = []
+            rows = []
+            for index, value in enumerate(file_values[field]):
+                num_values = images_number[index] if image_field else 1
+                if index in errors[field]:
+                    value = [None] * num_values
+                elif not image_field:
+                    value = [value]
+                rows.append((len(values), len(values) + len(value)))
+                values.extend(value)
+                mask.extend([index in errors[field]] * len(value))
+            if not errors[field]:
+                column = np.asarray(values)
+            else:
+                valid = [value for value, masked in zip(values, mask)
+                         if not masked]
+                if valid and np.asarray(valid).dtype.kind in "biuf":
+                    column = np.ma.masked_array(
+                        [0 if masked else value
+                         for value, masked in zip(values, mask)],
+                        mask=mask, dtype=np.asarray(valid).dtype)
+                else:
+                    column = np.empty(len(values), dtype=object)
+                    column[:] = values
+            metadata[field] = column
+            file_rows[field] = rows
+        self._file_rows = file_rows
+        self._metadata_errors = errors
+        self._metadata = metadata
+        return self._metadata
+
+    def _get_field(self, field, files=None):
+        """Values of the field in the files of the given indexes (all the
+        files by default): the values of their images for IMAGE_FIELDS,
+        a value per file otherwise. The original error is raised if the
+        field could not be read in one of these files"""
+        column = self.harvest_metadata()[field]
+        if files is None:
+            files = range(len(self.file_names))
+        values = []
+        for index in files:
+            if index in self._metadata_errors[field]:
+                raise self._metadata_errors[field][index]
+            start, stop = self._file_rows[field][index]
+            values.extend(np.asarray(column[start:stop]).tolist())
+        return values
+
     def get_pixel_size(self):
-        file_name = self.file_names[0]
-        with XradiaFile(file_name) as xrm_file:
-            return xrm_file.pixel_size
+        return self._get_field('pixel_size', [0])[0]
 
     def get_exp_times(self):
-        exp_times = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                exp_times.extend(xrm_file.get_exp_times())
-        return exp_times
+        return self._get_field('exp_times')
 
     def get_machine_currents(self):
-        currents = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                currents.extend(xrm_file.get_machine_currents())
-        return currents
+        return self._get_field('machine_currents')
 
     def get_energies(self):
-        energies = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                energies.extend(xrm_file.get_energies())
-        return energies
+        return self._get_field('energies')
 
     def get_start_time(self):
-        filename = self.file_names[0]
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_start_date()
+        return self._get_field('dates', [0])[0]
 
     def get_end_time(self):
-        filename = self.file_names[-1]
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_end_date()
+        return self._get_field('dates', [len(self.file_names) - 1])[-1]
 
     def get_angles(self):
-        angles = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                angles.extend(xrm_file.get_angles())
-        return angles
+        return self._get_field('angles')
 
     def get_x_positions(self):
-        positions = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                positions.extend(xrm_file.get_x_positions())
-        return positions
+        return self._get_field('x_positions')
 
     def get_y_positions(self):
-        positions = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                positions.extend(xrm_file.get_y_positions())
-        return positions
+        return self._get_field('y_positions')
 
     def get_z_positions(self):
-        positions = []
-        for file_name in self.file_names:
-            with XradiaFile(file_name) as xrm_file:
-                positions.extend(xrm_file.get_z_positions())
-        return positions
+        return self._get_field('z_positions')
 
-    def get_image(self, id):
+    def get_image(self, id, out=None):
         """
         :param id: number of the images sequence
+        :param out: optional preallocated array where decoding the image
         :return: image data
         """
         filename = self.file_names[id]
         with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_image()
+            return xrm_file.get_image(out=out)
 
     def get_distance(self):
-        filename = self.file_names[0]
-        # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_distance()
+        return self._get_field('distance', [0])[0]
 
     def get_sample_id(self):
-        filename = self.file_names[0]
-        # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_sample_id()
+        return self._get_field('sample_id', [0])[0]
 
     def get_xray_magnification(self):
-        filename = self.file_names[0]
-        # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.get_xray_magnification()
+        return self._get_field('xray_magnification', [0])[0]
 
     def get_data_type(self):
-        filename = self.file_names[0]
-        # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.data_type
+        return self._get_field('data_type', [0])[0]
 
     def get_image_size(self):
-        filename = self.file_names[0]
-        # TODO: get the data from the first file
-        with XradiaFile(filename) as xrm_file:
-            return xrm_file.image_height, xrm_file.image_width
+        return (self._get_field('image_height', [0])[0],
+                self._get_field('image_width', [0])[0])
 
     def get_sample_name(self):
         filename = self.file_names[0]